@@ -0,0 +1,137 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import db_interaction
+from db_pool import db_pool
+from metrics import db_query_seconds
+
+
+# psycopg2 is blocking, so every query runs on a dedicated executor whose size
+# matches the connection pool. Handlers await these coroutines and the aiogram
+# event loop keeps processing updates while Postgres is slow.
+db_executor = ThreadPoolExecutor(max_workers=db_pool.max_size, thread_name_prefix="db")
+
+
+def timed_call(function_name, func, *args, **kwargs):
+    # Runs on the executor thread, so queueing for a free thread isn't counted
+    with db_query_seconds.time(function=function_name):
+        return func(*args, **kwargs)
+
+
+async def run_in_db_executor(func, *args, **kwargs):
+    return await run_named_in_db_executor(func.__name__, func, *args, **kwargs)
+
+
+async def run_named_in_db_executor(function_name, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(db_executor, functools.partial(timed_call, function_name, func, *args, **kwargs))
+
+
+async def create_tables_DB():
+    return await run_in_db_executor(db_interaction.create_tables_DB)
+
+
+async def migrate_tables_DB():
+    return await run_in_db_executor(db_interaction.migrate_tables_DB)
+
+
+async def drop_tables_DB():
+    return await run_in_db_executor(db_interaction.drop_tables_DB)
+
+
+async def add_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
+    return await run_in_db_executor(db_interaction.add_user_DB, telegram_id, url, display_hour, display_minutes)
+
+
+async def upsert_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
+    return await run_in_db_executor(db_interaction.upsert_user_DB, telegram_id, url, display_hour, display_minutes)
+
+
+async def get_user_DB(telegram_id):
+    # Cache hits are answered without a trip through the executor
+    row = db_interaction.user_cache.get(telegram_id)
+    if row is not None:
+        return row
+    return await run_in_db_executor(db_interaction.fetch_user_DB, telegram_id)
+
+
+async def update_display_time(telegram_id, display_hour, display_minutes):
+    return await run_in_db_executor(db_interaction.update_display_time, telegram_id, display_hour, display_minutes)
+
+
+async def remove_user_DB(telegram_id):
+    return await run_in_db_executor(db_interaction.remove_user_DB, telegram_id)
+
+
+async def deactivate_user_DB(telegram_id):
+    return await run_in_db_executor(db_interaction.deactivate_user_DB, telegram_id)
+
+
+async def add_mailing_date_DB(date):
+    return await run_in_db_executor(db_interaction.add_mailing_date_DB, date)
+
+
+async def get_all_users_DB():
+    return await run_in_db_executor(db_interaction.get_all_users_DB)
+
+
+async def enqueue_due_jobs_DB(from_minute, to_minute, target_date):
+    return await run_in_db_executor(db_interaction.enqueue_due_jobs_DB, from_minute, to_minute, target_date)
+
+
+async def claim_jobs_DB(target_date, worker_id, lease_seconds, batch_size=1000):
+    return await run_in_db_executor(db_interaction.claim_jobs_DB, target_date, worker_id, lease_seconds, batch_size)
+
+
+async def enqueue_prefetch_jobs_DB(from_minute, to_minute, target_date):
+    return await run_in_db_executor(db_interaction.enqueue_prefetch_jobs_DB, from_minute, to_minute, target_date)
+
+
+async def claim_prefetch_jobs_DB(from_minute, to_minute, target_date, worker_id, reserved_until, batch_size=1000):
+    return await run_in_db_executor(db_interaction.claim_prefetch_jobs_DB, from_minute, to_minute, target_date,
+                                    worker_id, reserved_until, batch_size)
+
+
+async def renew_leases_DB(worker_id, lease_seconds):
+    return await run_in_db_executor(db_interaction.renew_leases_DB, worker_id, lease_seconds)
+
+
+async def record_deliveries_DB(deliveries):
+    return await run_in_db_executor(db_interaction.record_deliveries_DB, deliveries)
+
+
+async def get_fsm_record_DB(storage_key):
+    return await run_in_db_executor(db_interaction.get_fsm_record_DB, storage_key)
+
+
+async def set_fsm_state_DB(storage_key, state):
+    return await run_in_db_executor(db_interaction.set_fsm_state_DB, storage_key, state)
+
+
+async def set_fsm_data_DB(storage_key, data):
+    return await run_in_db_executor(db_interaction.set_fsm_data_DB, storage_key, data)
+
+
+async def sync_feed_snapshots_DB():
+    return await run_in_db_executor(db_interaction.sync_feed_snapshots_DB)
+
+
+async def claim_due_feeds_DB(poll_interval, batch_size=50):
+    return await run_in_db_executor(db_interaction.claim_due_feeds_DB, poll_interval, batch_size)
+
+
+async def save_feed_snapshot_DB(url, etag, last_modified, digest, window_end, events):
+    return await run_in_db_executor(db_interaction.save_feed_snapshot_DB, url, etag, last_modified, digest,
+                                    window_end, events)
+
+
+async def get_display_minutes_DB():
+    return await run_in_db_executor(db_interaction.get_display_minutes_DB)
+
+
+async def get_all_mailing_history_DB():
+    return await run_in_db_executor(db_interaction.get_all_mailing_history_DB)
+
+
+def shutdown_db_executor():
+    db_executor.shutdown(wait=True)
@@ -0,0 +1,452 @@
+"""
+End-to-end benchmark of the daily fan-out against local stand-ins.
+
+A helper process serves synthetic KUSSS feeds with configurable latency and a
+fake Telegram Bot API that enforces the global and per-chat rate limits. The
+benchmark seeds a local Postgres with N users, times the db_interaction
+functions and Schedule.get_daily_schedule, then sends every user their
+schedule through send_daily_schedule and reports delivery latency, fan-out
+time, messages/s and peak RSS as JSON.
+
+    python benchmark.py --users 100 1000 10000 --output bench.json
+    python benchmark.py --users 1000 --baseline bench.json
+
+The tables of --database are dropped and recreated, point it at a scratch
+database, never at production.
+"""
+import argparse
+import asyncio
+import gc
+import json
+import math
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from collections import deque
+from datetime import date, datetime, timedelta
+
+BOT_TOKEN = "123456:benchmark-token"
+
+COURSES = [
+    "VL Algorithms and Data Structures 1", "UE Algorithms and Data Structures 1",
+    "KV Responsible AI", "VL Machine Learning: Basic Techniques", "UE Hands-on AI I",
+    "VL Computational Statistics", "KV Software Engineering", "PR Software Development",
+    "VL Formal Models", "KS Mathematics for AI I", "VL Logic", "SE Seminar in AI",
+]
+INSTRUCTORS = ["Martina Mara", "Sepp Hochreiter", "Johannes Brandstetter", "Werner Retschitzegger",
+               "Bernhard Nessler", "Alois Ferscha", "Armin Biere", "Gerhard Widmer"]
+ROOMS = ["HS 1", "HS 18", "S3 048", "SP2 416-1", "K 224B", "LIT 1.331", "Online"]
+
+
+def generate_feed(seed, days=60, events_per_day=3, start=None):
+    """
+    Synthetic KUSSS export: days of events around start (today by default),
+    each a VEVENT with a TZID start/end, "title / instructor / (code)" summary,
+    room and a folded description. The seed picks courses and rooms, so
+    feeds of different users differ in content like real ones do.
+    """
+    rng = random.Random(seed)
+    start = start or date.today()
+    lines = [
+        "BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//JKU//KUSSS//DE", "CALSCALE:GREGORIAN",
+        "BEGIN:VTIMEZONE", "TZID:Europe/Vienna",
+        "BEGIN:STANDARD", "DTSTART:19701025T030000", "TZOFFSETFROM:+0200", "TZOFFSETTO:+0100",
+        "RRULE:FREQ=YEARLY;BYMONTH=10;BYDAY=-1SU", "END:STANDARD",
+        "BEGIN:DAYLIGHT", "DTSTART:19700329T020000", "TZOFFSETFROM:+0100", "TZOFFSETTO:+0200",
+        "RRULE:FREQ=YEARLY;BYMONTH=3;BYDAY=-1SU", "END:DAYLIGHT",
+        "END:VTIMEZONE",
+    ]
+    uid = 0
+    for offset in range(-days // 2, days - days // 2):
+        day = start + timedelta(days=offset)
+        if day.weekday() >= 5:
+            continue
+        for slot in sorted(rng.sample(range(5), min(events_per_day, 5))):
+            uid += 1
+            begin = datetime(day.year, day.month, day.day, 8 + 2 * slot, rng.choice((0, 15, 30, 45)))
+            end = begin + timedelta(minutes=rng.choice((45, 90, 135)))
+            code = f"{rng.randint(100000, 999999)}/{start.year}W"
+            lines += [
+                "BEGIN:VEVENT",
+                f"UID:{seed}-{uid}@kusss.jku.at",
+                f"DTSTAMP:{begin:%Y%m%dT%H%M%S}Z",
+                f"DTSTART;TZID=Europe/Vienna:{begin:%Y%m%dT%H%M%S}",
+                f"DTEND;TZID=Europe/Vienna:{end:%Y%m%dT%H%M%S}",
+                f"SUMMARY:{rng.choice(COURSES)} / {rng.choice(INSTRUCTORS)} / ({code})",
+                f"LOCATION:{rng.choice(ROOMS)}",
+                "DESCRIPTION:Lehrveranstaltung laut KUSSS\\, Details und Unterlagen im Moodle-Kurs der LVA\r\n"
+                " \\, Änderungen werden per Mail bekanntgegeben",
+                "END:VEVENT",
+            ]
+    lines.append("END:VCALENDAR")
+    return ("\r\n".join(lines) + "\r\n").encode("utf-8")
+
+
+# Stand-ins, run in their own process so they don't compete with the bot for the GIL
+
+def serve_stand_ins(config, ready):
+    asyncio.run(_serve_stand_ins(config, ready))
+
+
+async def _serve_stand_ins(config, ready):
+    from aiohttp import web
+
+    feeds = {}
+    sent = {}
+    recent = deque()
+    last_chat_send = {}
+    stats = {"feed_requests": 0, "messages": 0, "rate_limited": 0}
+
+    async def feed(request):
+        await asyncio.sleep(config["feed_latency"])
+        number = int(request.match_info["number"])
+        body = feeds.get(number)
+        if body is None:
+            body = generate_feed(number, config["feed_days"], config["events_per_day"])
+            if len(feeds) < 2048:
+                feeds[number] = body
+        stats["feed_requests"] += 1
+        return web.Response(body=body, content_type="text/calendar")
+
+    def too_many_requests(retry_after):
+        stats["rate_limited"] += 1
+        return web.json_response({
+            "ok": False, "error_code": 429,
+            "description": f"Too Many Requests: retry after {retry_after}",
+            "parameters": {"retry_after": retry_after},
+        })
+
+    async def send_message(request):
+        data = await request.post()
+        chat_id = int(data["chat_id"])
+        now = time.monotonic()
+        while recent and recent[0] <= now - 1:
+            recent.popleft()
+        if len(recent) >= config["telegram_rate"]:
+            return too_many_requests(1)
+        if now - last_chat_send.get(chat_id, -math.inf) < config["per_chat_interval"]:
+            return too_many_requests(1)
+        recent.append(now)
+        last_chat_send[chat_id] = now
+        sent[chat_id] = now
+        stats["messages"] += 1
+        return web.json_response({"ok": True, "result": {
+            "message_id": stats["messages"], "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"}, "text": data.get("text", ""),
+        }})
+
+    async def get_stats(request):
+        return web.json_response({**stats, "sent_at": sent})
+
+    async def reset(request):
+        sent.clear()
+        last_chat_send.clear()
+        for key in stats:
+            stats[key] = 0
+        return web.json_response({"ok": True})
+
+    app = web.Application(client_max_size=16 * 1024 * 1024)
+    app.router.add_get("/feeds/{number}.ics", feed)
+    app.router.add_post(f"/bot{BOT_TOKEN}/sendMessage", send_message)
+    app.router.add_get("/stats", get_stats)
+    app.router.add_post("/reset", reset)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", config["port"]).start()
+    ready.set()
+    await asyncio.Event().wait()
+
+
+# Measurements
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(math.ceil(fraction * len(ordered)) - 1, 0)]
+
+
+def summarize(durations):
+    # Seconds in, milliseconds out
+    return {
+        "count": len(durations),
+        "total_ms": round(sum(durations) * 1000, 3),
+        "p50_ms": round(percentile(durations, 0.5) * 1000, 3) if durations else None,
+        "p99_ms": round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+    }
+
+
+def timed(func, *args):
+    started = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - started, result
+
+
+def peak_rss_mb(worker_pids):
+    # ru_maxrss is in kilobytes on Linux. The parse workers are still running,
+    # so their high-water marks come from /proc
+    workers = []
+    for pid in worker_pids:
+        try:
+            with open(f"/proc/{pid}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        workers.append(int(line.split()[1]) / 1024)
+        except OSError:
+            pass
+    return {
+        "bot": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "parse_workers": round(sum(workers), 1) if workers else None,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+
+def seed_users(db, users, feeds, base_url):
+    from psycopg2.extras import execute_values
+    from db_pool import db_pool
+
+    db.drop_tables_DB()
+    db.create_tables_DB()
+    db.migrate_tables_DB()
+    rows = [(telegram_id, f"{base_url}/feeds/{telegram_id % feeds}.ics", 0, 0) for telegram_id in range(1, users + 1)]
+    with db_pool.connection() as connection:
+        with connection.cursor() as cursor:
+            execute_values(cursor, "INSERT INTO USERS (TELEGRAM_ID, URL, display_hour, display_minutes) VALUES %s", rows)
+        connection.commit()
+    db.user_cache.clear()
+    return rows
+
+
+def bench_db(db, rows, sample):
+    picked = random.Random(0).sample(rows, min(sample, len(rows)))
+    results = {}
+
+    durations = [timed(db.upsert_user_DB, telegram_id, url, hour, minutes)[0] for telegram_id, url, hour, minutes in picked]
+    results["upsert_user_DB"] = summarize(durations)
+
+    db.user_cache.clear()
+    results["get_user_DB_cold"] = summarize([timed(db.get_user_DB, row[0])[0] for row in picked])
+    results["get_user_DB_cached"] = summarize([timed(db.get_user_DB, row[0])[0] for row in picked])
+
+    duration, _ = timed(db.get_all_users_DB)
+    results["get_all_users_DB"] = summarize([duration])
+
+    def stream_due_users():
+        return sum(len(batch) for batch in db.iter_due_users_DB(0, 1440, date.today(), 1000))
+    duration, streamed = timed(stream_due_users)
+    results["iter_due_users_DB"] = {**summarize([duration]), "rows": streamed}
+
+    duration, _ = timed(db.get_display_minutes_DB)
+    results["get_display_minutes_DB"] = summarize([duration])
+    return results
+
+
+def clear_feed_caches():
+    """
+    Forgets every downloaded feed, rendered message and shared event, so the
+    next measurement starts cold even after earlier sizes warmed them up.
+    """
+    from calendar_cache import calendar_cache
+    from event_store import event_store
+    from render_cache import render_cache
+
+    calendar_cache.clear()
+    render_cache.clear()
+    # Dropped indexes hand their event ids back from __del__, stats() collects them
+    gc.collect()
+    leftover = event_store.stats()["events"]
+    if leftover:
+        print(f"Warning: {leftover} events still referenced after clearing the caches", file=sys.stderr)
+
+
+def bench_schedule(schedule_module, rows, sample):
+    from render_cache import render_cache
+
+    urls = list(dict.fromkeys(url for _, url, _, _ in rows))[:sample]
+    clear_feed_caches()
+    cold = [timed(schedule_module.Schedule().get_daily_schedule, url)[0] for url in urls]
+    warm = [timed(schedule_module.Schedule().get_daily_schedule, url)[0] for url in urls]
+    return {
+        "get_daily_schedule_cold": summarize(cold),
+        "get_daily_schedule_cached": summarize(warm),
+        "render_cache": render_cache.stats(),
+    }
+
+
+async def bench_fanout(bot_module, async_db, stand_ins_url, batch_size, dispatchers):
+    """
+    Sends today's schedule to every seeded user through the same path the
+    dispatch scheduler takes: enqueue the due jobs, claim them in batches and
+    hand each batch to send_daily_schedule. Feeds are not prefetched, so this
+    is the cold case where every message waits for its download.
+    """
+    import aiohttp
+    from dispatch_scheduler import fire_time_on
+
+    clear_feed_caches()
+    async with aiohttp.ClientSession() as session:
+        await session.post(f"{stand_ins_url}/reset")
+
+    fire_date = date.today()
+    fire_at = fire_time_on(fire_date, 0)
+
+    async def drain(worker_id):
+        while True:
+            rows = await async_db.claim_jobs_DB(fire_date, worker_id, 300, batch_size)
+            if not rows:
+                return
+            await bot_module.send_daily_schedule([(telegram_id, url, None, fire_at) for telegram_id, url, _, _ in rows])
+
+    started = time.monotonic()
+    await async_db.enqueue_due_jobs_DB(0, 1, fire_date)
+    await asyncio.gather(*(drain(f"benchmark-{number}") for number in range(dispatchers)))
+    elapsed = time.monotonic() - started
+
+    async with aiohttp.ClientSession() as session:
+        async with session.get(f"{stand_ins_url}/stats") as response:
+            stats = await response.json()
+    latencies = [sent_at - started for sent_at in stats["sent_at"].values()]
+    delivered = len(latencies)
+    return {
+        "delivered": delivered,
+        "fanout_s": round(elapsed, 3),
+        "messages_per_s": round(delivered / elapsed, 2) if elapsed else None,
+        "latency_p50_s": round(percentile(latencies, 0.5), 3) if latencies else None,
+        "latency_p99_s": round(percentile(latencies, 0.99), 3) if latencies else None,
+        "feed_requests": stats["feed_requests"],
+        "rate_limited": stats["rate_limited"],
+        "pipeline_retries": bot_module.delivery_pipeline.retries,
+    }
+
+
+def compare(results, baseline_path):
+    # Prints how the headline numbers moved against an earlier run
+    with open(baseline_path) as file:
+        baseline = {run["users"]: run for run in json.load(file)["runs"]}
+    for run in results["runs"]:
+        previous = baseline.get(run["users"])
+        if previous is None:
+            continue
+        for section, key in (("fanout", "fanout_s"), ("fanout", "latency_p99_s"), ("fanout", "messages_per_s"),
+                             ("schedule", "get_daily_schedule_cold"), ("peak_rss_mb", "bot")):
+            old, new = previous[section][key], run[section][key]
+            if isinstance(old, dict):
+                old, new = old["p50_ms"], new["p50_ms"]
+            if old and new is not None:
+                print(f"{run['users']:>6} users  {section}.{key}: {old} -> {new} ({(new - old) / old:+.1%})")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--users-per-feed", type=int, default=1, help="users sharing one feed URL")
+    parser.add_argument("--feed-days", type=int, default=60)
+    parser.add_argument("--events-per-day", type=int, default=3)
+    parser.add_argument("--feed-latency", type=float, default=0.05, help="seconds before each feed response")
+    parser.add_argument("--telegram-rate", type=float, default=30, help="messages per second the fake API accepts")
+    parser.add_argument("--per-chat-interval", type=float, default=1)
+    parser.add_argument("--sample", type=int, default=200, help="calls per timed db/schedule function")
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dispatchers", type=int, default=1, help="concurrent claim loops, as with several workers")
+    parser.add_argument("--port", type=int, default=8780)
+    parser.add_argument("--database", default="jkuclassnotifier_bench")
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--baseline", help="earlier --output file to compare against")
+    return parser.parse_args()
+
+
+async def run(args, stand_ins_url):
+    # The bot modules read their configuration at import, after main() set it
+    from aiogram import Bot
+    from aiogram.client.session.aiohttp import AiohttpSession
+    from aiogram.client.telegram import TelegramAPIServer
+    import async_db
+    import bot as bot_module
+    import db_interaction
+    import schedule as schedule_module
+    from feed_fetcher import feed_fetcher
+    from parse_pool import parse_pool
+
+    bot = Bot(BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(stand_ins_url)))
+    await parse_pool.start()
+    bot_module.delivery_pipeline.start(bot)
+    runs = []
+    try:
+        for users in args.users:
+            feeds = max(users // args.users_per_feed, 1)
+            print(f"Seeding {users} users over {feeds} feeds...", flush=True)
+            rows = await async_db.run_in_db_executor(seed_users, db_interaction, users, feeds, stand_ins_url)
+            db_results = await async_db.run_in_db_executor(bench_db, db_interaction, rows, args.sample)
+            schedule_results = await async_db.run_in_db_executor(bench_schedule, schedule_module, rows, args.sample)
+            print(f"Fanning out to {users} users...", flush=True)
+            fanout = await bench_fanout(bot_module, async_db, stand_ins_url, args.batch_size, args.dispatchers)
+            runs.append({
+                "users": users,
+                "db": db_results,
+                "schedule": schedule_results,
+                "fanout": fanout,
+                "peak_rss_mb": peak_rss_mb(parse_pool.worker_pids),
+            })
+            print(json.dumps(runs[-1]["fanout"]), flush=True)
+    finally:
+        await bot_module.delivery_pipeline.stop()
+        await bot.session.close()
+        await feed_fetcher.close()
+        parse_pool.shutdown()
+        async_db.shutdown_db_executor()
+    return runs
+
+
+def main():
+    args = parse_args()
+    os.environ["DB_DATABASE"] = args.database
+    os.environ["BOT_TOKEN"] = BOT_TOKEN
+    os.environ["TELEGRAM_GLOBAL_RATE"] = str(args.telegram_rate)
+    os.environ["TELEGRAM_PER_CHAT_INTERVAL"] = str(args.per_chat_interval)
+    os.environ.setdefault("IS_TEST", "0")
+    # Cold runs must really download and parse
+    os.environ["FEED_STORE"] = "0"
+
+    ready = multiprocessing.get_context("spawn").Event()
+    stand_ins = multiprocessing.get_context("spawn").Process(target=serve_stand_ins, daemon=True, args=({
+        "port": args.port,
+        "feed_latency": args.feed_latency,
+        "feed_days": args.feed_days,
+        "events_per_day": args.events_per_day,
+        "telegram_rate": args.telegram_rate,
+        "per_chat_interval": args.per_chat_interval,
+    }, ready))
+    stand_ins.start()
+    if not ready.wait(30):
+        sys.exit("Stand-in servers didn't start")
+
+    try:
+        runs = asyncio.run(run(args, f"http://127.0.0.1:{args.port}"))
+    finally:
+        stand_ins.terminate()
+
+    results = {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "commit": git_commit(),
+        "config": vars(args),
+        "runs": runs,
+    }
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+    if args.baseline:
+        compare(results, args.baseline)
+
+
+if __name__ == "__main__":
+    main()
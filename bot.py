@@ -1,26 +1,60 @@
 from aiogram import Bot, Dispatcher, html
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
 from aiogram.filters import CommandStart, Command
 from aiogram.types import Message, BotCommand
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.storage.memory import MemoryStorage
-from dotenv import load_dotenv
-from datetime import datetime, timedelta, time
+from datetime import datetime
 import asyncio
-import os
+import signal
 import traceback
 import textwrap
-from schedule import *
-from db_interaction import *
+import config
+from schedule import Schedule, get_current_date, IncorrectCalendarURL
+from db_interaction import drop_tables_DB, create_tables_DB, add_mailing_date_DB
 from custom_logging import logger
-
-load_dotenv()
-BOT_TOKEN = os.getenv("BOT_TOKEN")
+from db_pool import db_pool
+import async_db
+from feed_fetcher import feed_fetcher, UpstreamUnavailable
+from parse_pool import parse_pool
+from feed_store import feed_store
+from metrics import start_metrics_server, dispatch_lag_seconds, update_seconds
+from fsm_storage import PostgresStorage
+from webhook_server import start_webhook_server, register_webhook
+from dispatch_scheduler import DispatchScheduler
+from change_watcher import change_watcher
+from telegram_sender import DeliveryPipeline, InteractiveSendBudget
+from lanes import BULK, set_lane
+
+BOT_TOKEN = config.get("BOT_TOKEN")
+# Extra workers only help with the daily dispatch, one process must poll
+DISPATCH_ONLY = config.get("DISPATCH_ONLY", 0, int)
+# "polling" or "webhook"
+BOT_MODE = config.get("BOT_MODE", "polling")
+# Updates handled at the same time, the rest wait for a free slot
+UPDATE_CONCURRENCY = config.get("UPDATE_CONCURRENCY", 64, int)
+# "postgres" when several webhook workers have to share the dialog state
+FSM_STORAGE = config.get("FSM_STORAGE", "memory")
+# Local Bot API server, or a stand-in when replaying recorded updates
+TELEGRAM_API_URL = config.get("TELEGRAM_API_URL")
 
 # Initialize dispatcher
-dp = Dispatcher()
+dp = Dispatcher(storage=PostgresStorage() if FSM_STORAGE == "postgres" else MemoryStorage())
+update_slots = asyncio.Semaphore(UPDATE_CONCURRENCY)
+
+
+# Both modes start a task per update, this keeps a burst of updates from
+# opening more database connections and feed downloads than we can serve
+@dp.update.outer_middleware()
+async def limit_update_concurrency(handler, event, data):
+    with update_seconds.time():
+        async with update_slots:
+            return await handler(event, data)
+
 
 class Form(StatesGroup):
     asking_calendar_url = State()
@@ -28,7 +62,16 @@ class Form(StatesGroup):
 
 # Task management
 global_task = None
-task_lock = asyncio.Lock()
+scheduler = DispatchScheduler()
+
+
+# Chats that blocked the bot or were deleted stop receiving the daily message
+async def deactivate_chat(telegram_id):
+    scheduler.remove_user(telegram_id)
+    await async_db.deactivate_user_DB(telegram_id)
+
+
+delivery_pipeline = DeliveryPipeline(on_dead_letter=deactivate_chat)
 
 # Bot commands setup
 async def set_bot_commands(bot: Bot):
@@ -41,21 +84,6 @@ async def set_bot_commands(bot: Bot):
     await bot.set_my_commands(commands)
     logger.info("Bot commands have been set successfully.")
 
-# Restart the daily schedule task
-async def restart_send_daily_schedule(bot):
-    global global_task
-    async with task_lock:
-        if global_task and not global_task.done():
-            logger.info("Cancelling existing send_daily_schedule task.")
-            global_task.cancel()
-            try:
-                await global_task
-            except asyncio.CancelledError:
-                logger.info("Existing task cancelled successfully.")
-
-        logger.info("Starting a new send_daily_schedule task.")
-        global_task = asyncio.create_task(send_daily_schedule(bot))
-
 # Handler for /start command
 @dp.message(CommandStart())
 async def ask_calendar_url(message: Message, state: FSMContext) -> None:
@@ -81,14 +109,11 @@ async def ask_cal(message: Message, state: FSMContext) -> None:
     url = message.text
     logger.info(f"Received calendar URL from user {message.from_user.id}: {url}")
     try:
-        schedule_msg = Schedule().get_daily_schedule(url)
-        registered_users = [user for user, _, _, _ in get_all_users_DB()]
-
-        if message.from_user.id in registered_users:
-            remove_user_DB(message.from_user.id)
-            logger.info(f"Registered user {message.from_user.id} successfully DELETED from database.")
-
-        add_user_DB(message.from_user.id, url)
+        schedule_msg = await Schedule().get_daily_schedule_async(url)
+        # Registers the user, or replaces the URL and resets the display time
+        # of a previous (possibly deactivated) registration
+        await async_db.upsert_user_DB(message.from_user.id, url)
+        scheduler.schedule_user(message.from_user.id, url, 0, 0)
         logger.info(f"User {message.from_user.id} successfully added to database.")
 
         confirmation_msg = textwrap.dedent((
@@ -103,37 +128,85 @@ async def ask_cal(message: Message, state: FSMContext) -> None:
         await state.clear()
         logger.info(f"Sent confirmation and sample schedule to user {message.from_user.id}.")
 
+    except UpstreamUnavailable as e:
+        logger.warning(f"KUSSS unavailable while registering user {message.from_user.id}: {e}")
+        await message.reply("⚠️ KUSSS can't be reached right now. Please send the URL again in a few minutes.")
+
+    except IncorrectCalendarURL:
+        logger.info(f"User {message.from_user.id} sent a URL that isn't a calendar: {url}")
+        await message.reply("⚠️ This URL doesn't lead to a KUSSS calendar. Please check it and try again.")
+
     except Exception as e:
         logger.error(f"Failed to process URL for user {message.from_user.id}: {e}")
         await message.reply("⚠️ An error occurred while processing your calendar URL. Please try again.")
 
-async def send_daily_schedule(bot):
-    logger.info("Daily schedule background task started.")
-    while True:
-        users = get_all_users_DB()
-        current_time = datetime.now()
-
-        for telegram_id, url, display_hour, display_minutes in users:
-            user_time = time(display_hour, display_minutes)
-
-            # Send immediately if the updated time is close to now
-            if current_time.time() < user_time <= (current_time + timedelta(minutes=1)).time():
-                try:
-                    schedule_msg = Schedule().get_daily_schedule(url)
-                    await bot.send_message(telegram_id, schedule_msg)
-                    logger.info(f"Sent schedule to user {telegram_id}.")
-                except Exception as e:
-                    logger.error(f"Failed to send message to {telegram_id}: {e}")
-
-        # Sleep for a short duration (e.g., 30 seconds) before checking again
-        await asyncio.sleep(35)
+# Called by the dispatch scheduler ahead of a user's display time
+async def prepare_daily_schedule(url, fire_date):
+    return await Schedule(fire_date).get_daily_schedule_async(url)
+
+
+# Called by the dispatch scheduler with the users whose display time has come
+async def send_daily_schedule(due_users):
+    # Render whatever the prefetch stage didn't manage to, fetching concurrently
+    missing = {}
+    for _, url, schedule_msg, fire_at in due_users:
+        if schedule_msg is None:
+            missing.setdefault(fire_at.date(), []).append(url)
+    schedules = {}
+    for fire_date, urls in missing.items():
+        schedules[fire_date] = await Schedule(fire_date).get_daily_schedules_async(urls)
+
+    messages = []
+    ledger = []
+    fire_times = {}
+    for telegram_id, url, schedule_msg, fire_at in due_users:
+        if schedule_msg is None:
+            schedule_msg = schedules[fire_at.date()][url]
+        if isinstance(schedule_msg, Exception):
+            logger.error(f"Failed to send message to {telegram_id}: {schedule_msg}")
+            ledger.append((telegram_id, fire_at.date(), "failed", 0, None))
+            continue
+        messages.append((telegram_id, schedule_msg))
+        fire_times[telegram_id] = fire_at
+
+    # Rate limiting, retries and dead chats are handled by the pipeline
+    deliveries = await delivery_pipeline.deliver(messages)
+    sent = 0
+    for delivery in deliveries:
+        fire_at = fire_times[delivery.chat_id]
+        if delivery.error is None:
+            sent += 1
+            latency_ms = int((delivery.sent_at - fire_at.timestamp()) * 1000)
+            dispatch_lag_seconds.observe(latency_ms / 1000)
+            ledger.append((delivery.chat_id, fire_at.date(), "sent", delivery.attempts, latency_ms))
+        else:
+            status = "dead" if delivery.chat_id in delivery_pipeline.dead_letters else "failed"
+            ledger.append((delivery.chat_id, fire_at.date(), status, delivery.attempts, None))
+    await async_db.record_deliveries_DB(ledger)
+    logger.info(f"Sent schedule to {sent} of {len(due_users)} users.")
+
+
+# Called by the change watcher with a short delta message for every subscriber of a changed feed
+async def send_change_notifications(messages):
+    deliveries = await delivery_pipeline.deliver(messages)
+    sent = sum(1 for delivery in deliveries if delivery.error is None)
+    logger.info(f"Sent change notification to {sent} of {len(messages)} users.")
 
 
 @dp.message(Command("get_today_schedule"))
 async def get_today_schedule(message: Message) -> None:
     logger.info(f"User {message.from_user.id} triggered /get_today_schedule command.")
-    userUrl = [row[1] for row in get_all_users_DB() if row[0]==message.from_user.id][0]
-    today_schedule_msg = Schedule().get_daily_schedule(userUrl, tomorrow=False)
+    user = await async_db.get_user_DB(message.from_user.id)
+    if user is None:
+        await message.reply("⚠️ You are not registered yet. Use /start to set up your calendar.")
+        return
+    userUrl = user[1]
+    try:
+        today_schedule_msg = await Schedule().get_daily_schedule_async(userUrl, tomorrow=False)
+    except UpstreamUnavailable as e:
+        logger.warning(f"KUSSS unavailable for /get_today_schedule of {message.from_user.id}: {e}")
+        await message.reply("⚠️ KUSSS can't be reached right now. Please try again in a few minutes.")
+        return
     logger.info(f"Sending daily schedule to {message.from_user.id}")
     await message.reply(today_schedule_msg)
 
@@ -156,29 +229,114 @@ async def update_display_time_handler(message: Message, state: FSMContext) -> No
         display_hour = display_time.hour
         display_minutes = display_time.minute
 
-        update_display_time(message.from_user.id, display_hour, display_minutes)
+        user = await async_db.update_display_time(message.from_user.id, display_hour, display_minutes)
         logger.info(f"Display time for user {message.from_user.id} updated to {display_hour:02d}:{display_minutes:02d}.")
 
         await message.reply(f"✅ Your message display time has been updated to <b>{display_hour:02d}:{display_minutes:02d}</b>.")
         await state.clear()
 
-        # Restart the background task with updated schedules
-        await restart_send_daily_schedule(message.bot)
+        # Make sure the new time bucket is scheduled, the running task keeps going
+        if user is not None:
+            scheduler.schedule_user(*user)
 
     except ValueError:
         logger.warning(f"Invalid time format received from user {message.from_user.id}: {time_input}")
         await message.reply("⚠️ Invalid time format. Please enter the time in <b>HH:MM</b> format (e.g., 08:30).")
 
 
+# Everything that talks to Postgres or Telegram before the first poll runs in
+# the background, so a restart answers updates as soon as aiogram is loaded
+# and a database that is briefly down only delays the daily messages
+async def start_dispatch():
+    # Daily messages and change notifications yield to users' commands
+    set_lane(BULK)
+    delay = 1
+    while True:
+        try:
+            if await async_db.migrate_tables_DB():
+                break
+        except Exception as e:
+            logger.warning(f"Database unreachable: {e}")
+        logger.warning(f"Database not ready, retrying in {delay}s.")
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, 60)
+    scheduler.load_minutes(await async_db.get_display_minutes_DB())
+    await asyncio.gather(
+        scheduler.run(send_daily_schedule, prepare_daily_schedule),
+        change_watcher.run(send_change_notifications),
+    )
+
+
+async def warm_up(bot):
+    try:
+        await set_bot_commands(bot)
+    except Exception as e:
+        logger.warning(f"Failed to set bot commands: {e}")
+    # Dispatch-only workers leave the way updates arrive to the others
+    if not DISPATCH_ONLY:
+        try:
+            if BOT_MODE == "webhook":
+                await register_webhook(bot, dp)
+            else:
+                # getUpdates is refused while a webhook is set, polling retries until it's gone
+                await bot.delete_webhook()
+        except Exception as e:
+            logger.warning(f"Failed to update the webhook: {e}")
+    await parse_pool.start()
+    await asyncio.to_thread(feed_store.prune)
+
+
+async def wait_for_stop_signal():
+    # start_polling handles the signals itself, the webhook server doesn't
+    stopped = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(signum, stopped.set)
+    await stopped.wait()
+
+
 async def main() -> None:
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
-    await set_bot_commands(bot)
+    if BOT_MODE not in ("polling", "webhook"):
+        raise ValueError(f"Unknown BOT_MODE: {BOT_MODE}")
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    # Replies of the handlers share the Telegram rate budget with the pipeline
+    bot.session.middleware(InteractiveSendBudget(delivery_pipeline.bucket))
 
     global global_task
-    global_task = asyncio.create_task(send_daily_schedule(bot))
+    metrics_runner = await start_metrics_server()
+    webhook_runner = None
+    delivery_pipeline.start(bot)
+    warm_up_task = asyncio.create_task(warm_up(bot))
+    global_task = asyncio.create_task(start_dispatch())
 
-    logger.info("Bot polling started.")
-    await dp.start_polling(bot)
+    try:
+        if DISPATCH_ONLY:
+            logger.info(f"Dispatch worker {scheduler.worker_id} started.")
+            await global_task
+        elif BOT_MODE == "webhook":
+            webhook_runner = await start_webhook_server(bot, dp)
+            logger.info("Bot webhook started.")
+            await wait_for_stop_signal()
+        else:
+            logger.info("Bot polling started.")
+            await dp.start_polling(bot)
+    finally:
+        warm_up_task.cancel()
+        global_task.cancel()
+        await delivery_pipeline.stop()
+        # Also closes the bot session
+        if webhook_runner is not None:
+            await webhook_runner.cleanup()
+        await feed_fetcher.close()
+        parse_pool.shutdown()
+        feed_store.close()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        async_db.shutdown_db_executor()
+        db_pool.close()
 
 @dp.message(Command("help"))
 async def show_help(message: Message) -> None:
@@ -210,7 +368,7 @@ async def show_help(message: Message) -> None:
 
 
 if __name__ == "__main__":
-    is_test = int(os.getenv("IS_TEST"))
+    is_test = config.get("IS_TEST", 0, int)
     if is_test:
         drop_tables_DB()
         create_tables_DB()
@@ -0,0 +1,156 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+import config
+from event_store import event_store
+from metrics import Callback
+
+CALENDAR_CACHE_TTL = config.get("CALENDAR_CACHE_TTL", 900, float)
+CALENDAR_CACHE_MAX_BYTES = config.get("CALENDAR_CACHE_MAX_BYTES", 64 * 1024 * 1024, int)
+
+
+class CacheEntry():
+    __slots__ = ("url", "parsed", "etag", "last_modified", "fetched_at", "checked_at", "size", "digest",
+                 "restored")
+
+    def __init__(self, url, body, parsed, etag=None, last_modified=None):
+        self.url = url
+        self.parsed = parsed
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched_at = time.monotonic()
+        # Wall clock of the last time KUSSS confirmed this content, shown on stale schedules
+        self.checked_at = time.time()
+        # The body itself isn't kept, only what was parsed from it
+        self.size = parsed.nbytes
+        # Identifies the content, unchanged feeds keep their rendered messages
+        self.digest = hashlib.sha1(body if isinstance(body, bytes) else body.encode("utf-8")).hexdigest()
+        self.restored = False
+
+
+    @classmethod
+    def from_store(cls, url, parsed, etag, last_modified, digest, checked_at):
+        # Entry read back from the feed store, its events are shared like those of a fresh parse
+        entry = cls.__new__(cls)
+        entry.url = url
+        entry.parsed = event_store.intern_index(parsed)
+        entry.etag = etag
+        entry.last_modified = last_modified
+        # Ages as if it had stayed in memory since KUSSS last confirmed it
+        entry.fetched_at = time.monotonic() - max(time.time() - checked_at, 0)
+        entry.checked_at = checked_at
+        entry.size = entry.parsed.nbytes
+        entry.digest = digest
+        # Until KUSSS confirms it again
+        entry.restored = True
+        return entry
+
+
+# LRU cache of downloaded feeds keyed by URL. Keeps the parsed calendar, the
+# digest of the raw body and the validators needed for conditional requests.
+# The events of parsed calendars live in the event store, shared with other
+# users' feeds, an entry's size counts its event ids and the records it added.
+class CalendarCache():
+    def __init__(self, ttl=CALENDAR_CACHE_TTL, max_bytes=CALENDAR_CACHE_MAX_BYTES):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+
+    def is_fresh(self, entry):
+        return time.monotonic() - entry.fetched_at < self.ttl
+
+
+    def conditional_headers(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+
+    def record_hit(self):
+        self.hits += 1
+
+
+    def record_revalidation(self, entry):
+        # Server answered 304 Not Modified, the cached copy is good for another TTL
+        self.revalidations += 1
+        entry.fetched_at = time.monotonic()
+        entry.checked_at = time.time()
+        entry.restored = False
+
+
+    def put(self, url, body, parsed, etag=None, last_modified=None):
+        entry = CacheEntry(url, body, event_store.intern_index(parsed), etag, last_modified)
+        with self._lock:
+            self.misses += 1
+        return self.add(entry)
+
+
+    def add(self, entry):
+        url = entry.url
+        with self._lock:
+            previous = self._entries.pop(url, None)
+            if previous is not None:
+                self.total_bytes -= previous.size
+            self._entries[url] = entry
+            self.total_bytes += entry.size
+
+            # Evict least recently used feeds until we fit into the memory cap
+            while self.total_bytes > self.max_bytes and len(self._entries) > 1:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.size
+                self.evictions += 1
+        return entry
+
+
+    def invalidate(self, url):
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+
+    def stats(self):
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "hits": self.hits,
+            "revalidations": self.revalidations,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+calendar_cache = CalendarCache()
+
+Callback("bot_calendar_cache_hits_total", "Feeds served from the calendar cache", "counter", lambda: calendar_cache.hits)
+Callback("bot_calendar_cache_revalidations_total", "Cached feeds confirmed with a 304", "counter",
+         lambda: calendar_cache.revalidations)
+Callback("bot_calendar_cache_misses_total", "Feeds downloaded and parsed", "counter", lambda: calendar_cache.misses)
+Callback("bot_calendar_cache_bytes", "Bytes held by the calendar cache", "gauge", lambda: calendar_cache.total_bytes)
@@ -0,0 +1,201 @@
+import asyncio
+import hashlib
+import html
+import json
+from datetime import datetime, timedelta, timezone
+import config
+from schedule import get_current_date, cet_timezone
+from feed_fetcher import feed_fetcher
+from calendar_cache import calendar_cache
+from feed_store import feed_store
+from parse_pool import parse_pool
+import async_db
+from custom_logging import logger
+from metrics import change_polls, change_notifications
+
+# Seconds between two polls of the same feed, 0 turns change detection off
+CHANGE_POLL_INTERVAL = config.get("CHANGE_POLL_INTERVAL", 1800, float)
+# Changes are reported for events up to this many days ahead
+CHANGE_WINDOW_DAYS = config.get("CHANGE_WINDOW_DAYS", 14, int)
+CHANGE_POLL_BATCH = config.get("CHANGE_POLL_BATCH", 50, int)
+# Longer lists are cut, the daily message has the full picture
+CHANGE_MAX_LINES = 10
+
+
+def event_key(record):
+    # KUSSS exports a UID for every event, anything else is matched by start and title
+    return record.uid or f"{record.start.isoformat()}|{record.title}"
+
+
+def fingerprint(record):
+    content = f"{record.start.isoformat()}|{record.end.isoformat()}|{record.title}|{record.instructor}|{record.location}"
+    return hashlib.sha1(content.encode("utf-8")).hexdigest()[:16]
+
+
+def snapshot_events(records):
+    # Just enough of every event to tell what changed and to describe it
+    return {
+        event_key(record): [fingerprint(record), int(record.start.timestamp()), int(record.end.timestamp()),
+                            record.title, record.location]
+        for record in records
+    }
+
+
+def diff_snapshots(old_events, new_events, old_window_end, now):
+    """
+    Returns (kind, old, new) for every event that was added, changed or
+    removed between two snapshots, leaving out events that are already over.
+    An event only counts as added when the old snapshot covered its day,
+    otherwise it just moved into the window.
+    """
+    now = int(now.timestamp())
+    changes = []
+    for key, new in new_events.items():
+        old = old_events.get(key)
+        if new[2] <= now:
+            continue
+        if old is None:
+            if local_time(new[1]).date() <= old_window_end:
+                changes.append(("added", None, new))
+        elif old[0] != new[0]:
+            changes.append(("changed", old, new))
+    for key, old in old_events.items():
+        if key not in new_events and old[2] > now:
+            changes.append(("removed", old, None))
+    changes.sort(key=lambda change: (change[2] or change[1])[1])
+    return changes
+
+
+def local_time(timestamp):
+    return datetime.fromtimestamp(timestamp, cet_timezone)
+
+
+def describe(kind, old, new):
+    event = new or old
+    title = html.escape(event[3])
+    when = f"{local_time(event[1]):%a %d.%m %H:%M}–{local_time(event[2]):%H:%M}"
+    if kind == "added":
+        return f"🆕 New: {title}, {when}, {html.escape(new[4])}"
+    if kind == "removed":
+        return f"🚫 Cancelled: {title}, {when}"
+    if old[1:3] != new[1:3]:
+        line = f"🕒 Moved: {title}, {local_time(old[1]):%a %d.%m %H:%M} → {when}"
+        if old[4] != new[4]:
+            line += f", {html.escape(new[4])}"
+        return line
+    if old[4] != new[4]:
+        return f"🏫 Room changed: {title}, {when}: {html.escape(old[4])} → {html.escape(new[4])}"
+    return f"✏️ Updated: {title}, {when}"
+
+
+def format_changes(changes):
+    lines = [describe(*change) for change in changes[:CHANGE_MAX_LINES]]
+    if len(changes) > CHANGE_MAX_LINES:
+        lines.append(f"…and {len(changes) - CHANGE_MAX_LINES} more changes.")
+    return "🔔 Your schedule changed:\n\n" + "\n".join(lines)
+
+
+# Re-polls every subscribed feed every POLL_INTERVAL seconds and tells its
+# subscribers about room changes, cancellations and new or moved events.
+#
+# Polls are conditional requests with the validators stored in the feed's
+# snapshot, so an unchanged feed costs a 304 and nothing else, and a 200 with
+# the same digest is dropped before parsing. Only a feed that really changed
+# is parsed and its events in the window are compared with the snapshot by
+# their 16 byte fingerprints, only the changed ones are formatted.
+#
+# Feeds are claimed from FEED_SNAPSHOT by pushing their next poll time
+# forward, so several bot processes can run the watcher against one database
+# and every feed is still polled, and announced, by one of them.
+class ChangeWatcher():
+    def __init__(self, poll_interval=CHANGE_POLL_INTERVAL, window_days=CHANGE_WINDOW_DAYS,
+                 batch_size=CHANGE_POLL_BATCH):
+        self.poll_interval = poll_interval
+        self.window = timedelta(days=window_days)
+        self.batch_size = batch_size
+
+
+    async def run(self, notify):
+        """
+        notify is awaited with [(telegram_id, message), ...] for every feed
+        that changed. Runs until cancelled.
+        """
+        if self.poll_interval <= 0:
+            logger.info("Change detection is disabled.")
+            return
+        logger.info(f"Change detection polls feeds every {self.poll_interval:.0f}s.")
+        while True:
+            try:
+                await self.poll_due_feeds(notify)
+            except Exception as e:
+                logger.error(f"Change detection round failed: {e}")
+            # Due times are spread out, look for due feeds a few times per interval
+            await asyncio.sleep(min(self.poll_interval / 4, 60))
+
+
+    async def poll_due_feeds(self, notify):
+        added, removed = await async_db.sync_feed_snapshots_DB()
+        if added or removed:
+            logger.info(f"Watching {added} new feeds, stopped watching {removed}.")
+        while True:
+            feeds = await async_db.claim_due_feeds_DB(self.poll_interval, self.batch_size)
+            if not feeds:
+                return
+            # feed_fetcher bounds how many of them download at once
+            await asyncio.gather(*(self.poll_feed(*feed, notify=notify) for feed in feeds))
+
+
+    async def poll_feed(self, url, etag, last_modified, digest, window_end, events, telegram_ids, notify):
+        headers = {}
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+        try:
+            response = await feed_fetcher.fetch(url, headers)
+        except Exception as e:
+            change_polls.inc(result="error")
+            logger.warning(f"Failed to poll {url} for changes: {e!r}")
+            return
+        if response.status == 304:
+            change_polls.inc(result="not_modified")
+            return
+        new_digest = hashlib.sha1(response.body).hexdigest()
+        if new_digest == digest:
+            change_polls.inc(result="same_digest")
+            return
+
+        # Reuse the cached parse when the dispatcher already saw this version,
+        # otherwise refresh the cache so the next daily message has it too
+        cached = calendar_cache.get(url)
+        if cached is None or cached.digest != new_digest:
+            try:
+                cached = calendar_cache.put(url, response.body, await parse_pool.parse(response.body),
+                                            response.etag, response.last_modified)
+            except Exception as e:
+                change_polls.inc(result="error")
+                logger.warning(f"Failed to parse {url} while polling for changes: {e!r}")
+                return
+            feed_store.save(cached)
+        first_day = get_current_date()
+        new_window_end = first_day + self.window
+        new_events = snapshot_events(cached.parsed.events_between(first_day, new_window_end))
+        await async_db.save_feed_snapshot_DB(url, response.etag, response.last_modified, new_digest,
+                                             new_window_end, json.dumps(new_events))
+
+        # The first poll of a feed only records the baseline
+        if events is None:
+            change_polls.inc(result="baseline")
+            return
+        changes = diff_snapshots(events, new_events, window_end, datetime.now(timezone.utc))
+        if not changes:
+            change_polls.inc(result="unchanged")
+            return
+        change_polls.inc(result="changed")
+        logger.info(f"{len(changes)} changes in {url}, notifying {len(telegram_ids)} users.")
+        message = format_changes(changes)
+        change_notifications.inc(len(telegram_ids))
+        await notify([(telegram_id, message) for telegram_id in telegram_ids])
+
+
+change_watcher = ChangeWatcher()
@@ -0,0 +1,89 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+# aiogram alone takes a few seconds to import on a small container
+IMPORT_BUDGET = 8.0
+STARTUP_BUDGET = 0.5
+
+# Runs in a fresh interpreter, so nothing imported here skews the timings
+PROBE = r"""
+import asyncio
+import json
+import sys
+import time
+
+started = time.perf_counter()
+import bot
+imported = time.perf_counter() - started
+
+import custom_logging
+from db_pool import db_pool
+
+result = {
+    "import_seconds": imported,
+    "heavy_modules": sorted(name for name in ("ics", "arrow", "requests") if name in sys.modules),
+    "db_pool_created": db_pool._pool is not None,
+    "log_connection_opened": custom_logging.db_handler.connection is not None,
+}
+
+
+async def first_poll(bot_instance, *args, **kwargs):
+    result["first_poll_seconds"] = time.perf_counter() - main_started
+
+
+bot.dp.start_polling = first_poll
+main_started = time.perf_counter()
+asyncio.run(bot.main())
+print("STARTUP " + json.dumps(result))
+"""
+
+
+def probe():
+    env = dict(os.environ)
+    # Nothing listens there, startup must not wait for the database or Telegram
+    env.update({
+        "BOT_TOKEN": "123456:startup-check",
+        "DB_HOST": "127.0.0.1",
+        "DB_PORT": "1",
+        "METRICS_PORT": "0",
+        "PARSE_POOL_SIZE": "0",
+        "DISPATCH_ONLY": "0",
+        "IS_TEST": "0",
+    })
+    output = subprocess.run([sys.executable, "-c", PROBE], env=env, capture_output=True, text=True, check=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    # The log handler prints to stdout as well when PostgreSQL is unreachable
+    line = next(line for line in output.splitlines() if line.startswith("STARTUP "))
+    return json.loads(line[len("STARTUP "):])
+
+
+def check(result, import_budget=IMPORT_BUDGET, startup_budget=STARTUP_BUDGET):
+    failures = []
+    if result["import_seconds"] > import_budget:
+        failures.append(f"import took {result['import_seconds']:.2f}s, budget {import_budget}s")
+    if result["first_poll_seconds"] > startup_budget:
+        failures.append(f"main() reached polling after {result['first_poll_seconds']:.2f}s, budget {startup_budget}s")
+    if result["heavy_modules"]:
+        failures.append(f"imported eagerly: {', '.join(result['heavy_modules'])}")
+    if result["db_pool_created"]:
+        failures.append("database pool created before it was needed")
+    if result["log_connection_opened"]:
+        failures.append("log handler connected to PostgreSQL during startup")
+    return failures
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check that the bot imports and starts polling within budget")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET)
+    parser.add_argument("--startup-budget", type=float, default=STARTUP_BUDGET)
+    args = parser.parse_args()
+
+    result = probe()
+    print(json.dumps(result, indent=2))
+    failures = check(result, args.import_budget, args.startup_budget)
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,20 @@
+import os
+from dotenv import load_dotenv
+
+_loaded = False
+
+
+def load():
+    # .env is read once per process, variables already set in the environment win
+    global _loaded
+    if not _loaded:
+        load_dotenv()
+        _loaded = True
+
+
+def get(name, default=None, cast=str):
+    load()
+    value = os.getenv(name)
+    if value is None or value == "":
+        return default
+    return cast(value)
@@ -1,41 +1,144 @@
 import logging
 import psycopg2
-import os
-from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+import queue
+import sys
+import threading
+import time
+import config
 
-load_dotenv()
+LOG_QUEUE_SIZE = config.get("LOG_QUEUE_SIZE", 10000, int)
+LOG_BATCH_SIZE = config.get("LOG_BATCH_SIZE", 200, int)
+LOG_FLUSH_INTERVAL = config.get("LOG_FLUSH_INTERVAL", 1, float)
+# What emit does when the queue is full: "drop", "block" or "stderr"
+LOG_QUEUE_OVERFLOW = config.get("LOG_QUEUE_OVERFLOW", "drop")
+# Attempts to write a batch again while Postgres is unreachable, before it goes to stderr
+LOG_WRITE_RETRIES = config.get("LOG_WRITE_RETRIES", 3, int)
+
+_STOP = object()
 
 
 # Custom PostgreSQL Logging Handler
+# emit() only puts the record on a bounded queue, a background thread formats
+# the records and writes them to bot_logs in multi-row INSERT batches.
 class PostgresHandler(logging.Handler):
-    def __init__(self):
+    def __init__(self, queue_size=LOG_QUEUE_SIZE, batch_size=LOG_BATCH_SIZE,
+                 flush_interval=LOG_FLUSH_INTERVAL, overflow=LOG_QUEUE_OVERFLOW,
+                 write_retries=LOG_WRITE_RETRIES):
         super().__init__()
-        # Establish the connection
+        if overflow not in ("drop", "block", "stderr"):
+            raise ValueError(f"Unknown log queue overflow policy: {overflow}")
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.overflow = overflow
+        self.write_retries = write_retries
+        self.dropped = 0
+        # Set while someone waits for the queue to drain, cuts retry back-off short
+        self._hurry = threading.Event()
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        # The connection is opened lazily by the writer thread
+        self.connection = None
+        self._writer = threading.Thread(target=self._run, name="bot-log-writer", daemon=True)
+        self._writer.start()
+
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            if self.overflow == "block":
+                self.queue.put(record)
+            elif self.overflow == "stderr":
+                sys.stderr.write(self.format(record) + "\n")
+            else:
+                self.dropped += 1
+
+
+    def _connect(self):
         self.connection = psycopg2.connect(
-            user=os.getenv("DB_USER"),
-            password=os.getenv("DB_PASSWORD"),
-            host=os.getenv("DB_HOST"),
-            port=os.getenv("DB_PORT"),
-            database=os.getenv("DB_DATABASE")
+            user=config.get("DB_USER"),
+            password=config.get("DB_PASSWORD"),
+            host=config.get("DB_HOST"),
+            port=config.get("DB_PORT"),
+            database=config.get("DB_DATABASE")
         )
         self.connection.autocommit = True
 
 
-    def emit(self, record):
-        log_message = self.format(record)
-        try:
-            cursor = self.connection.cursor()
-            cursor.execute(
-                "INSERT INTO bot_logs (level, message) VALUES (%s, %s)",
-                (record.levelname, log_message),
-            )
-            cursor.close()
-        except Exception as e:
-            print(f"Failed to log message to PostgreSQL: {e}")
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            try:
+                item = self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+
+            # Collect up to batch_size records or whatever arrives within flush_interval
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if item is _STOP:
+                    stopping = True
+                else:
+                    batch.append(item)
+                if stopping or len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._write(batch)
+            for _ in range(len(batch) + stopping):
+                self.queue.task_done()
+
+
+    def _write(self, batch):
+        rows = []
+        for record in batch:
+            try:
+                rows.append((record.levelname, self.format(record)))
+            except Exception:
+                self.handleError(record)
+        for attempt in range(self.write_retries + 1):
+            try:
+                if self.connection is None or self.connection.closed:
+                    self._connect()
+                with self.connection.cursor() as cursor:
+                    execute_values(cursor, "INSERT INTO bot_logs (level, message) VALUES %s", rows)
+                return
+            except Exception as e:
+                error = e
+                if self.connection is not None:
+                    self.connection.close()
+                # Back off while the database is restarting, but don't hold up a flush or shutdown
+                if attempt < self.write_retries and not self._hurry.wait(min(2 ** attempt, 30)):
+                    continue
+                break
+
+        print(f"Failed to log {len(rows)} messages to PostgreSQL: {error}")
+        for _, message in rows:
+            sys.stderr.write(message + "\n")
+
+
+    def flush(self):
+        # Blocks until every record queued so far has been written
+        if self._writer.is_alive():
+            self._hurry.set()
+            self.queue.join()
+            self._hurry.clear()
 
 
     def close(self):
         logger.info("Bot stopped")
+        self._hurry.set()
+        if self._writer.is_alive():
+            self.queue.put(_STOP)
+            self._writer.join()
+        if self.dropped:
+            print(f"{self.dropped} log messages were dropped because the log queue was full")
         if self.connection:
             self.connection.close()
         super().close()
@@ -49,4 +152,4 @@ db_handler.setFormatter(formatter)
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
-logger.addHandler(db_handler)
\ No newline at end of file
+logger.addHandler(db_handler)
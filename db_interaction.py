@@ -1,17 +1,67 @@
-import psycopg2 as pg2
 from psycopg2 import errors
-import os
+from psycopg2.extras import execute_values
+import threading
+import time
+from collections import OrderedDict
+import config
 from custom_logging import logger
-from dotenv import load_dotenv
+from db_pool import get_connection, release_connection
+from metrics import Callback
+
+USER_CACHE_TTL = config.get("USER_CACHE_TTL", 300, float)
+USER_CACHE_MAX_SIZE = config.get("USER_CACHE_MAX_SIZE", 10000, int)
+
+
+# In-process write-through cache of active USERS rows keyed by TELEGRAM_ID.
+# Every mutation below updates or drops the cached row after it commits, the
+# TTL bounds staleness when another process changes the table.
+class UserCache():
+    def __init__(self, ttl=USER_CACHE_TTL, max_size=USER_CACHE_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._rows = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, telegram_id):
+        with self._lock:
+            cached = self._rows.get(telegram_id)
+            if cached is None or time.monotonic() - cached[1] > self.ttl:
+                self.misses += 1
+                return None
+            self._rows.move_to_end(telegram_id)
+            self.hits += 1
+            return cached[0]
+
+
+    def put(self, row):
+        with self._lock:
+            self._rows[row[0]] = (row, time.monotonic())
+            self._rows.move_to_end(row[0])
+            while len(self._rows) > self.max_size:
+                self._rows.popitem(last=False)
+
+
+    def invalidate(self, telegram_id):
+        with self._lock:
+            self._rows.pop(telegram_id, None)
+
+
+    def clear(self):
+        with self._lock:
+            self._rows.clear()
+
+
+user_cache = UserCache()
+
+Callback("bot_user_cache_hits_total", "User lookups answered from the cache", "counter", lambda: user_cache.hits)
+Callback("bot_user_cache_misses_total", "User lookups that went to Postgres", "counter", lambda: user_cache.misses)
+
 
 def create_tables_DB():
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
+    connection = get_connection()
 
     try:
         cursor = connection.cursor()
@@ -32,10 +82,12 @@ def create_tables_DB():
         logger.info("Creating table USERS...")
         cursor.execute("""
             CREATE TABLE USERS (
-                TELEGRAM_ID BIGINT UNIQUE,
+                TELEGRAM_ID BIGINT PRIMARY KEY,
                 URL VARCHAR(255),
                 display_hour SMALLINT CHECK (display_hour >= 0 AND display_hour < 24),
-                display_minutes SMALLINT CHECK (display_minutes >= 0 AND display_minutes < 60)
+                display_minutes SMALLINT CHECK (display_minutes >= 0 AND display_minutes < 60),
+                ACTIVE BOOLEAN NOT NULL DEFAULT TRUE,
+                display_minute_of_day SMALLINT GENERATED ALWAYS AS (display_hour * 60 + display_minutes) STORED
             );
         """)
         logger.info("Table USERS created successfully.")
@@ -58,17 +110,128 @@ def create_tables_DB():
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after table creation.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after table creation.")
+
+def migrate_tables_DB():
+    """
+    Brings tables created by older versions of the bot up to date.
+    Every statement is idempotent, so it runs on each startup.
+    """
+    logger.info("Migrating database tables...")
+    connection = get_connection()
+
+    try:
+        cursor = connection.cursor()
+
+        # Chats that blocked the bot are deactivated instead of retried daily
+        cursor.execute("""
+            ALTER TABLE USERS ADD COLUMN IF NOT EXISTS ACTIVE BOOLEAN NOT NULL DEFAULT TRUE;
+        """)
+
+        # Older tables only had a nullable UNIQUE TELEGRAM_ID, promote it to the primary key
+        cursor.execute("""
+            DO $$
+            BEGIN
+                IF NOT EXISTS (
+                    SELECT 1 FROM pg_constraint
+                    WHERE conrelid = 'users'::regclass AND contype = 'p'
+                ) THEN
+                    ALTER TABLE USERS ALTER COLUMN TELEGRAM_ID SET NOT NULL;
+                    ALTER TABLE USERS ADD PRIMARY KEY (TELEGRAM_ID);
+                END IF;
+            END $$;
+        """)
+
+        # Minute of the day the user wants the message, indexed for the dispatcher
+        cursor.execute("""
+            ALTER TABLE USERS ADD COLUMN IF NOT EXISTS display_minute_of_day SMALLINT
+            GENERATED ALWAYS AS (display_hour * 60 + display_minutes) STORED;
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS users_due_idx
+            ON USERS (display_minute_of_day) INCLUDE (TELEGRAM_ID, URL)
+            WHERE ACTIVE;
+        """)
+
+        # One row per user and target date, tells which daily messages went out
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS DELIVERY_LEDGER (
+                TELEGRAM_ID BIGINT NOT NULL,
+                TARGET_DATE DATE NOT NULL,
+                STATUS TEXT NOT NULL,
+                ATTEMPTS SMALLINT NOT NULL DEFAULT 0,
+                LATENCY_MS INTEGER,
+                UPDATED_AT TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (TELEGRAM_ID, TARGET_DATE)
+            );
+        """)
+
+        # Ledger rows double as dispatch jobs that workers claim under a lease
+        cursor.execute("""
+            ALTER TABLE DELIVERY_LEDGER
+            ADD COLUMN IF NOT EXISTS LEASE_OWNER TEXT,
+            ADD COLUMN IF NOT EXISTS LEASE_EXPIRES TIMESTAMPTZ;
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS delivery_ledger_open_idx
+            ON DELIVERY_LEDGER (TARGET_DATE)
+            WHERE STATUS IN ('pending', 'claimed');
+        """)
+        # Jobs created ahead of a bucket, for the worker that prefetches them
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS delivery_ledger_reserved_idx
+            ON DELIVERY_LEDGER (TARGET_DATE)
+            WHERE STATUS = 'reserved';
+        """)
+
+        # Conversation state of the aiogram FSM, shared by webhook workers
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS FSM_STATE (
+                STORAGE_KEY TEXT PRIMARY KEY,
+                STATE TEXT,
+                DATA JSONB NOT NULL DEFAULT '{}',
+                UPDATED_AT TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+        """)
+
+        # Last seen version of every subscribed feed, for change detection.
+        # EVENTS maps UID -> [fingerprint, start, end, title, location] for
+        # the events up to WINDOW_END
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS FEED_SNAPSHOT (
+                URL VARCHAR(255) PRIMARY KEY,
+                ETAG TEXT,
+                LAST_MODIFIED TEXT,
+                DIGEST TEXT,
+                WINDOW_END DATE,
+                EVENTS JSONB,
+                NEXT_POLL_AT TIMESTAMPTZ NOT NULL DEFAULT now(),
+                UPDATED_AT TIMESTAMPTZ
+            );
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS feed_snapshot_due_idx ON FEED_SNAPSHOT (NEXT_POLL_AT);
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS users_url_idx ON USERS (URL) WHERE ACTIVE;
+        """)
+        connection.commit()
+        logger.info("Database tables migrated successfully.")
+        return True
+
+    except Exception as error:
+        logger.error(f"An error occurred while migrating tables: {error}")
+        if connection:
+            connection.rollback()
+        return False
+
+    finally:
+        cursor.close()
+        release_connection(connection)
 
 def drop_tables_DB():
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
+    connection = get_connection()
 
     try:
         cursor = connection.cursor()
@@ -89,21 +252,15 @@ def drop_tables_DB():
 
     finally:
         cursor.close()
-        connection.close()
+        release_connection(connection)
 
 def drop_table_by_name(table_name):
     """
     Drops a specific table from the database using its name.
     """
     logger.info(f"Attempting to drop table: {table_name}")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for dropping a table.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for dropping a table.")
 
     try:
         cursor = connection.cursor()
@@ -120,20 +277,14 @@ def drop_table_by_name(table_name):
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after attempting to drop the table.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after attempting to drop the table.")
 
         
 def add_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
     logger.info(f"Adding user {telegram_id} to USERS table with default display time: {display_hour:02d}:{display_minutes:02d}...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for adding user.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for adding user.")
 
     try:
         cursor = connection.cursor()
@@ -142,6 +293,7 @@ def add_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
             VALUES (%s, %s, %s, %s);
         """, (telegram_id, url, display_hour, display_minutes))
         connection.commit()  # Commit changes immediately
+        user_cache.put((telegram_id, url, display_hour, display_minutes))
         logger.info(f"User {telegram_id} added successfully with display time: {display_hour:02d}:{display_minutes:02d}.")
 
     except errors.UniqueViolation:
@@ -151,20 +303,92 @@ def add_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
         connection.rollback()
     finally:
         cursor.close()
-        connection.close()
+        release_connection(connection)
+
+
+
+def upsert_user_DB(telegram_id, url, display_hour=0, display_minutes=0):
+    """
+    Registers a user or replaces their URL and display time in one statement.
+    Returns the stored row.
+    """
+    logger.info(f"Upserting user {telegram_id} with display time {display_hour:02d}:{display_minutes:02d}...")
+    connection = get_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO USERS (TELEGRAM_ID, URL, display_hour, display_minutes, ACTIVE)
+            VALUES (%s, %s, %s, %s, TRUE)
+            ON CONFLICT (TELEGRAM_ID) DO UPDATE
+            SET URL = EXCLUDED.URL,
+                display_hour = EXCLUDED.display_hour,
+                display_minutes = EXCLUDED.display_minutes,
+                ACTIVE = TRUE
+            RETURNING TELEGRAM_ID, URL, display_hour, display_minutes;
+        """, (telegram_id, url, display_hour, display_minutes))
+        row = cursor.fetchone()
+        connection.commit()
+        user_cache.put(row)
+        logger.info(f"User {telegram_id} upserted successfully.")
+        return row
+
+    except Exception as e:
+        logger.error(f"An error occurred while upserting user {telegram_id}: {e}")
+        user_cache.invalidate(telegram_id)
+        if connection:
+            connection.rollback()
+        raise
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+
+def get_user_DB(telegram_id):
+    """
+    Returns the (TELEGRAM_ID, URL, display_hour, display_minutes) row of an
+    active user or None, served from the user cache when possible.
+    """
+    row = user_cache.get(telegram_id)
+    if row is not None:
+        return row
+    return fetch_user_DB(telegram_id)
+
+
+
+def fetch_user_DB(telegram_id):
+    # Primary-key lookup that bypasses and then refills the user cache
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT TELEGRAM_ID, URL, display_hour, display_minutes
+            FROM USERS
+            WHERE TELEGRAM_ID = %s AND ACTIVE;
+        """, (telegram_id,))
+        row = cursor.fetchone()
+        if row is not None:
+            user_cache.put(row)
+        return row
+
+    except Exception as error:
+        logger.error(f"An error occurred while fetching user {telegram_id}: {error}")
+        if connection:
+            connection.rollback()
+        return None
+
+    finally:
+        cursor.close()
+        release_connection(connection)
 
 
 
 def update_display_time(telegram_id, display_hour, display_minutes):
     logger.info(f"Updating display time for user {telegram_id} to {display_hour:02d}:{display_minutes:02d}...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for updating display time.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for updating display time.")
 
     try:
         cursor = connection.cursor()
@@ -173,45 +397,47 @@ def update_display_time(telegram_id, display_hour, display_minutes):
         cursor.execute("""
             UPDATE USERS
             SET display_hour = %s, display_minutes = %s
-            WHERE TELEGRAM_ID = %s;
+            WHERE TELEGRAM_ID = %s
+            RETURNING TELEGRAM_ID, URL, display_hour, display_minutes, ACTIVE;
         """, (display_hour, display_minutes, telegram_id))
+        row = cursor.fetchone()
 
-        if cursor.rowcount == 0:
+        if row is None:
             logger.warning(f"No user found with TELEGRAM_ID {telegram_id}.")
+            user_cache.invalidate(telegram_id)
         else:
             connection.commit()
+            if row[4]:
+                user_cache.put(row[:4])
             logger.info(f"Display time for user {telegram_id} updated successfully to {display_hour:02d}:{display_minutes:02d}.")
+            return row[:4]
 
     except Exception as e:
         logger.error(f"An error occurred while updating display time: {e}")
+        user_cache.invalidate(telegram_id)
         if connection:
             connection.rollback()  # Rollback transaction in case of an error
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after updating display time.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after updating display time.")
 
 
 
 def remove_user_DB(telegram_id):
     logger.info(f"Removing user {telegram_id} from USERS table...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for removing user.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for removing user.")
 
     try:
         cursor = connection.cursor()
-        cursor.execute(f"""
+        cursor.execute("""
             DELETE FROM USERS
-            WHERE TELEGRAM_ID = {telegram_id};
-        """)
+            WHERE TELEGRAM_ID = %s;
+        """, (telegram_id,))
         connection.commit()
+        user_cache.invalidate(telegram_id)
         logger.info(f"User {telegram_id} removed successfully.")
 
     except Exception as e:
@@ -221,21 +447,41 @@ def remove_user_DB(telegram_id):
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after removing user.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after removing user.")
+
+
+
+def deactivate_user_DB(telegram_id):
+    logger.info(f"Deactivating user {telegram_id}...")
+    connection = get_connection()
+
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE USERS
+            SET ACTIVE = FALSE
+            WHERE TELEGRAM_ID = %s;
+        """, (telegram_id,))
+        connection.commit()
+        user_cache.invalidate(telegram_id)
+        logger.info(f"User {telegram_id} deactivated.")
+
+    except Exception as e:
+        logger.error(f"An error occurred while deactivating user {telegram_id}: {e}")
+        if connection:
+            connection.rollback()
+
+    finally:
+        cursor.close()
+        release_connection(connection)
 
 
 
 def add_mailing_date_DB(date):
     logger.info(f"Adding mailing date {date}...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for adding mailing date.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for adding mailing date.")
 
     try:
         cursor = connection.cursor()
@@ -253,23 +499,21 @@ def add_mailing_date_DB(date):
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after adding mailing date.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after adding mailing date.")
 
 def get_all_users_DB():
     logger.info("Fetching all users from USERS table...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for fetching users.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for fetching users.")
 
     try:
         cursor = connection.cursor()
-        cursor.execute("SELECT * FROM USERS;")
+        cursor.execute("""
+            SELECT TELEGRAM_ID, URL, display_hour, display_minutes
+            FROM USERS
+            WHERE ACTIVE;
+        """)
         records = cursor.fetchall()
         logger.info(f"Fetched {len(records)} users.")
         return records
@@ -282,20 +526,448 @@ def get_all_users_DB():
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after fetching users.")
+        release_connection(connection)
+        logger.info("Database connection returned to pool after fetching users.")
+
+
+def due_window_condition(from_minute, to_minute):
+    # [from_minute, to_minute) in minutes of the day, wrapping past midnight when from > to
+    if from_minute <= to_minute:
+        return "display_minute_of_day >= %s AND display_minute_of_day < %s"
+    return "(display_minute_of_day >= %s OR display_minute_of_day < %s)"
+
+
+def iter_due_users_DB(from_minute, to_minute, target_date, batch_size=1000):
+    """
+    Yields batches of active (TELEGRAM_ID, URL, display_hour, display_minutes)
+    rows whose display time falls into [from_minute, to_minute) and whose
+    message for target_date isn't marked as sent in DELIVERY_LEDGER. Rows are
+    streamed through a server-side cursor, so memory stays flat however many
+    users are due.
+    """
+    connection = get_connection()
+    cursor = None
+    try:
+        cursor = connection.cursor(name="due_users")
+        cursor.itersize = batch_size
+        cursor.execute(f"""
+            SELECT TELEGRAM_ID, URL, display_hour, display_minutes
+            FROM USERS
+            WHERE ACTIVE AND {due_window_condition(from_minute, to_minute)}
+            AND NOT EXISTS (
+                SELECT 1 FROM DELIVERY_LEDGER
+                WHERE DELIVERY_LEDGER.TELEGRAM_ID = USERS.TELEGRAM_ID
+                AND DELIVERY_LEDGER.TARGET_DATE = %s
+                AND DELIVERY_LEDGER.STATUS = 'sent'
+            )
+            ORDER BY display_minute_of_day;
+        """, (from_minute, to_minute, target_date))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            yield rows
+        connection.commit()
+
+    except Exception as error:
+        logger.error(f"An error occurred while fetching due users: {error}")
+        connection.rollback()
+
+    finally:
+        if cursor is not None:
+            cursor.close()
+        release_connection(connection)
+
+
+def record_deliveries_DB(deliveries):
+    """
+    Writes (telegram_id, target_date, status, attempts, latency_ms) rows to
+    DELIVERY_LEDGER in one statement. Attempts add up across retries.
+    """
+    if not deliveries:
+        return
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        execute_values(cursor, """
+            INSERT INTO DELIVERY_LEDGER (TELEGRAM_ID, TARGET_DATE, STATUS, ATTEMPTS, LATENCY_MS)
+            VALUES %s
+            ON CONFLICT (TELEGRAM_ID, TARGET_DATE) DO UPDATE
+            SET STATUS = EXCLUDED.STATUS,
+                ATTEMPTS = DELIVERY_LEDGER.ATTEMPTS + EXCLUDED.ATTEMPTS,
+                LATENCY_MS = EXCLUDED.LATENCY_MS,
+                LEASE_OWNER = NULL,
+                LEASE_EXPIRES = NULL,
+                UPDATED_AT = CURRENT_TIMESTAMP;
+        """, deliveries)
+        connection.commit()
+        logger.info(f"Recorded {len(deliveries)} deliveries in the ledger.")
+
+    except Exception as error:
+        logger.error(f"An error occurred while recording deliveries: {error}")
+        if connection:
+            connection.rollback()
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def enqueue_due_jobs_DB(from_minute, to_minute, target_date):
+    """
+    Adds a pending DELIVERY_LEDGER job for every active user whose display
+    time falls into [from_minute, to_minute) and who has no job for
+    target_date yet, failed and reserved ones are queued again. Every worker
+    runs this when a bucket fires, the conflict clause makes the repeats
+    no-ops. Reserved jobs keep their owner, see claim_jobs_DB.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            INSERT INTO DELIVERY_LEDGER (TELEGRAM_ID, TARGET_DATE, STATUS)
+            SELECT TELEGRAM_ID, %s, 'pending'
+            FROM USERS
+            WHERE ACTIVE AND {due_window_condition(from_minute, to_minute)}
+            ON CONFLICT (TELEGRAM_ID, TARGET_DATE) DO UPDATE
+            SET STATUS = 'pending', UPDATED_AT = CURRENT_TIMESTAMP
+            WHERE DELIVERY_LEDGER.STATUS IN ('failed', 'reserved');
+        """, (target_date, from_minute, to_minute))
+        connection.commit()
+        return cursor.rowcount
+
+    except Exception as error:
+        logger.error(f"An error occurred while enqueueing due jobs: {error}")
+        connection.rollback()
+        return 0
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def claim_jobs_DB(target_date, worker_id, lease_seconds, batch_size=1000):
+    """
+    Claims up to batch_size open jobs for target_date, pending ones and those
+    whose lease ran out because their worker died. Jobs another worker
+    reserved for its prefetch are left to it until the reservation runs out.
+    Rows locked by another worker are skipped rather than waited for. Returns
+    the claimed users as (TELEGRAM_ID, URL, display_hour, display_minutes) rows.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH claimed AS (
+                UPDATE DELIVERY_LEDGER
+                SET STATUS = 'claimed',
+                    LEASE_OWNER = %s,
+                    LEASE_EXPIRES = now() + make_interval(secs => %s),
+                    UPDATED_AT = CURRENT_TIMESTAMP
+                WHERE (TELEGRAM_ID, TARGET_DATE) IN (
+                    SELECT DELIVERY_LEDGER.TELEGRAM_ID, DELIVERY_LEDGER.TARGET_DATE
+                    FROM DELIVERY_LEDGER
+                    JOIN USERS ON USERS.TELEGRAM_ID = DELIVERY_LEDGER.TELEGRAM_ID
+                    WHERE DELIVERY_LEDGER.TARGET_DATE = %s AND USERS.ACTIVE
+                    AND ((DELIVERY_LEDGER.STATUS = 'pending'
+                          AND (DELIVERY_LEDGER.LEASE_OWNER IS NULL OR DELIVERY_LEDGER.LEASE_OWNER = %s
+                               OR DELIVERY_LEDGER.LEASE_EXPIRES < now()))
+                         OR (DELIVERY_LEDGER.STATUS = 'claimed' AND DELIVERY_LEDGER.LEASE_EXPIRES < now()))
+                    LIMIT %s
+                    FOR UPDATE OF DELIVERY_LEDGER SKIP LOCKED
+                )
+                RETURNING TELEGRAM_ID
+            )
+            SELECT USERS.TELEGRAM_ID, USERS.URL, USERS.display_hour, USERS.display_minutes
+            FROM claimed JOIN USERS ON USERS.TELEGRAM_ID = claimed.TELEGRAM_ID;
+        """, (worker_id, lease_seconds, target_date, worker_id, batch_size))
+        users = cursor.fetchall()
+        connection.commit()
+        return users
+
+    except Exception as error:
+        logger.error(f"An error occurred while claiming jobs: {error}")
+        connection.rollback()
+        return []
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def enqueue_prefetch_jobs_DB(from_minute, to_minute, target_date):
+    """
+    Adds a reserved DELIVERY_LEDGER job for every active user whose display
+    time falls into [from_minute, to_minute) and who has no job for
+    target_date yet. Reserved jobs aren't sent, workers take them with
+    claim_prefetch_jobs_DB before the bucket fires.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            INSERT INTO DELIVERY_LEDGER (TELEGRAM_ID, TARGET_DATE, STATUS)
+            SELECT TELEGRAM_ID, %s, 'reserved'
+            FROM USERS
+            WHERE ACTIVE AND {due_window_condition(from_minute, to_minute)}
+            ON CONFLICT (TELEGRAM_ID, TARGET_DATE) DO NOTHING;
+        """, (target_date, from_minute, to_minute))
+        connection.commit()
+        return cursor.rowcount
+
+    except Exception as error:
+        logger.error(f"An error occurred while enqueueing prefetch jobs: {error}")
+        connection.rollback()
+        return 0
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def claim_prefetch_jobs_DB(from_minute, to_minute, target_date, worker_id, reserved_until, batch_size=1000):
+    """
+    Takes up to batch_size reserved jobs for target_date of users whose
+    display time falls into [from_minute, to_minute) that no worker has taken
+    yet. Until reserved_until only worker_id claims them for sending, so the
+    worker that prefetched a message is the one that sends it. Returns the
+    users as (TELEGRAM_ID, URL) rows.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            WITH reserved AS (
+                UPDATE DELIVERY_LEDGER
+                SET LEASE_OWNER = %s,
+                    LEASE_EXPIRES = %s,
+                    UPDATED_AT = CURRENT_TIMESTAMP
+                WHERE (TELEGRAM_ID, TARGET_DATE) IN (
+                    SELECT DELIVERY_LEDGER.TELEGRAM_ID, DELIVERY_LEDGER.TARGET_DATE
+                    FROM DELIVERY_LEDGER
+                    JOIN USERS ON USERS.TELEGRAM_ID = DELIVERY_LEDGER.TELEGRAM_ID
+                    WHERE DELIVERY_LEDGER.TARGET_DATE = %s AND DELIVERY_LEDGER.STATUS = 'reserved'
+                    AND DELIVERY_LEDGER.LEASE_OWNER IS NULL
+                    AND USERS.ACTIVE AND {due_window_condition(from_minute, to_minute)}
+                    LIMIT %s
+                    FOR UPDATE OF DELIVERY_LEDGER SKIP LOCKED
+                )
+                RETURNING TELEGRAM_ID
+            )
+            SELECT USERS.TELEGRAM_ID, USERS.URL
+            FROM reserved JOIN USERS ON USERS.TELEGRAM_ID = reserved.TELEGRAM_ID;
+        """, (worker_id, reserved_until, target_date, from_minute, to_minute, batch_size))
+        users = cursor.fetchall()
+        connection.commit()
+        return users
+
+    except Exception as error:
+        logger.error(f"An error occurred while claiming prefetch jobs: {error}")
+        connection.rollback()
+        return []
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def renew_leases_DB(worker_id, lease_seconds):
+    # Heartbeat, keeps the jobs this worker is still sending from being reclaimed
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE DELIVERY_LEDGER
+            SET LEASE_EXPIRES = now() + make_interval(secs => %s)
+            WHERE LEASE_OWNER = %s AND STATUS = 'claimed';
+        """, (lease_seconds, worker_id))
+        connection.commit()
+        return cursor.rowcount
+
+    except Exception as error:
+        logger.error(f"An error occurred while renewing leases: {error}")
+        connection.rollback()
+        return 0
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def get_fsm_record_DB(storage_key):
+    # (STATE, DATA) of one conversation, None when the user isn't in a dialog
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT STATE, DATA FROM FSM_STATE WHERE STORAGE_KEY = %s;
+        """, (storage_key,))
+        return cursor.fetchone()
+
+    except Exception as error:
+        logger.error(f"An error occurred while fetching FSM state {storage_key}: {error}")
+        connection.rollback()
+        return None
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def set_fsm_state_DB(storage_key, state):
+    set_fsm_column(storage_key, "STATE", state)
+
+
+def set_fsm_data_DB(storage_key, data):
+    # data is a JSON document
+    set_fsm_column(storage_key, "DATA", data)
+
+
+def set_fsm_column(storage_key, column, value):
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute(f"""
+            INSERT INTO FSM_STATE (STORAGE_KEY, {column}) VALUES (%s, %s)
+            ON CONFLICT (STORAGE_KEY) DO UPDATE
+            SET {column} = EXCLUDED.{column}, UPDATED_AT = now();
+        """, (storage_key, value))
+        # Finished dialogs leave no row behind
+        cursor.execute("""
+            DELETE FROM FSM_STATE WHERE STORAGE_KEY = %s AND STATE IS NULL AND DATA = '{}';
+        """, (storage_key,))
+        connection.commit()
+
+    except Exception as error:
+        logger.error(f"An error occurred while saving FSM {column.lower()} {storage_key}: {error}")
+        connection.rollback()
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def sync_feed_snapshots_DB():
+    # One snapshot row per feed an active user subscribed to
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            INSERT INTO FEED_SNAPSHOT (URL)
+            SELECT DISTINCT URL FROM USERS WHERE ACTIVE AND URL IS NOT NULL
+            ON CONFLICT (URL) DO NOTHING;
+        """)
+        added = cursor.rowcount
+        cursor.execute("""
+            DELETE FROM FEED_SNAPSHOT s
+            WHERE NOT EXISTS (SELECT 1 FROM USERS u WHERE u.ACTIVE AND u.URL = s.URL);
+        """)
+        removed = cursor.rowcount
+        connection.commit()
+        return added, removed
+
+    except Exception as error:
+        logger.error(f"An error occurred while syncing feed snapshots: {error}")
+        connection.rollback()
+        return 0, 0
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def claim_due_feeds_DB(poll_interval, batch_size=50):
+    """
+    Takes up to batch_size feeds whose poll is due and moves their next poll
+    poll_interval (+-25% so polls spread out) into the future, which also
+    keeps other workers away from them. Returns (URL, ETAG, LAST_MODIFIED,
+    DIGEST, WINDOW_END, EVENTS, [TELEGRAM_ID, ...]) rows.
+    """
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            WITH due AS (
+                SELECT URL FROM FEED_SNAPSHOT
+                WHERE NEXT_POLL_AT <= now()
+                ORDER BY NEXT_POLL_AT
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            UPDATE FEED_SNAPSHOT s
+            SET NEXT_POLL_AT = now() + make_interval(secs => %s * (0.75 + random() / 2))
+            FROM due
+            WHERE s.URL = due.URL
+            RETURNING s.URL, s.ETAG, s.LAST_MODIFIED, s.DIGEST, s.WINDOW_END, s.EVENTS;
+        """, (batch_size, poll_interval))
+        feeds = cursor.fetchall()
+        subscribers = {}
+        if feeds:
+            cursor.execute("""
+                SELECT URL, array_agg(TELEGRAM_ID) FROM USERS
+                WHERE ACTIVE AND URL = ANY(%s)
+                GROUP BY URL;
+            """, ([feed[0] for feed in feeds],))
+            subscribers = dict(cursor.fetchall())
+        connection.commit()
+        return [(*feed, subscribers.get(feed[0], [])) for feed in feeds]
+
+    except Exception as error:
+        logger.error(f"An error occurred while claiming feeds to poll: {error}")
+        connection.rollback()
+        return []
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def save_feed_snapshot_DB(url, etag, last_modified, digest, window_end, events):
+    # events is a JSON document
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            UPDATE FEED_SNAPSHOT
+            SET ETAG = %s, LAST_MODIFIED = %s, DIGEST = %s, WINDOW_END = %s, EVENTS = %s, UPDATED_AT = now()
+            WHERE URL = %s;
+        """, (etag, last_modified, digest, window_end, events, url))
+        connection.commit()
+
+    except Exception as error:
+        logger.error(f"An error occurred while saving the snapshot of {url}: {error}")
+        connection.rollback()
+
+    finally:
+        cursor.close()
+        release_connection(connection)
+
+
+def get_display_minutes_DB():
+    # Distinct display times in use, at most 1440 rows
+    connection = get_connection()
+    try:
+        cursor = connection.cursor()
+        cursor.execute("""
+            SELECT DISTINCT display_minute_of_day FROM USERS WHERE ACTIVE;
+        """)
+        return [minute_of_day for minute_of_day, in cursor.fetchall()]
+
+    except Exception as error:
+        logger.error(f"An error occurred while fetching display minutes: {error}")
+        if connection:
+            connection.rollback()
+        return []
+
+    finally:
+        cursor.close()
+        release_connection(connection)
 
 
 def get_all_mailing_history_DB():
     logger.info("Fetching mailing history...")
-    connection = pg2.connect(
-        user=os.getenv("DB_USER"),
-        password=os.getenv("DB_PASSWORD"),
-        host=os.getenv("DB_HOST"),
-        port=os.getenv("DB_PORT"),
-        database=os.getenv("DB_DATABASE")
-    )
-    logger.info("Database connection established for fetching mailing history.")
+    connection = get_connection()
+    logger.info("Database connection acquired from pool for fetching mailing history.")
 
     try:
         cursor = connection.cursor()
@@ -311,5 +983,5 @@ def get_all_mailing_history_DB():
 
     finally:
         cursor.close()
-        connection.close()
-        logger.info("Database connection closed after fetching mailing history.")
\ No newline at end of file
+        release_connection(connection)
+        logger.info("Database connection returned to pool after fetching mailing history.")
\ No newline at end of file
@@ -0,0 +1,160 @@
+import threading
+import time
+import psycopg2 as pg2
+from psycopg2 import pool
+from contextlib import contextmanager
+import config
+from custom_logging import logger
+
+
+class PoolExhausted(Exception):
+    def __init__(self, message="No database connection became available in time"):
+        super().__init__(message)
+
+
+# Bounded, thread-safe pool of PostgreSQL connections shared by db_interaction
+class ConnectionPool():
+    def __init__(self, min_size=1, max_size=10, acquire_timeout=10,
+                 healthcheck_interval=30, connect_retries=3, retry_delay=1):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self.connect_retries = connect_retries
+        self.retry_delay = retry_delay
+
+        # Limits how many connections can be borrowed at the same time,
+        # callers wait instead of failing once max_size is reached
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self._last_used = {}
+        self._pool = None
+
+
+    def _connect_kwargs(self):
+        return dict(
+            user=config.get("DB_USER"),
+            password=config.get("DB_PASSWORD"),
+            host=config.get("DB_HOST"),
+            port=config.get("DB_PORT"),
+            database=config.get("DB_DATABASE")
+        )
+
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None or self._pool.closed:
+                self._pool = self._retry(
+                    lambda: pool.ThreadedConnectionPool(self.min_size, self.max_size, **self._connect_kwargs())
+                )
+                logger.info(f"Database connection pool created (min={self.min_size}, max={self.max_size}).")
+            return self._pool
+
+
+    def _retry(self, connect):
+        for attempt in range(1, self.connect_retries + 1):
+            try:
+                return connect()
+            except pg2.OperationalError as error:
+                if attempt == self.connect_retries:
+                    raise
+                logger.warning(f"Database connection attempt {attempt} failed: {error}. Retrying...")
+                time.sleep(self.retry_delay * attempt)
+
+
+    def _is_healthy(self, connection):
+        if connection.closed:
+            return False
+
+        # Only ping connections that sat idle long enough to have been dropped
+        # by the server or a firewall, fresh ones cost no extra round trip
+        last_used = self._last_used.get(id(connection))
+        if last_used is None or time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT 1;")
+            connection.rollback()
+            return True
+        except pg2.Error:
+            return False
+
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.acquire_timeout):
+            raise PoolExhausted
+        try:
+            for attempt in range(1, self.connect_retries + 1):
+                db_pool = self._get_pool()
+                connection = self._retry(db_pool.getconn)
+                if self._is_healthy(connection):
+                    return connection
+
+                # Broken connection: discard it and reconnect
+                logger.warning(f"Discarding unhealthy database connection (attempt {attempt}).")
+                self._discard(db_pool, connection)
+            raise pg2.OperationalError("Could not obtain a healthy database connection")
+        except Exception:
+            self._slots.release()
+            raise
+
+
+    def putconn(self, connection):
+        db_pool = self._pool
+        try:
+            if db_pool is None or db_pool.closed:
+                connection.close()
+            elif connection.closed:
+                self._discard(db_pool, connection)
+            else:
+                # Never hand out a connection in the middle of a transaction
+                if connection.info.transaction_status != pg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                self._last_used[id(connection)] = time.monotonic()
+                db_pool.putconn(connection)
+        except pg2.Error:
+            self._discard(db_pool, connection)
+        finally:
+            self._slots.release()
+
+
+    def _discard(self, db_pool, connection):
+        self._last_used.pop(id(connection), None)
+        try:
+            db_pool.putconn(connection, close=True)
+        except Exception:
+            pass
+
+
+    @contextmanager
+    def connection(self):
+        connection = self.getconn()
+        try:
+            yield connection
+        finally:
+            self.putconn(connection)
+
+
+    def close(self):
+        with self._lock:
+            if self._pool is not None and not self._pool.closed:
+                self._pool.closeall()
+                logger.info("Database connection pool closed.")
+            self._last_used.clear()
+
+
+db_pool = ConnectionPool(
+    min_size=config.get("DB_POOL_MIN_SIZE", 1, int),
+    max_size=config.get("DB_POOL_MAX_SIZE", 10, int),
+    acquire_timeout=config.get("DB_POOL_ACQUIRE_TIMEOUT", 10, float),
+    healthcheck_interval=config.get("DB_POOL_HEALTHCHECK_INTERVAL", 30, float),
+    connect_retries=config.get("DB_POOL_CONNECT_RETRIES", 3, int),
+)
+
+
+def get_connection():
+    return db_pool.getconn()
+
+
+def release_connection(connection):
+    db_pool.putconn(connection)
@@ -0,0 +1,284 @@
+import asyncio
+import heapq
+import os
+import random
+import socket
+from datetime import datetime, timedelta, time
+import config
+from schedule import get_current_date, cet_timezone
+import async_db
+from custom_logging import logger
+
+DISPATCH_PREFETCH_WINDOW = config.get("DISPATCH_PREFETCH_WINDOW", 10, float)
+DISPATCH_BATCH_SIZE = config.get("DISPATCH_BATCH_SIZE", 500, int)
+# How far back, in minutes, a restart looks for messages that never went out
+DISPATCH_RECOVERY_WINDOW = config.get("DISPATCH_RECOVERY_WINDOW", 60, int)
+# Workers sharing one database must have distinct ids
+DISPATCH_WORKER_ID = config.get("DISPATCH_WORKER_ID") or f"{socket.gethostname()}-{os.getpid()}"
+# Claimed jobs go back to the other workers when not renewed for this long
+DISPATCH_LEASE_SECONDS = config.get("DISPATCH_LEASE_SECONDS", 60, float)
+
+# Heap entry kinds, prefetches sort before sends due at the same instant
+PREFETCH = 0
+SEND = 1
+
+
+def fire_time_on(day, minute_of_day):
+    return cet_timezone.localize(datetime.combine(day, time(minute_of_day // 60, minute_of_day % 60)))
+
+
+def next_fire_time(minute_of_day, now):
+    # Next occurrence of HH:MM in CET strictly after now, crossing midnight if needed
+    fire_at = fire_time_on(now.date(), minute_of_day)
+    if fire_at <= now:
+        fire_at = fire_time_on(now.date() + timedelta(days=1), minute_of_day)
+    return fire_at
+
+
+def minute_windows(since, now):
+    # [since, now] as (from_minute, to_minute, fire_date) windows of the
+    # due-window query, split at midnight so each has a single fire date
+    windows = []
+    day = since.date()
+    from_minute = since.hour * 60 + since.minute
+    while day < now.date():
+        windows.append((from_minute, 1440, day))
+        day += timedelta(days=1)
+        from_minute = 0
+    windows.append((from_minute, now.hour * 60 + now.minute + 1, now.date()))
+    return windows
+
+
+# Min-heap of display-time buckets. Each minute of the day that is in use is
+# in the heap once per kind, keyed by its next fire time, so the scheduler
+# sleeps until exactly the next due bucket. The users of a bucket are streamed
+# from Postgres with the due-window query when it fires, so the scheduler's
+# memory doesn't grow with the number of users. PREFETCH_WINDOW minutes before
+# a bucket fires, its messages are rendered at jittered moments and parked in
+# a ready queue for the send. The workers split a bucket's users between them
+# for this by reserving their ledger jobs, see _prefetch_bucket.
+#
+# Sends go through DELIVERY_LEDGER: when a bucket fires its users become
+# pending jobs, and workers claim batches of them with FOR UPDATE SKIP LOCKED
+# under a lease they keep renewing. Any number of bot processes can run this
+# scheduler against one database, each job is sent by the one worker that
+# claimed it, and jobs of a worker that died are reclaimed once its lease
+# expires.
+class DispatchScheduler():
+    def __init__(self, prefetch_window=DISPATCH_PREFETCH_WINDOW, batch_size=DISPATCH_BATCH_SIZE,
+                 recovery_window=DISPATCH_RECOVERY_WINDOW, worker_id=DISPATCH_WORKER_ID,
+                 lease_seconds=DISPATCH_LEASE_SECONDS):
+        self.prefetch_window = timedelta(minutes=prefetch_window)
+        self.batch_size = batch_size
+        self.recovery_window = recovery_window
+        self.worker_id = worker_id
+        self.lease_seconds = lease_seconds
+        self._heap = []
+        self._scheduled = set()
+        self._claimed = 0
+        self._ready = {}
+        self._wakeup = asyncio.Event()
+        self._tasks = set()
+        self._swept_at = None
+        self._send_batch = None
+        self._prepare = None
+
+
+    def load_minutes(self, minutes):
+        for minute_of_day in minutes:
+            self._schedule_minute(minute_of_day, get_current_date(time=True))
+        logger.info(f"Dispatch scheduler loaded {len(minutes)} time buckets.")
+
+
+    def schedule_user(self, telegram_id, url, display_hour, display_minutes):
+        # Called after the user's row was written, the bucket picks it up from the DB
+        self._ready.pop(telegram_id, None)
+        minute_of_day = display_hour * 60 + display_minutes
+        now = get_current_date(time=True)
+        already_prefetched = (PREFETCH, minute_of_day) in self._scheduled
+        self._schedule_minute(minute_of_day, now)
+
+        fire_at = next_fire_time(minute_of_day, now)
+        if already_prefetched and fire_at - now <= self.prefetch_window:
+            # The bucket was already prefetched for this fire time, reserve the new user's job
+            self._spawn(self._prefetch_bucket(minute_of_day, fire_at))
+
+
+    def remove_user(self, telegram_id):
+        self._ready.pop(telegram_id, None)
+
+
+    def _schedule_minute(self, minute_of_day, now):
+        fire_at = next_fire_time(minute_of_day, now)
+        if (SEND, minute_of_day) not in self._scheduled:
+            self._push(fire_at, SEND, minute_of_day)
+        if (PREFETCH, minute_of_day) not in self._scheduled:
+            self._push(fire_at - self.prefetch_window, PREFETCH, minute_of_day)
+
+
+    def _push(self, when, kind, minute_of_day):
+        heapq.heappush(self._heap, (when, kind, minute_of_day))
+        self._scheduled.add((kind, minute_of_day))
+        # Wake the loop in case the new entry is due before the one it sleeps on
+        self._wakeup.set()
+
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, kind, minute_of_day = heapq.heappop(self._heap)
+            self._scheduled.discard((kind, minute_of_day))
+            fire_at = when + self.prefetch_window if kind == PREFETCH else when
+            due.append((kind, minute_of_day, fire_at))
+            self._push(next_fire_time(minute_of_day, max(now, fire_at)) - (fire_at - when), kind, minute_of_day)
+        return due
+
+
+    async def _dispatch_window(self, from_minute, to_minute, fire_date):
+        # Users that already have a job for fire_date get no second one, so this
+        # is exactly once per user per day even if the user moved to a later
+        # time after receiving today's message
+        await async_db.enqueue_due_jobs_DB(from_minute, to_minute, fire_date)
+        await self._drain(fire_date)
+
+
+    async def _drain(self, fire_date):
+        # Claim and send batches until no open job for fire_date is left
+        while True:
+            rows = await async_db.claim_jobs_DB(fire_date, self.worker_id, self.lease_seconds, self.batch_size)
+            if not rows:
+                return
+            due_users = []
+            for telegram_id, url, display_hour, display_minutes in rows:
+                fire_at = fire_time_on(fire_date, display_hour * 60 + display_minutes)
+                message = None
+                ready = self._ready.pop(telegram_id, None)
+                if ready is not None and ready[0] == fire_at and ready[1] == url:
+                    message = ready[2]
+                due_users.append((telegram_id, url, message, fire_at))
+
+            prefetched = sum(1 for _, _, message, _ in due_users if message is not None)
+            logger.info(f"Worker {self.worker_id} dispatching schedules to {len(due_users)} users ({prefetched} prefetched).")
+            self._claimed += 1
+            try:
+                await self._send_batch(due_users)
+            finally:
+                self._claimed -= 1
+
+
+    async def _maintain_leases(self):
+        # Heartbeat for the batches being sent, and every lease period a sweep
+        interval = self.lease_seconds / 3
+        beats = 0
+        while True:
+            await asyncio.sleep(interval)
+            beats += 1
+            # A database hiccup must not end the heartbeat for the life of the process
+            try:
+                if self._claimed:
+                    await async_db.renew_leases_DB(self.worker_id, self.lease_seconds)
+                if beats % 3 == 0:
+                    await self._sweep(get_current_date(time=True))
+            except Exception as e:
+                logger.exception(f"Dispatch lease maintenance failed: {e!r}")
+
+
+    async def _sweep(self, now):
+        # Pick up display times registered through other workers
+        for minute_of_day in await async_db.get_display_minutes_DB():
+            self._schedule_minute(minute_of_day, now)
+        # Enqueue again what fired since the last sweep, in case a bucket's
+        # enqueue failed, the ledger's primary key makes the repeats no-ops
+        for from_minute, to_minute, fire_date in minute_windows(self._swept_at, now):
+            await async_db.enqueue_due_jobs_DB(from_minute, to_minute, fire_date)
+        self._swept_at = now
+        # Take over jobs left behind by workers that stopped renewing
+        for fire_date in (now.date() - timedelta(days=1), now.date()):
+            self._spawn(self._drain(fire_date))
+
+
+    async def _recover(self, now):
+        # Resend whatever the ledger doesn't mark as sent for the buckets that
+        # fired in the last recovery_window minutes
+        if self.recovery_window <= 0:
+            return
+        since = cet_timezone.normalize(now - timedelta(minutes=self.recovery_window))
+        for from_minute, to_minute, fire_date in minute_windows(since, now):
+            await self._dispatch_window(from_minute, to_minute, fire_date)
+        logger.info(f"Recovered missed deliveries of the last {self.recovery_window} minutes.")
+
+
+    async def _prefetch_bucket(self, minute_of_day, fire_at):
+        # The bucket's jobs are created as reserved and the workers take them
+        # in batches, each prefetches only the messages it is going to send.
+        # A worker that stops before the bucket fires leaves its jobs to the
+        # others once the reservation runs out, a lease period after the send.
+        if self._prepare is None:
+            return
+        fire_date = fire_at.date()
+        reserved_until = fire_at + timedelta(seconds=self.lease_seconds)
+        await async_db.enqueue_prefetch_jobs_DB(minute_of_day, minute_of_day + 1, fire_date)
+        while True:
+            rows = await async_db.claim_prefetch_jobs_DB(minute_of_day, minute_of_day + 1, fire_date, self.worker_id,
+                                                         reserved_until, self.batch_size)
+            if not rows:
+                return
+            self._start_prefetch(rows, fire_at, get_current_date(time=True))
+
+
+    def _start_prefetch(self, users, fire_at, now):
+        if self._prepare is None:
+            return
+        # Spread the fetches over what is left of the window, leaving a margin
+        # so the slowest ones still finish before the send
+        spread = max((fire_at - now).total_seconds(), 0) * 0.8
+        for telegram_id, url in users:
+            self._spawn(self._prefetch_user(telegram_id, url, fire_at, random.uniform(0, spread)))
+
+
+    async def _prefetch_user(self, telegram_id, url, fire_at, delay):
+        await asyncio.sleep(delay)
+        try:
+            message = await self._prepare(url, fire_at.date())
+        except Exception as e:
+            # The message is rendered again at send time
+            logger.warning(f"Prefetch for user {telegram_id} failed: {e!r}")
+            return
+        self._ready[telegram_id] = (fire_at, url, message)
+
+
+    def _spawn(self, coroutine):
+        task = asyncio.create_task(coroutine)
+        self._tasks.add(task)
+        task.add_done_callback(self._finished)
+
+
+    def _finished(self, task):
+        self._tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Dispatch task failed: {task.exception()!r}", exc_info=task.exception())
+
+
+    async def run(self, send_batch, prepare):
+        self._send_batch = send_batch
+        self._prepare = prepare
+        self._swept_at = get_current_date(time=True)
+        logger.info("Dispatch scheduler started.")
+        self._spawn(self._recover(get_current_date(time=True)))
+        self._spawn(self._maintain_leases())
+        while True:
+            now = get_current_date(time=True)
+            for kind, minute_of_day, fire_at in self._pop_due(now):
+                if kind == PREFETCH:
+                    self._spawn(self._prefetch_bucket(minute_of_day, fire_at))
+                else:
+                    self._spawn(self._dispatch_window(minute_of_day, minute_of_day + 1, fire_at.date()))
+            self._wakeup.clear()
+
+            timeout = None
+            if self._heap:
+                timeout = max((self._heap[0][0] - get_current_date(time=True)).total_seconds(), 0)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,74 @@
+from bisect import bisect_left, bisect_right
+
+
+# Lightweight copy of the fields get_daily_schedule needs from an ics event
+class EventRecord():
+    __slots__ = ("start", "end", "title", "instructor", "location", "uid", "fragment")
+
+    def __init__(self, start, end, title, instructor, location, uid=None):
+        self.start = start
+        self.end = end
+        self.title = title
+        self.instructor = instructor
+        self.location = location
+        # Stable across feed versions, change detection matches events by it
+        self.uid = uid
+        # This event's part of the schedule message, built on first render
+        self.fragment = None
+
+
+    @classmethod
+    def from_summary(cls, start, end, summary, location, uid=None):
+        # e.g. "KV Responsible AI / Martina Mara / (510101/2024W)"
+        summary = summary or ""
+        parts = summary.split(" / ")
+        if len(parts) >= 2:
+            course_title = parts[0].strip()
+            instructor = parts[1].strip()
+        else:
+            # If the format is different or incomplete
+            course_title = summary.strip()
+            instructor = "N/A"
+        return cls(start, end, course_title, instructor, location or "N/A", uid)
+
+
+    def __repr__(self):
+        return f"EventRecord({self.start:%Y-%m-%d %H:%M}, {self.title!r})"
+
+
+# Events of one feed grouped by their local start date, each day pre-sorted
+class EventIndex():
+    def __init__(self, records):
+        days = {}
+        for record in records:
+            days.setdefault(record.start.date(), []).append(record)
+        self._days = {day: tuple(sorted(events, key=lambda record: record.start)) for day, events in days.items()}
+        self._dates = sorted(self._days)
+
+
+    @classmethod
+    def from_calendar(cls, calendar):
+        return cls(
+            EventRecord.from_summary(event.begin.datetime, event.end.datetime, event.name, event.location, event.uid)
+            for event in calendar.events
+        )
+
+
+    def __len__(self):
+        return sum(len(events) for events in self._days.values())
+
+
+    def days(self):
+        # (date, events) pairs in date order
+        return [(day, self._days[day]) for day in self._dates]
+
+
+    def events_on(self, day):
+        return self._days.get(day, ())
+
+
+    def events_between(self, first_day, last_day):
+        # All events from first_day through last_day inclusive, in start order
+        start = bisect_left(self._dates, first_day)
+        stop = bisect_right(self._dates, last_day)
+        return [record for day in self._dates[start:stop] for record in self._days[day]]
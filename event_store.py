@@ -0,0 +1,173 @@
+import sys
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime
+from event_index import EventRecord
+from metrics import Callback
+
+
+def content_key(record):
+    # Everything a message shows, plus the UID change detection matches events by.
+    # The offsets keep the same instant in different time zones apart, it renders differently.
+    return (record.start, record.start.utcoffset(), record.end, record.end.utcoffset(),
+            record.title, record.instructor, record.location, record.uid)
+
+
+# An EventRecord with its two datetimes and a KUSSS UID, which no other event shares
+RECORD_BYTES = EventRecord.__basicsize__ + 2 * sys.getsizeof(datetime.now()) + sys.getsizeof("510101-1@kusss.jku.at")
+
+
+# One EventRecord per distinct event across all cached feeds. Students who
+# take the same course have the same lectures in their feeds, every feed
+# refers to the shared record by a 4 byte id.
+#
+# Ids are reference counted per feed index. An index that is garbage hands
+# its ids back from __del__ through a queue, the counts are updated on the
+# next intern, so no lock is ever taken from a finalizer. Records nobody
+# refers to any more are dropped and their ids reused.
+class EventStore():
+    def __init__(self):
+        self.records = []
+        self.indexes = 0
+        self.id_bytes = 0
+        self._refs = array("I")
+        self._ids = {}
+        self._free = []
+        self._released = deque()
+        self._lock = threading.Lock()
+
+
+    def intern_index(self, event_index):
+        """
+        Returns an InternedEventIndex with the events of event_index, reusing
+        the records of identical events that are already stored.
+        """
+        days = event_index.days()
+        ids = array("I")
+        with self._lock:
+            self._collect()
+            records = len(self._ids)
+            for _, events in days:
+                ids.extend(self._intern(record) for record in events)
+            added = len(self._ids) - records
+            self.indexes += 1
+            self.id_bytes += ids.itemsize * len(ids)
+        index = InternedEventIndex(self, [day for day, _ in days], [len(events) for _, events in days], ids)
+        # The feed that brought new events in is charged for their records
+        index.nbytes += added * RECORD_BYTES
+        return index
+
+
+    def _intern(self, record):
+        key = content_key(record)
+        event_id = self._ids.get(key)
+        if event_id is not None:
+            self._refs[event_id] += 1
+            return event_id
+        # Course titles, instructors and rooms repeat all semester
+        record.title = sys.intern(record.title)
+        record.instructor = sys.intern(record.instructor)
+        record.location = sys.intern(record.location)
+        if self._free:
+            event_id = self._free.pop()
+            self.records[event_id] = record
+            self._refs[event_id] = 1
+        else:
+            event_id = len(self.records)
+            self.records.append(record)
+            self._refs.append(1)
+        self._ids[key] = event_id
+        return event_id
+
+
+    def release(self, ids):
+        # Safe to call from __del__, the work is done under the lock later
+        self._released.append(ids)
+
+
+    def _collect(self):
+        # Called with the lock held
+        while self._released:
+            ids = self._released.popleft()
+            self.indexes -= 1
+            self.id_bytes -= ids.itemsize * len(ids)
+            for event_id in ids:
+                self._refs[event_id] -= 1
+                if not self._refs[event_id]:
+                    del self._ids[content_key(self.records[event_id])]
+                    self.records[event_id] = None
+                    self._free.append(event_id)
+
+
+    def stats(self):
+        with self._lock:
+            self._collect()
+            events = len(self._ids)
+            references = sum(self._refs)
+            return {
+                "events": events,
+                "references": references,
+                "indexes": self.indexes,
+                # How many feeds share an average event
+                "sharing": round(references / events, 2) if events else 0,
+                "id_bytes": self.id_bytes,
+                # The records themselves, their interned strings are shared further
+                "record_bytes": events * RECORD_BYTES,
+            }
+
+
+# EventIndex of one feed as ids into the EventStore: the days in order, how
+# many events each has, and the ids of all events, day by day in start order.
+class InternedEventIndex():
+    __slots__ = ("_store", "_dates", "_starts", "_ids", "nbytes")
+
+    def __init__(self, store, dates, counts, ids):
+        self._store = store
+        self._dates = dates
+        self._starts = array("I", [0])
+        for count in counts:
+            self._starts.append(self._starts[-1] + count)
+        self._ids = ids
+        self.nbytes = (sys.getsizeof(dates) + sum(sys.getsizeof(day) for day in dates)
+                       + self._starts.itemsize * len(self._starts) + ids.itemsize * len(ids))
+
+
+    def __del__(self):
+        self._store.release(self._ids)
+
+
+    def __len__(self):
+        return len(self._ids)
+
+
+    def _events(self, position):
+        records = self._store.records
+        return tuple(records[event_id] for event_id in self._ids[self._starts[position]:self._starts[position + 1]])
+
+
+    def days(self):
+        return [(day, self._events(position)) for position, day in enumerate(self._dates)]
+
+
+    def events_on(self, day):
+        position = bisect_left(self._dates, day)
+        if position == len(self._dates) or self._dates[position] != day:
+            return ()
+        return self._events(position)
+
+
+    def events_between(self, first_day, last_day):
+        start = bisect_left(self._dates, first_day)
+        stop = bisect_right(self._dates, last_day)
+        records = self._store.records
+        return [records[event_id] for event_id in self._ids[self._starts[start]:self._starts[stop]]]
+
+
+event_store = EventStore()
+
+Callback("bot_event_store_events", "Distinct events held for all cached feeds", "gauge",
+         lambda: event_store.stats()["events"])
+Callback("bot_event_store_references", "Events of all cached feeds, shared ones counted once per feed", "gauge",
+         lambda: event_store.stats()["references"])
@@ -0,0 +1,279 @@
+import asyncio
+import time
+from collections import namedtuple
+from urllib.parse import urlsplit
+import aiohttp
+import config
+from custom_logging import logger
+from lanes import LaneLimiter
+from metrics import feed_fetch_seconds, feed_fetch_bytes, feed_fetch_errors, feed_circuit_opened
+
+# Concurrent downloads per host to start with, adapted to how the host copes
+FEED_FETCH_CONCURRENCY = config.get("FEED_FETCH_CONCURRENCY", 10, int)
+FEED_FETCH_MIN_CONCURRENCY = config.get("FEED_FETCH_MIN_CONCURRENCY", 1, int)
+FEED_FETCH_MAX_CONCURRENCY = config.get("FEED_FETCH_MAX_CONCURRENCY", 32, int)
+# Download slots per host the daily dispatch leaves to users' commands
+FEED_FETCH_RESERVED = config.get("FEED_FETCH_RESERVED", 2, int)
+# Downloads slower than this count as a sign of overload
+FEED_LATENCY_TARGET = config.get("FEED_LATENCY_TARGET", 2, float)
+FEED_CONNECT_TIMEOUT = config.get("FEED_CONNECT_TIMEOUT", 5, float)
+FEED_READ_TIMEOUT = config.get("FEED_READ_TIMEOUT", 15, float)
+# Deadline for a whole download, however slowly the bytes keep coming
+FEED_TOTAL_TIMEOUT = config.get("FEED_TOTAL_TIMEOUT", 30, float)
+# Consecutive upstream failures that open a host's circuit, and for how long
+FEED_BREAKER_THRESHOLD = config.get("FEED_BREAKER_THRESHOLD", 5, int)
+FEED_BREAKER_COOLDOWN = config.get("FEED_BREAKER_COOLDOWN", 30, float)
+FEED_BREAKER_MAX_COOLDOWN = 300
+
+# status is 304 and body is None when the server confirmed our cached copy
+FeedResponse = namedtuple("FeedResponse", ["status", "body", "etag", "last_modified"])
+
+# A request the circuit breaker let through, its outcome is reported with it
+Attempt = namedtuple("Attempt", ["generation", "probe"])
+
+# Answers that say the URL itself is wrong, retrying won't help
+INVALID_URL_STATUSES = {400, 401, 403, 404, 405, 410, 414}
+
+
+# The URL doesn't lead to a calendar: malformed, unknown or revoked
+class InvalidFeedURL(Exception):
+    def __init__(self, message="URL doesn't lead to a calendar feed"):
+        super().__init__(message)
+
+
+# KUSSS is down, overloaded or too slow, the same URL may work later
+class UpstreamUnavailable(Exception):
+    def __init__(self, message="Calendar server is unavailable"):
+        super().__init__(message)
+
+
+# AIMD limit on concurrent downloads from one host: every download that was
+# fast enough raises it by 1/limit (so by about 1 per round of downloads),
+# a slow or failed one halves it, at most once per latency target so one
+# bad round doesn't collapse it to the minimum. The slots are shared between
+# the interactive and the bulk lane like any LaneLimiter's.
+class AdaptiveLimit(LaneLimiter):
+    def __init__(self, initial=FEED_FETCH_CONCURRENCY, minimum=FEED_FETCH_MIN_CONCURRENCY,
+                 maximum=FEED_FETCH_MAX_CONCURRENCY, latency_target=FEED_LATENCY_TARGET,
+                 reserved=FEED_FETCH_RESERVED, clock=time.monotonic):
+        super().__init__("fetch", float(min(max(initial, minimum), maximum)), reserved)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.download_target = latency_target
+        self.clock = clock
+        self._last_decrease = float("-inf")
+
+
+    async def release(self, lane, latency, overloaded):
+        async with self._condition:
+            now = self.clock()
+            if overloaded or latency > self.download_target:
+                if now - self._last_decrease > self.download_target:
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._release(lane)
+
+
+# Fails fast while a host keeps failing. After THRESHOLD consecutive
+# upstream failures the circuit opens and requests are refused for the
+# cooldown, then a single probe is let through: success closes the circuit,
+# failure opens it again for twice as long.
+#
+# Every change of state starts a new generation. Outcomes of requests that
+# were let through in an earlier one are stale and ignored, so a slow
+# request from before the circuit opened can't decide the probe's verdict.
+class CircuitBreaker():
+    def __init__(self, threshold=FEED_BREAKER_THRESHOLD, cooldown=FEED_BREAKER_COOLDOWN, clock=time.monotonic):
+        self.threshold = threshold
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.generation = 0
+
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or self.clock() - self.opened_at < self.cooldown:
+            return "open"
+        return "half-open"
+
+
+    def allow(self):
+        # The Attempt to report the outcome with, None while the circuit refuses requests
+        state = self.state
+        if state == "open":
+            return None
+        if state == "half-open":
+            self.probing = True
+        return Attempt(self.generation, state == "half-open")
+
+
+    def _open(self):
+        self.opened_at = self.clock()
+        self.generation += 1
+
+
+    def record_success(self, attempt):
+        if attempt.generation != self.generation:
+            return
+        if attempt.probe:
+            self.generation += 1
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+        self.cooldown = self.base_cooldown
+
+
+    def record_failure(self, attempt):
+        # True when this failure opened the circuit
+        if attempt.generation != self.generation:
+            return False
+        self.failures += 1
+        if attempt.probe:
+            self.probing = False
+            self.cooldown = min(self.cooldown * 2, FEED_BREAKER_MAX_COOLDOWN)
+            self._open()
+        elif self.failures >= self.threshold:
+            self._open()
+            feed_circuit_opened.inc()
+            return True
+        return False
+
+
+    def finish(self, attempt):
+        # A probe that ended without a verdict (cancelled, bad URL, ...)
+        # must not keep the circuit open for good, the next request probes
+        if attempt.probe and attempt.generation == self.generation:
+            self.probing = False
+
+
+class Upstream():
+    def __init__(self, host):
+        self.host = host
+        self.limit = AdaptiveLimit()
+        self.breaker = CircuitBreaker()
+
+
+# Downloads iCal feeds over one shared keep-alive HTTP session. Every host
+# gets its own adaptive concurrency limit and circuit breaker, so a KUSSS
+# incident neither hangs the dispatcher nor gets hammered by retries, and
+# concurrent requests for the same feed share one download.
+class FeedFetcher():
+    def __init__(self, connect_timeout=FEED_CONNECT_TIMEOUT, read_timeout=FEED_READ_TIMEOUT,
+                 total_timeout=FEED_TOTAL_TIMEOUT, max_concurrency=FEED_FETCH_MAX_CONCURRENCY):
+        self.max_concurrency = max_concurrency
+        self.timeout = aiohttp.ClientTimeout(total=total_timeout, connect=connect_timeout, sock_read=read_timeout)
+        self.upstreams = {}
+        self._session = None
+        self._in_flight = {}
+
+
+    def _get_session(self):
+        # The session must be created inside the running event loop
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_concurrency, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            # Their locks belong to the event loop of the previous session
+            self.upstreams = {}
+        return self._session
+
+
+    def upstream(self, url):
+        parts = urlsplit(url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise InvalidFeedURL(f"Not an http(s) URL: {url[:80]!r}")
+        try:
+            # Raises for a port out of range, found before a half-open circuit lets the URL probe
+            parts.port
+        except ValueError as e:
+            raise InvalidFeedURL(f"Malformed URL: {e}")
+        upstream = self.upstreams.get(parts.hostname)
+        if upstream is None:
+            upstream = self.upstreams[parts.hostname] = Upstream(parts.hostname)
+        return upstream
+
+
+    async def fetch(self, url, headers=None):
+        """
+        Returns a FeedResponse, raises InvalidFeedURL when the URL is at
+        fault and UpstreamUnavailable when the server is.
+        """
+        key = (url, tuple(sorted((headers or {}).items())))
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(url, headers))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # A waiter that gets cancelled mustn't cancel the download for the others
+        return await asyncio.shield(task)
+
+
+    async def _fetch(self, url, headers):
+        session = self._get_session()
+        try:
+            upstream = self.upstream(url)
+        except InvalidFeedURL:
+            feed_fetch_errors.inc(kind="invalid_url")
+            raise
+        attempt = upstream.breaker.allow()
+        if attempt is None:
+            feed_fetch_errors.inc(kind="circuit_open")
+            raise UpstreamUnavailable(f"{upstream.host} is failing, not retrying for now")
+
+        lane = None
+        started = time.perf_counter()
+        status = "error"
+        overloaded = False
+        try:
+            lane = await upstream.limit.acquire()
+            started = time.perf_counter()
+            async with session.get(url, headers=headers) as response:
+                status = str(response.status)
+                if response.status == 304:
+                    upstream.breaker.record_success(attempt)
+                    return FeedResponse(304, None, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+                if response.status in INVALID_URL_STATUSES:
+                    # The server answered, it's the URL that's wrong
+                    upstream.breaker.record_success(attempt)
+                    feed_fetch_errors.inc(kind="invalid_url")
+                    raise InvalidFeedURL(f"{upstream.host} answered {response.status}")
+                if response.status >= 400:
+                    raise UpstreamUnavailable(f"{upstream.host} answered {response.status}")
+                # Raw bytes, decoding is left to the parser
+                body = await response.read()
+                feed_fetch_bytes.inc(len(body))
+                upstream.breaker.record_success(attempt)
+                return FeedResponse(response.status, body, response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        except aiohttp.InvalidURL as e:
+            feed_fetch_errors.inc(kind="invalid_url")
+            raise InvalidFeedURL(f"Malformed URL: {e}")
+        except (asyncio.TimeoutError, aiohttp.ClientError, UpstreamUnavailable) as e:
+            overloaded = True
+            feed_fetch_errors.inc(kind="upstream")
+            if upstream.breaker.record_failure(attempt):
+                logger.warning(f"Circuit for {upstream.host} opened after {upstream.breaker.failures} failures.")
+            if isinstance(e, UpstreamUnavailable):
+                raise
+            raise UpstreamUnavailable(f"{upstream.host} failed: {e!r}")
+        finally:
+            upstream.breaker.finish(attempt)
+            if lane is not None:
+                latency = time.perf_counter() - started
+                await upstream.limit.release(lane, latency, overloaded)
+                feed_fetch_seconds.observe(latency, status=status)
+
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+            logger.info("Feed fetcher HTTP session closed.")
+
+
+feed_fetcher = FeedFetcher()
@@ -0,0 +1,266 @@
+import hashlib
+import json
+import os
+import struct
+import time
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta, timezone
+import config
+from custom_logging import logger
+from event_index import EventRecord
+from calendar_cache import CacheEntry
+from metrics import feed_store_loads, feed_store_writes
+
+# 0 keeps parsed feeds in memory only
+FEED_STORE = config.get("FEED_STORE", 1, int)
+# Mount a volume here to keep the store when the container is re-created
+FEED_STORE_DIR = config.get("FEED_STORE_DIR", "feed_store")
+# Files of feeds KUSSS hasn't confirmed for this many days are deleted at startup
+FEED_STORE_MAX_AGE_DAYS = config.get("FEED_STORE_MAX_AGE_DAYS", 30, int)
+
+# One file per feed, little endian:
+#   header | metadata (JSON) | day table | event table | string offsets | strings
+# The day table gives the first event and the number of events of every day,
+# so a day's events are decoded straight from the file's bytes without
+# touching the rest. Titles, instructors and rooms repeat a lot and are
+# stored once in the string table.
+MAGIC = b"JKUFEED1"
+HEADER = struct.Struct("<8sIIII")    # magic, metadata bytes, days, events, strings
+DAY = struct.Struct("<iII")          # date ordinal, first event, event count
+EVENT = struct.Struct("<qqhhIIII")   # start, end (epoch seconds), their UTC offsets (minutes), title, instructor, location, uid
+OFFSET = struct.Struct("<I")
+NO_STRING = 0xFFFFFFFF
+
+
+def encode(entry):
+    strings = {}
+
+    def string_id(value):
+        if value is None:
+            return NO_STRING
+        return strings.setdefault(value, len(strings))
+
+    day_table = bytearray()
+    event_table = bytearray()
+    count = 0
+    days = entry.parsed.days()
+    for day, events in days:
+        day_table += DAY.pack(day.toordinal(), count, len(events))
+        for event in events:
+            event_table += EVENT.pack(
+                int(event.start.timestamp()), int(event.end.timestamp()),
+                utc_offset_minutes(event.start), utc_offset_minutes(event.end),
+                string_id(event.title), string_id(event.instructor), string_id(event.location), string_id(event.uid),
+            )
+        count += len(events)
+
+    blob = bytearray()
+    offsets = bytearray()
+    for value in strings:
+        offsets += OFFSET.pack(len(blob))
+        blob += value.encode("utf-8")
+    offsets += OFFSET.pack(len(blob))
+
+    metadata = json.dumps({
+        "url": entry.url, "etag": entry.etag, "last_modified": entry.last_modified, "digest": entry.digest,
+    }).encode("utf-8")
+    return b"".join((HEADER.pack(MAGIC, len(metadata), len(days), count, len(strings)),
+                     metadata, day_table, event_table, offsets, blob))
+
+
+def utc_offset_minutes(moment):
+    return int(moment.utcoffset().total_seconds() // 60)
+
+
+_timezones = {}
+
+
+def fixed_timezone(minutes):
+    tz = _timezones.get(minutes)
+    if tz is None:
+        tz = _timezones[minutes] = timezone(timedelta(minutes=minutes))
+    return tz
+
+
+# Read-only EventIndex over a stored feed file. Only the day table is read
+# up front, EventRecords are built the first time their day is asked for.
+# Restored entries hand it to the event store, which reads every day once.
+class StoredEventIndex():
+    def __init__(self, buffer):
+        magic, metadata_size, day_count, self._event_count, string_count = HEADER.unpack_from(buffer, 0)
+        if magic != MAGIC:
+            raise ValueError("Not a feed store file")
+        position = HEADER.size
+        self.metadata = json.loads(bytes(buffer[position:position + metadata_size]))
+        position += metadata_size
+        self._ordinals = []
+        self._slots = {}
+        for ordinal, first, count in DAY.iter_unpack(buffer[position:position + day_count * DAY.size]):
+            self._ordinals.append(ordinal)
+            self._slots[ordinal] = (first, count)
+        self._events_at = position + day_count * DAY.size
+        self._offsets_at = self._events_at + self._event_count * EVENT.size
+        self._strings_at = self._offsets_at + (string_count + 1) * OFFSET.size
+        self._buffer = buffer
+        self._strings = {}
+        self._loaded = {}
+
+
+    def __len__(self):
+        return self._event_count
+
+
+    def _string(self, index):
+        if index == NO_STRING:
+            return None
+        value = self._strings.get(index)
+        if value is None:
+            start, = OFFSET.unpack_from(self._buffer, self._offsets_at + index * OFFSET.size)
+            stop, = OFFSET.unpack_from(self._buffer, self._offsets_at + (index + 1) * OFFSET.size)
+            value = self._strings[index] = self._buffer[self._strings_at + start:self._strings_at + stop].decode("utf-8")
+        return value
+
+
+    def _record(self, position):
+        start, end, start_offset, end_offset, title, instructor, location, uid = EVENT.unpack_from(
+            self._buffer, self._events_at + position * EVENT.size)
+        return EventRecord(
+            datetime.fromtimestamp(start, fixed_timezone(start_offset)),
+            datetime.fromtimestamp(end, fixed_timezone(end_offset)),
+            self._string(title), self._string(instructor), self._string(location), self._string(uid),
+        )
+
+
+    def events_on(self, day):
+        ordinal = day.toordinal()
+        events = self._loaded.get(ordinal)
+        if events is None:
+            slot = self._slots.get(ordinal)
+            if slot is None:
+                return ()
+            first, count = slot
+            # Kept, so fragments rendered for these records are reused
+            events = self._loaded[ordinal] = tuple(self._record(position) for position in range(first, first + count))
+        return events
+
+
+    def days(self):
+        return [(date.fromordinal(ordinal), self.events_on(date.fromordinal(ordinal))) for ordinal in self._ordinals]
+
+
+    def events_between(self, first_day, last_day):
+        start = bisect_left(self._ordinals, first_day.toordinal())
+        stop = bisect_right(self._ordinals, last_day.toordinal())
+        return [record for ordinal in self._ordinals[start:stop] for record in self.events_on(date.fromordinal(ordinal))]
+
+
+# Parsed feeds on local disk, so a restarted bot starts with every calendar
+# it knew instead of downloading and parsing them all again. Files are
+# written by one background thread after each successful parse and replaced
+# atomically, a 304 only touches the file. Its mtime is therefore the last
+# time KUSSS confirmed the content. Loaded feeds share their events with
+# the other cached feeds, like freshly parsed ones.
+class FeedStore():
+    def __init__(self, directory=FEED_STORE_DIR, enabled=FEED_STORE, max_age_days=FEED_STORE_MAX_AGE_DAYS):
+        self.directory = directory
+        self.enabled = bool(enabled)
+        self.max_age_days = max_age_days
+        self._writer = None
+
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".feed")
+
+
+    def load(self, url):
+        # CacheEntry of the stored copy of url, or None
+        if not self.enabled:
+            return None
+        try:
+            # Files are a few KB, a mapping would hold a file descriptor per cached feed
+            with open(self.path(url), "rb") as file:
+                checked_at = os.fstat(file.fileno()).st_mtime
+                buffer = file.read()
+        except FileNotFoundError:
+            feed_store_loads.inc(result="miss")
+            return None
+        try:
+            index = StoredEventIndex(buffer)
+            metadata = index.metadata
+            if metadata["url"] != url:
+                raise ValueError("Stored feed belongs to another URL")
+            # Decodes every event, a damaged event table shows up here
+            entry = CacheEntry.from_store(url, index, metadata["etag"], metadata["last_modified"], metadata["digest"],
+                                          checked_at)
+        except Exception as e:
+            feed_store_loads.inc(result="corrupt")
+            logger.warning(f"Ignoring stored feed of {url}: {e}")
+            return None
+        feed_store_loads.inc(result="hit")
+        return entry
+
+
+    def _submit(self, func, *args):
+        # Returns right away, files are written in order on the store's thread
+        if not self.enabled:
+            return
+        if self._writer is None:
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="feed-store")
+        self._writer.submit(func, *args)
+
+
+    def save(self, entry):
+        self._submit(self._write, entry)
+
+
+    def touch(self, url):
+        # KUSSS confirmed the stored content is still current
+        self._submit(self._touch, self.path(url))
+
+
+    def _touch(self, path):
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+
+    def _write(self, entry):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            path = self.path(entry.url)
+            temporary = f"{path}.{os.getpid()}.tmp"
+            with open(temporary, "wb") as file:
+                file.write(encode(entry))
+            os.replace(temporary, path)
+            feed_store_writes.inc()
+        except Exception as e:
+            logger.error(f"Failed to store parsed feed {entry.url}: {e}")
+
+
+    def prune(self):
+        if not self.enabled or not os.path.isdir(self.directory):
+            return 0
+        cutoff = time.time() - self.max_age_days * 86400
+        removed = 0
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.remove(path)
+                    removed += 1
+            except OSError:
+                pass
+        if removed:
+            logger.info(f"Removed {removed} stored feeds not confirmed for {self.max_age_days} days.")
+        return removed
+
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.shutdown(wait=True)
+            self._writer = None
+
+
+feed_store = FeedStore()
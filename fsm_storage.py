@@ -0,0 +1,38 @@
+import json
+from aiogram.exceptions import DataNotDictLikeError
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+import async_db
+
+
+# FSM storage in the FSM_STATE table. MemoryStorage keeps a dialog in the
+# process that started it, behind a load-balanced webhook the next message
+# of the same user usually lands on another worker.
+class PostgresStorage(BaseStorage):
+    def __init__(self, key_builder=None):
+        self.key_builder = key_builder or DefaultKeyBuilder(with_destiny=True)
+
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        await async_db.set_fsm_state_DB(self.key_builder.build(key), state)
+
+
+    async def get_state(self, key):
+        record = await async_db.get_fsm_record_DB(self.key_builder.build(key))
+        return record[0] if record else None
+
+
+    async def set_data(self, key, data):
+        if not isinstance(data, dict):
+            raise DataNotDictLikeError(f"Data must be a dict or dict-like object, got {type(data).__name__}")
+        await async_db.set_fsm_data_DB(self.key_builder.build(key), json.dumps(data))
+
+
+    async def get_data(self, key):
+        record = await async_db.get_fsm_record_DB(self.key_builder.build(key))
+        return dict(record[1]) if record else {}
+
+
+    async def close(self):
+        pass
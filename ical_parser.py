@@ -0,0 +1,174 @@
+import io
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from event_index import EventRecord
+
+
+# Raised for feeds the fast parser doesn't understand, callers fall back to ics
+class UnsupportedFeed(Exception):
+    def __init__(self, message="Feed uses iCalendar features the fast parser doesn't support"):
+        super().__init__(message)
+
+
+# Properties of a VEVENT we keep, everything else is skipped without parsing
+WANTED_PROPERTIES = {"DTSTART", "DTEND", "SUMMARY", "LOCATION", "UID"}
+
+_timezones = {}
+
+
+def get_timezone(tzid):
+    tz = _timezones.get(tzid)
+    if tz is None:
+        try:
+            tz = ZoneInfo(tzid)
+        except (ZoneInfoNotFoundError, ValueError):
+            # Custom VTIMEZONE definitions are left to ics
+            raise UnsupportedFeed(f"Unknown TZID {tzid!r}")
+        _timezones[tzid] = tz
+    return tz
+
+
+def unfolded_lines(feed):
+    # Lines starting with a space or tab continue the previous one (RFC 5545 3.1)
+    if isinstance(feed, bytes):
+        feed = feed.decode("utf-8")
+    if isinstance(feed, str):
+        feed = io.StringIO(feed)
+
+    current = None
+    for line in feed:
+        line = line.rstrip("\r\n")
+        if line[:1] in (" ", "\t"):
+            if current is not None:
+                current += line[1:]
+            continue
+        if current is not None:
+            yield current
+        current = line
+    if current:
+        yield current
+
+
+def split_property(line):
+    # NAME;PARAM=VALUE;PARAM="QUOTED:VALUE":value
+    in_quotes = False
+    for position, char in enumerate(line):
+        if char == '"':
+            in_quotes = not in_quotes
+        elif char == ":" and not in_quotes:
+            head, value = line[:position], line[position + 1:]
+            break
+    else:
+        raise UnsupportedFeed(f"Malformed content line {line[:40]!r}")
+
+    name, *raw_params = head.split(";")
+    params = {}
+    for raw_param in raw_params:
+        key, _, param_value = raw_param.partition("=")
+        params[key.upper()] = param_value.strip('"')
+    return name.upper(), params, value
+
+
+def unescape_text(value):
+    if "\\" not in value:
+        return value
+    result = []
+    chars = iter(value)
+    for char in chars:
+        if char == "\\":
+            escaped = next(chars, "")
+            result.append("\n" if escaped in ("n", "N") else escaped)
+        else:
+            result.append(char)
+    return "".join(result)
+
+
+def parse_datetime(params, value):
+    # Mirrors ics: TZID is honoured, UTC ("Z") and floating times become UTC
+    if "T" not in value:
+        moment = datetime.strptime(value[:8], "%Y%m%d")
+    elif value.endswith(("Z", "z")):
+        return datetime.strptime(value[:15], "%Y%m%dT%H%M%S").replace(tzinfo=timezone.utc)
+    else:
+        moment = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+
+    tzid = params.get("TZID")
+    return moment.replace(tzinfo=get_timezone(tzid) if tzid else timezone.utc)
+
+
+def iter_events(feed, first_day=None, last_day=None):
+    """
+    Streams EventRecords out of a VCALENDAR, reading only DTSTART, DTEND,
+    SUMMARY, LOCATION and UID. Events starting outside [first_day, last_day] are
+    skipped before their text fields are decoded.
+    """
+    properties = None
+    depth = 0
+    in_calendar = False
+    for line in unfolded_lines(feed):
+        if line.startswith("BEGIN:"):
+            if line == "BEGIN:VCALENDAR":
+                in_calendar = True
+            elif line == "BEGIN:VEVENT":
+                properties = {}
+                depth = 0
+            elif properties is not None:
+                # Nested component such as VALARM
+                depth += 1
+            continue
+
+        if line.startswith("END:"):
+            if properties is not None:
+                if depth:
+                    depth -= 1
+                elif line == "END:VEVENT":
+                    record = build_record(properties, first_day, last_day)
+                    if record is not None:
+                        yield record
+                    properties = None
+            continue
+
+        if properties is None or depth:
+            continue
+        name = line.split(":", 1)[0].split(";", 1)[0].upper()
+        if name in WANTED_PROPERTIES:
+            if name in properties:
+                raise UnsupportedFeed(f"Repeated {name} in one event")
+            properties[name] = line
+        elif name in ("RRULE", "RDATE", "DURATION"):
+            raise UnsupportedFeed(f"{name} is not supported")
+
+    if not in_calendar:
+        # Not an iCalendar at all, let ics produce the error
+        raise UnsupportedFeed("No VCALENDAR found")
+    if properties is not None:
+        raise UnsupportedFeed("Unterminated VEVENT")
+
+
+def build_record(properties, first_day, last_day):
+    if "DTSTART" not in properties or "DTEND" not in properties:
+        raise UnsupportedFeed("Event without DTSTART/DTEND")
+
+    try:
+        _, params, value = split_property(properties["DTSTART"])
+        start = parse_datetime(params, value)
+        day = start.date()
+        if (first_day is not None and day < first_day) or (last_day is not None and day > last_day):
+            return None
+
+        _, params, value = split_property(properties["DTEND"])
+        end = parse_datetime(params, value)
+    except ValueError as e:
+        raise UnsupportedFeed(f"Unparseable date: {e}")
+    summary = location = uid = None
+    if "SUMMARY" in properties:
+        summary = unescape_text(split_property(properties["SUMMARY"])[2])
+    if "LOCATION" in properties:
+        location = unescape_text(split_property(properties["LOCATION"])[2])
+    if "UID" in properties:
+        uid = split_property(properties["UID"])[2]
+    return EventRecord.from_summary(start, end, summary, location, uid)
+
+
+def parse_events(feed, first_day=None, last_day=None):
+    return list(iter_events(feed, first_day, last_day))
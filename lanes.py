@@ -0,0 +1,104 @@
+import asyncio
+import time
+from contextvars import ContextVar
+import config
+from metrics import lane_queue_depth, lane_wait_seconds
+
+INTERACTIVE = "interactive"
+BULK = "bulk"
+
+# Longest an interactive request should wait for a fetch or parse slot,
+# beyond that the bulk lane is throttled
+INTERACTIVE_LATENCY_TARGET = config.get("INTERACTIVE_LATENCY_TARGET", 0.5, float)
+
+# Work started by a user's message is interactive. The daily dispatch, the
+# change watcher and background revalidations switch their tasks to the
+# bulk lane, tasks they start inherit it.
+_lane = ContextVar("lane", default=INTERACTIVE)
+
+
+def current_lane():
+    return _lane.get()
+
+
+def set_lane(lane):
+    # For the rest of the current task and the tasks it starts
+    _lane.set(lane)
+
+
+# Bounds the concurrent work of one stage (fetch, parse) and shares it between
+# the lanes. Interactive work may take every slot and is admitted before any
+# waiting bulk work, bulk work leaves `reserved` slots free for it but always
+# keeps at least one. When interactive work still waits longer than the
+# latency target, the bulk share is halved, and it grows back by one slot for
+# every bulk task that finishes while nothing interactive is waiting.
+class LaneLimiter():
+    def __init__(self, stage, limit, reserved, latency_target=INTERACTIVE_LATENCY_TARGET):
+        self.stage = stage
+        self.limit = limit
+        self.reserved = reserved
+        self.latency_target = latency_target
+        self.bulk_limit = self.bulk_share()
+        self.in_flight = {INTERACTIVE: 0, BULK: 0}
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+        self._last_throttle = 0.0
+        self._condition = asyncio.Condition()
+
+
+    def bulk_share(self):
+        return max(1, int(self.limit) - self.reserved)
+
+
+    def _admits(self, lane):
+        if self.in_flight[INTERACTIVE] + self.in_flight[BULK] >= int(self.limit):
+            return False
+        if lane == INTERACTIVE:
+            return True
+        return not self.waiting[INTERACTIVE] and self.in_flight[BULK] < min(self.bulk_limit, self.bulk_share())
+
+
+    async def acquire(self, lane=None):
+        """
+        Waits for a slot in the lane of the current task (or the given one)
+        and returns the lane, to be passed to release.
+        """
+        lane = lane or current_lane()
+        started = time.monotonic()
+        async with self._condition:
+            if not self._admits(lane):
+                self.waiting[lane] += 1
+                lane_queue_depth.inc(stage=self.stage, lane=lane)
+                try:
+                    await self._condition.wait_for(lambda: self._admits(lane))
+                finally:
+                    self.waiting[lane] -= 1
+                    lane_queue_depth.dec(stage=self.stage, lane=lane)
+                    # A cancelled interactive waiter may have been holding bulk work back
+                    self._condition.notify_all()
+            self.in_flight[lane] += 1
+            waited = time.monotonic() - started
+            if lane == INTERACTIVE and waited > self.latency_target:
+                self._throttle_bulk()
+        lane_wait_seconds.observe(waited, stage=self.stage, lane=lane)
+        return lane
+
+
+    def _throttle_bulk(self):
+        # At most once per latency target, like AdaptiveLimit
+        now = time.monotonic()
+        if now - self._last_throttle > self.latency_target:
+            self.bulk_limit = max(1, min(self.bulk_limit, self.bulk_share()) // 2)
+            self._last_throttle = now
+
+
+    def _release(self, lane):
+        # Called with the condition's lock held
+        self.in_flight[lane] -= 1
+        if lane == BULK and not self.waiting[INTERACTIVE]:
+            self.bulk_limit = min(self.bulk_limit + 1, self.bulk_share())
+        self._condition.notify_all()
+
+
+    async def release(self, lane):
+        async with self._condition:
+            self._release(lane)
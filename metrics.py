@@ -0,0 +1,187 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from aiohttp import web
+import config
+from custom_logging import logger
+
+METRICS_HOST = config.get("METRICS_HOST", "127.0.0.1")
+# 0 turns the endpoint off, the metrics are still collected
+METRICS_PORT = config.get("METRICS_PORT", 9108, int)
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+registry = []
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def format_labels(names, values, extra=()):
+    pairs = [f'{name}="{escape_label(value)}"' for name, value in zip(names, values)]
+    pairs += [f'{name}="{value}"' for name, value in extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+# Minimal Prometheus metrics. Recording is a dict update under a lock, the
+# text format is only built when /metrics is scraped.
+class Metric():
+    kind = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.labelnames)
+
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = list(self._values.items())
+        lines += self.samples(items)
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def samples(self, items):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+    def samples(self, items):
+        return [f"{self.name}{format_labels(self.labelnames, key)} {value}" for key, value in items]
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # Per-bucket counts (+Inf last), sum, count
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][bisect_left(self.buckets, value)] += 1
+            state[1] += value
+            state[2] += 1
+
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+
+    def samples(self, items):
+        lines = []
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, [('le', bound)])} {cumulative}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, key)} {count}")
+        return lines
+
+
+# Value read from somewhere else at scrape time, e.g. a cache's hit counter
+class Callback(Metric):
+    def __init__(self, name, help, kind, read):
+        super().__init__(name, help)
+        self.kind = kind
+        self.read = read
+
+
+    def expose(self):
+        return f"# HELP {self.name} {self.help}\n# TYPE {self.name} {self.kind}\n{self.name} {self.read()}"
+
+
+feed_fetch_seconds = Histogram("bot_feed_fetch_seconds", "Time to download a calendar feed", ["status"])
+feed_fetch_bytes = Counter("bot_feed_fetch_bytes_total", "Bytes of calendar feeds downloaded")
+feed_fetch_errors = Counter("bot_feed_fetch_errors_total", "Failed feed downloads by cause", ["kind"])
+feed_circuit_opened = Counter("bot_feed_circuit_opened_total", "Times a feed host's circuit breaker opened")
+feed_store_loads = Counter("bot_feed_store_loads_total", "Lookups of parsed feeds in the on-disk store", ["result"])
+feed_store_writes = Counter("bot_feed_store_writes_total", "Parsed feeds written to the on-disk store")
+stale_schedules = Counter("bot_stale_schedules_total", "Schedules rendered from a cached feed while KUSSS was unavailable")
+parse_seconds = Histogram("bot_parse_seconds", "Time to parse a calendar feed", ["where"])
+render_seconds = Histogram("bot_render_seconds", "Time to render a schedule message")
+db_query_seconds = Histogram("bot_db_query_seconds", "Time spent in a db_interaction function", ["function"])
+send_seconds = Histogram("bot_telegram_send_seconds", "Duration of a sendMessage call")
+send_errors = Counter("bot_telegram_send_errors_total", "Failed sendMessage calls", ["reason"])
+send_retries = Counter("bot_telegram_send_retries_total", "sendMessage calls that were retried")
+change_polls = Counter("bot_change_polls_total", "Feed polls for change detection by outcome", ["result"])
+change_notifications = Counter("bot_change_notifications_total", "Change notifications handed to the delivery pipeline")
+lane_queue_depth = Gauge("bot_lane_queue_depth", "Work waiting for a fetch, parse or send slot, by lane", ["stage", "lane"])
+lane_wait_seconds = Histogram("bot_lane_wait_seconds", "Time work waited for a fetch, parse or send slot, by lane",
+                              ["stage", "lane"])
+update_seconds = Histogram("bot_update_seconds", "Time to handle a Telegram update, waiting for a free slot included")
+dispatch_lag_seconds = Histogram("bot_dispatch_lag_seconds", "Time from a user's display time until the message was sent",
+                                 buckets=LAG_BUCKETS)
+
+
+def expose():
+    return "\n".join(metric.expose() for metric in registry) + "\n"
+
+
+async def handle_metrics(request):
+    return web.Response(text=expose(), headers={
+        "Content-Type": "text/plain; version=0.0.4; charset=utf-8",
+        "Cache-Control": "no-store",
+    })
+
+
+async def start_metrics_server(host=METRICS_HOST, port=METRICS_PORT):
+    if not port:
+        return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+    except OSError as e:
+        # e.g. a second worker on the same host, it keeps running without the endpoint
+        logger.warning(f"Metrics endpoint not started on {host}:{port}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"Metrics served on http://{host}:{port}/metrics")
+    return runner
@@ -0,0 +1,128 @@
+import asyncio
+import multiprocessing
+import os
+import sys
+import types
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor
+import config
+from event_index import EventIndex
+from ical_parser import parse_events, UnsupportedFeed
+from custom_logging import logger, db_handler
+from lanes import LaneLimiter
+from metrics import parse_seconds
+
+# 0 parses every feed inline on the event loop
+PARSE_POOL_SIZE = config.get("PARSE_POOL_SIZE", os.cpu_count() or 1, int)
+# Smaller feeds parse faster inline than the round trip to a worker takes
+PARSE_POOL_MIN_BYTES = config.get("PARSE_POOL_MIN_BYTES", 32 * 1024, int)
+# Workers the daily dispatch leaves to users' commands, bulk parsing keeps at least one
+PARSE_POOL_RESERVED = config.get("PARSE_POOL_RESERVED", 1, int)
+
+
+def parse_feed(feed, first_day=None, last_day=None):
+    """
+    Turns raw feed bytes (or text) into an EventIndex, restricted to events
+    starting in [first_day, last_day] when given. Returns the index and the
+    reason the ics fallback had to be used, or None. Runs in the worker
+    processes, so it must stay a picklable module-level function.
+    """
+    try:
+        return EventIndex(parse_events(feed, first_day, last_day)), None
+    except UnsupportedFeed as e:
+        # ics and arrow take a while to import and most feeds never need them
+        from ics import Calendar
+        if isinstance(feed, bytes):
+            feed = feed.decode("utf-8")
+        return EventIndex.from_calendar(Calendar(feed)), str(e)
+
+
+def init_worker():
+    # Workers don't log, and on exit must not write "Bot stopped" to bot_logs
+    logger.removeHandler(db_handler)
+    db_handler.close()
+
+
+def warm_up():
+    # The imports above already ran by the time this is called
+    return os.getpid()
+
+
+@contextmanager
+def bare_main():
+    # Spawned processes import the parent's main script as __mp_main__, for
+    # the bot that is aiogram, the handlers and the database modules, about
+    # 130 MB and seconds of imports per worker. Workers started while
+    # __main__ is a module without a file only import what they unpickle.
+    main = sys.modules["__main__"]
+    sys.modules["__main__"] = types.ModuleType("__main__")
+    try:
+        yield
+    finally:
+        sys.modules["__main__"] = main
+
+
+# Process pool for parsing, so a large feed keeps one core busy instead of
+# the event loop and parse throughput grows with the number of cores.
+# Feeds are only handed to the executor when a worker is free, so the
+# executor's own FIFO queue stays empty and the lanes decide who goes next.
+class ParsePool():
+    def __init__(self, size=PARSE_POOL_SIZE, min_bytes=PARSE_POOL_MIN_BYTES, reserved=PARSE_POOL_RESERVED):
+        self.size = size
+        self.min_bytes = min_bytes
+        self.reserved = reserved
+        self.slots = None
+        self.offloaded = 0
+        self.inline = 0
+        self.worker_pids = set()
+        self._executor = None
+
+
+    async def start(self):
+        if self.size <= 0 or self._executor is not None:
+            return
+        # parse() hands feeds to the executor as soon as it is set, during the warm-up too
+        self.slots = LaneLimiter("parse", self.size, self.reserved)
+        # Forking the bot would copy its threads' locks, start the workers fresh
+        self._executor = ProcessPoolExecutor(max_workers=self.size, mp_context=multiprocessing.get_context("spawn"),
+                                             initializer=init_worker)
+        # Workers are created on demand, by submit(). One task per worker
+        # starts them all here, and has their imports done before the first
+        # feed arrives.
+        with bare_main():
+            warm_ups = [self._executor.submit(warm_up) for _ in range(self.size)]
+        pids = await asyncio.gather(*(asyncio.wrap_future(future) for future in warm_ups))
+        self.worker_pids = set(pids)
+        logger.info(f"Parse pool started with {len(self.worker_pids)} worker processes.")
+
+
+    async def parse(self, feed, first_day=None, last_day=None):
+        if self._executor is None or len(feed) < self.min_bytes:
+            self.inline += 1
+            with parse_seconds.time(where="inline"):
+                event_index, fallback = parse_feed(feed, first_day, last_day)
+        else:
+            self.offloaded += 1
+            loop = asyncio.get_running_loop()
+            # Includes the wait for a free worker and the transfer of the result
+            with parse_seconds.time(where="pool"):
+                lane = await self.slots.acquire()
+                try:
+                    event_index, fallback = await loop.run_in_executor(self._executor, parse_feed, feed,
+                                                                       first_day, last_day)
+                finally:
+                    await self.slots.release(lane)
+        if fallback is not None:
+            logger.info(f"Falling back to ics parser: {fallback}")
+        return event_index
+
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+            self.worker_pids = set()
+            logger.info(f"Parse pool stopped ({self.offloaded} feeds parsed in workers, {self.inline} inline).")
+
+
+parse_pool = ParsePool()
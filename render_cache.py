@@ -0,0 +1,60 @@
+import threading
+from collections import OrderedDict
+import config
+from metrics import Callback
+
+RENDER_CACHE_MAX_ENTRIES = config.get("RENDER_CACHE_MAX_ENTRIES", 4096, int)
+
+
+# LRU cache of finished schedule messages keyed by (feed digest, date,
+# tomorrow). The message only depends on the feed content and the date, so
+# every user of a feed, and every /get_today_schedule, reuses one rendering
+# until the feed changes.
+class RenderCache():
+    def __init__(self, max_entries=RENDER_CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._messages = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def get(self, digest, current_date, tomorrow):
+        key = (digest, current_date, tomorrow)
+        with self._lock:
+            message = self._messages.get(key)
+            if message is None:
+                self.misses += 1
+                return None
+            self._messages.move_to_end(key)
+            self.hits += 1
+            return message
+
+
+    def put(self, digest, current_date, tomorrow, message):
+        with self._lock:
+            self._messages[(digest, current_date, tomorrow)] = message
+            self._messages.move_to_end((digest, current_date, tomorrow))
+            while len(self._messages) > self.max_entries:
+                self._messages.popitem(last=False)
+
+
+    def clear(self):
+        with self._lock:
+            self._messages.clear()
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._messages),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+        }
+
+
+render_cache = RenderCache()
+
+Callback("bot_render_cache_hits_total", "Schedule messages served from the render cache", "counter", lambda: render_cache.hits)
+Callback("bot_render_cache_misses_total", "Schedule messages rendered", "counter", lambda: render_cache.misses)
@@ -0,0 +1,107 @@
+"""
+POSTs Telegram updates to a locally running webhook the way Telegram does,
+and reports how fast they were acknowledged.
+
+    BOT_MODE=webhook WEBHOOK_SECRET=local TELEGRAM_API_URL=http://127.0.0.1:8081 python bot.py
+    python replay_updates.py recorded_updates.jsonl --secret local --concurrency 40
+    python replay_updates.py --synthetic 2000 --secret local
+
+The updates file holds a JSON list of updates or one update per line, e.g.
+saved from getUpdates. With TELEGRAM_API_URL pointing at a stand-in, the
+replies of the handlers don't reach real chats.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from collections import Counter
+import aiohttp
+import config
+from benchmark import percentile
+
+WEBHOOK_HOST = config.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = config.get("WEBHOOK_PORT", 8080, int)
+WEBHOOK_PATH = config.get("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = config.get("WEBHOOK_SECRET")
+
+COMMANDS = ["/help", "/start", "/get_today_schedule", "/update_time"]
+
+
+def load_updates(path):
+    with open(path, encoding="utf-8") as file:
+        text = file.read().strip()
+    if text.startswith("["):
+        return json.loads(text)
+    return [json.loads(line) for line in text.splitlines() if line.strip()]
+
+
+def synthetic_updates(count):
+    # Messages from count different users, as after an announcement in a course chat
+    updates = []
+    for number in range(count):
+        user_id = 10_000_000 + number
+        text = COMMANDS[number % len(COMMANDS)]
+        updates.append({
+            "update_id": number,
+            "message": {
+                "message_id": number,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private", "first_name": "Student"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "Student"},
+                "text": text,
+                "entities": [{"type": "bot_command", "offset": 0, "length": len(text)}],
+            },
+        })
+    return updates
+
+
+async def replay(url, secret, updates, concurrency):
+    slots = asyncio.Semaphore(concurrency)
+    update_ids = itertools.count(int(time.time()))
+    statuses = Counter()
+    durations = []
+
+    async def post(session, update):
+        # Fresh ids, so replaying the same file twice looks like new updates
+        update = dict(update, update_id=next(update_ids))
+        async with slots:
+            started = time.perf_counter()
+            async with session.post(url, json=update, headers={"X-Telegram-Bot-Api-Secret-Token": secret or ""}) as response:
+                await response.read()
+            durations.append(time.perf_counter() - started)
+            statuses[response.status] += 1
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(post(session, update) for update in updates))
+    elapsed = time.perf_counter() - started
+    return {
+        "updates": len(updates),
+        "statuses": {str(status): count for status, count in sorted(statuses.items())},
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(len(updates) / elapsed, 2) if elapsed else None,
+        "ack_p50_ms": round(percentile(durations, 0.5) * 1000, 3) if durations else None,
+        "ack_p99_ms": round(percentile(durations, 0.99) * 1000, 3) if durations else None,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("updates", nargs="?", help="file with recorded updates")
+    parser.add_argument("--synthetic", type=int, default=0, help="send this many generated command messages instead")
+    parser.add_argument("--repeat", type=int, default=1, help="send the updates this many times")
+    parser.add_argument("--concurrency", type=int, default=40, help="parallel connections, like max_connections")
+    parser.add_argument("--url", default=f"http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+    parser.add_argument("--secret", default=WEBHOOK_SECRET)
+    args = parser.parse_args()
+    if not args.updates and not args.synthetic:
+        parser.error("pass an updates file or --synthetic N")
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    updates = synthetic_updates(args.synthetic) if args.synthetic else load_updates(args.updates)
+    result = asyncio.run(replay(args.url, args.secret, updates * args.repeat, args.concurrency))
+    print(json.dumps(result, indent=2))
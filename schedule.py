@@ -1,12 +1,25 @@
+import time
 from datetime import datetime
 from datetime import timedelta
 import pytz
-import requests
-from ics import Calendar
-from dotenv import load_dotenv
+import config
 from custom_logging import *
+from feed_fetcher import (feed_fetcher, FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT, INVALID_URL_STATUSES,
+                          InvalidFeedURL, UpstreamUnavailable)
+from calendar_cache import calendar_cache
+from feed_store import feed_store
+from render_cache import render_cache
+from metrics import parse_seconds, render_seconds, stale_schedules
+from parse_pool import parse_pool, parse_feed
+from lanes import BULK, set_lane
+import asyncio
 
-load_dotenv()
+# Feeds restored from the feed store younger than this are served right away
+# after a restart and revalidated in the background
+FEED_STORE_SERVE_STALE = config.get("FEED_STORE_SERVE_STALE", 3600, float)
+
+# Background revalidations of restored feeds by URL
+_revalidations = {}
 
 
 # Custom exceptions
@@ -15,10 +28,11 @@ class IncorrectCalendarURL(Exception):
         super().__init__(message)
 
 
-def get_current_date(time=False):
-    # Define CET timezone
-    cet_timezone = pytz.timezone("Europe/Berlin")
+# Define CET timezone
+cet_timezone = pytz.timezone("Europe/Berlin")
+
 
+def get_current_date(time=False):
     # Get current time in CET
     if time:
         current_cet_date = datetime.now(cet_timezone)
@@ -29,108 +43,219 @@ def get_current_date(time=False):
 
 
 class Schedule():
-    def __init__(self):
-        self.current_date = get_current_date()
+    def __init__(self, current_date=None):
+        self.current_date = current_date or get_current_date()
+
+
+    def parse_feed(self, feed):
+        with parse_seconds.time(where="inline"):
+            event_index, fallback = parse_feed(feed)
+        if fallback is not None:
+            logger.info(f"Falling back to ics parser: {fallback}")
+        return event_index
+
+
+    # Both paths raise IncorrectCalendarURL when the URL is at fault and
+    # UpstreamUnavailable when KUSSS is, only the latter is worth retrying
+    def url_to_cache_entry(self, url):
+        # Only scripts use the blocking path, the bot doesn't need requests
+        import requests
+        cached = self.cached_entry(url)
+        if cached is not None and calendar_cache.is_fresh(cached):
+            calendar_cache.record_hit()
+            return cached
+        try:
+            response = requests.get(url, headers=calendar_cache.conditional_headers(cached),
+                                    timeout=(FEED_CONNECT_TIMEOUT, FEED_READ_TIMEOUT))
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise UpstreamUnavailable(f"Calendar server failed: {e!r}")
+        except requests.RequestException:
+            raise IncorrectCalendarURL
+        if response.status_code == 304 and cached is not None:
+            calendar_cache.record_revalidation(cached)
+            feed_store.touch(url)
+            return cached
+        if response.status_code in INVALID_URL_STATUSES:
+            raise IncorrectCalendarURL
+        if response.status_code >= 400:
+            raise UpstreamUnavailable(f"Calendar server answered {response.status_code}")
+        try:
+            event_index = self.parse_feed(response.content)
+        except Exception:
+            raise self.unparseable(url, cached)
+        entry = calendar_cache.put(url, response.content, event_index,
+                                   response.headers.get("ETag"), response.headers.get("Last-Modified"))
+        feed_store.save(entry)
+        return entry
+
 
+    async def url_to_cache_entry_async(self, url):
+        cached = self.cached_entry(url)
+        if cached is not None and calendar_cache.is_fresh(cached):
+            calendar_cache.record_hit()
+            return cached
+        if cached is not None and cached.restored and time.time() - cached.checked_at < FEED_STORE_SERVE_STALE:
+            # Warm copy from before a restart, answer now and ask KUSSS meanwhile
+            calendar_cache.record_hit()
+            self.revalidate_in_background(url, cached)
+            return cached
+        return await self.fetch_cache_entry(url, cached)
 
-    def url_to_calendar(self, url):
+
+    async def fetch_cache_entry(self, url, cached):
         try:
-            response = requests.get(url)
-            calendar = Calendar(response.text)
-            return calendar
-        except:
+            response = await feed_fetcher.fetch(url, calendar_cache.conditional_headers(cached))
+        except InvalidFeedURL:
             raise IncorrectCalendarURL
+        if response.status == 304 and cached is not None:
+            calendar_cache.record_revalidation(cached)
+            feed_store.touch(url)
+            return cached
+        try:
+            event_index = await parse_pool.parse(response.body)
+        except Exception:
+            raise self.unparseable(url, cached)
+        entry = calendar_cache.put(url, response.body, event_index, response.etag, response.last_modified)
+        feed_store.save(entry)
+        return entry
 
 
-    def get_today_events(self, current_date, calendar):
-        today_events = []
+    def cached_entry(self, url):
+        # After a restart feeds come back from the feed store instead of KUSSS
+        cached = calendar_cache.get(url)
+        if cached is None:
+            cached = feed_store.load(url)
+            if cached is not None:
+                calendar_cache.add(cached)
+        return cached
+
+
+    def revalidate_in_background(self, url, cached):
+        if url in _revalidations:
+            return
+        task = asyncio.ensure_future(self.revalidate(url, cached))
+        _revalidations[url] = task
+        task.add_done_callback(lambda _: _revalidations.pop(url, None))
+
+
+    async def revalidate(self, url, cached):
+        # Nobody is waiting for the answer
+        set_lane(BULK)
+        try:
+            await self.fetch_cache_entry(url, cached)
+        except Exception as e:
+            logger.warning(f"Failed to revalidate restored feed {url}: {e!r}")
 
-        for event in calendar.events:
-            calendar_date = event.begin.date()
-            if calendar_date==current_date:
-                today_events.append(event)
 
-        # Sorting events by time, from earliest
-        today_events = sorted(today_events, key=lambda event: event.begin)
-        
-        return today_events
-    
-    def get_tomorrow_events(self, current_date, calendar):
-        tomorrow_events = []
+    def unparseable(self, url, cached):
+        # A URL that served a calendar before is more likely to get an error
+        # page from an overloaded KUSSS than to have turned invalid
+        if cached is not None:
+            return UpstreamUnavailable(f"{url} didn't return a calendar")
+        return IncorrectCalendarURL()
 
+
+    def get_today_events(self, current_date, event_index):
+        return event_index.events_on(current_date)
+
+
+    def get_tomorrow_events(self, current_date, event_index):
         # Calculate tomorrow's date
         tomorrow_date = current_date + timedelta(days=1)
+        return event_index.events_on(tomorrow_date)
+
+
+    def get_daily_schedule(self, url, tomorrow=True):
+        try:
+            entry = self.url_to_cache_entry(url)
+        except UpstreamUnavailable as e:
+            return self.render_stale(url, e, tomorrow)
+        return self.render(entry, tomorrow)
 
-        for event in calendar.events:
-            calendar_date = event.begin.date()
-            if calendar_date == tomorrow_date:
-                tomorrow_events.append(event)
 
-        # Sorting events by time, from earliest
-        tomorrow_events = sorted(tomorrow_events, key=lambda event: event.begin)
+    async def get_daily_schedule_async(self, url, tomorrow=True):
+        try:
+            entry = await self.url_to_cache_entry_async(url)
+        except UpstreamUnavailable as e:
+            return self.render_stale(url, e, tomorrow)
+        return self.render(entry, tomorrow)
 
-        return tomorrow_events
 
+    def render_stale(self, url, error, tomorrow=True):
+        # While KUSSS is down the last copy we have beats no message at all
+        entry = calendar_cache.get(url)
+        if entry is None:
+            raise error
+        stale_schedules.inc()
+        logger.warning(f"Serving cached schedule for {url}: {error}")
+        checked_at = datetime.fromtimestamp(entry.checked_at, cet_timezone)
+        notice = (
+            "⚠️ KUSSS can't be reached right now, this schedule is from "
+            f"{checked_at:%d.%m %H:%M} and may be outdated.\n\n"
+        )
+        return notice + self.render(entry, tomorrow)
 
-    def get_daily_schedule(self, url, tomorrow=True):
-        calendar = self.url_to_calendar(url)
-        logger.info("Retrieving tomorrow events")
+
+    def render(self, entry, tomorrow=True):
+        message = render_cache.get(entry.digest, self.current_date, tomorrow)
+        if message is None:
+            with render_seconds.time():
+                message = self.events_to_schedule(entry.parsed, tomorrow)
+            render_cache.put(entry.digest, self.current_date, tomorrow, message)
+        return message
+
+
+    async def get_daily_schedules_async(self, urls, tomorrow=True):
+        # Fetches all feeds concurrently, returns {url: message or exception}
+        unique_urls = list(dict.fromkeys(urls))
+        results = await asyncio.gather(*(self.get_daily_schedule_async(url, tomorrow) for url in unique_urls),
+                                       return_exceptions=True)
+        schedules = dict(zip(unique_urls, results))
+        for url, schedule in schedules.items():
+            if isinstance(schedule, Exception):
+                logger.error(f"Failed to build schedule for {url}: {schedule!r}")
+        return schedules
+
+
+    def events_to_schedule(self, event_index, tomorrow=True):
         if tomorrow:
-            events = self.get_tomorrow_events(self.current_date, calendar)
+            events = self.get_tomorrow_events(self.current_date, event_index)
             current_date = self.current_date + timedelta(days=1)
         else:
-            events = self.get_today_events(self.current_date, calendar)
+            events = self.get_today_events(self.current_date, event_index)
             current_date = self.current_date
-        logger.info(f"Retrieved events: {events}")
+        logger.info(f"Rendering schedule for {current_date} with {len(events)} events")
         if len(events) > 0:
-            # Template for the header
-            header_template = (
+            header = (
                 "📅 Servus!\n"
                 f"Here’s your schedule for {current_date}:\n\n"
             )
-            
-            # Template for each event (subject/class)
-            event_template = (
-                "━━━━━━━━━━━━━━━━━━\n"
-                "🎯 Subject: {course_title}\n"
-                "👨‍🏫 Instructor: {instructor}\n"
-                "🗓 Time: {start_time} – {end_time}\n"
-                "🏫 Room: {location}\n"
-            )
-            
-            # Start the message with the header
-            message = header_template.format(current_date=self.current_date)
-            
-            # Add each event to the message
-            for event in events:
-                # Extract details from ICS event
-                summary = event.name  # e.g. "KV Responsible AI / Martina Mara / (510101/2024W)"
-                parts = summary.split(" / ")
-                
-                if len(parts) >= 2:
-                    course_title = parts[0].strip()
-                    instructor = parts[1].strip()
-                else:
-                    # If the format is different or incomplete
-                    course_title = summary.strip()
-                    instructor = "N/A"
-                
-                start_time = event.begin.format('HH:mm')
-                end_time = event.end.format('HH:mm')
-                location = event.location if event.location else "N/A"
-                
-                message += event_template.format(
-                    course_title=course_title,
-                    instructor=instructor,
-                    start_time=start_time,
-                    end_time=end_time,
-                    location=location
-                )
-            logger.info(f"Returning message")
-            return message
+            return header + "".join(event_fragment(event) for event in events)
         else:
-            logger.info(f"Returning message")
             if tomorrow:
                 return "No events scheduled for tomorrow. Enjoy your day! 🌟"
             else:
-                return "No events scheduled for today. Enjoy your day! 🌟"
\ No newline at end of file
+                return "No events scheduled for today. Enjoy your day! 🌟"
+
+
+# Template for each event (subject/class)
+EVENT_TEMPLATE = (
+    "━━━━━━━━━━━━━━━━━━\n"
+    "🎯 Subject: {course_title}\n"
+    "👨‍🏫 Instructor: {instructor}\n"
+    "🗓 Time: {start_time} – {end_time}\n"
+    "🏫 Room: {location}\n"
+)
+
+
+def event_fragment(event):
+    # Formatted once per event and reused by every message the event appears in
+    if event.fragment is None:
+        event.fragment = EVENT_TEMPLATE.format(
+            course_title=event.title,
+            instructor=event.instructor,
+            start_time=event.start.strftime('%H:%M'),
+            end_time=event.end.strftime('%H:%M'),
+            location=event.location
+        )
+    return event.fragment
@@ -0,0 +1,240 @@
+import asyncio
+import time
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import SendMessage
+import config
+from custom_logging import logger
+from lanes import INTERACTIVE, BULK, current_lane, set_lane
+from metrics import send_seconds, send_errors, send_retries, lane_queue_depth, lane_wait_seconds
+
+# Telegram allows roughly 30 messages per second overall and 1 per second per chat
+TELEGRAM_GLOBAL_RATE = config.get("TELEGRAM_GLOBAL_RATE", 30, float)
+TELEGRAM_PER_CHAT_INTERVAL = config.get("TELEGRAM_PER_CHAT_INTERVAL", 1, float)
+TELEGRAM_SEND_WORKERS = config.get("TELEGRAM_SEND_WORKERS", 8, int)
+TELEGRAM_SEND_RETRIES = config.get("TELEGRAM_SEND_RETRIES", 5, int)
+# Tokens bulk sends leave in the bucket, so replies to commands go out at once
+TELEGRAM_INTERACTIVE_RESERVE = config.get("TELEGRAM_INTERACTIVE_RESERVE", 3, float)
+
+# Bad requests that mean the chat is gone for good
+DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "bot was kicked")
+
+
+# Telegram's rate budget, shared by the delivery pipeline (bulk) and the
+# replies of the handlers (interactive). A bulk send only takes a token while
+# `reserved` more are left and nothing interactive is waiting, so the bulk
+# lane still gets the whole rate under load while replies don't queue behind it.
+class TokenBucket():
+    def __init__(self, rate, capacity=None, reserved=TELEGRAM_INTERACTIVE_RESERVE):
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.reserved = min(reserved, self.capacity - 1)
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0
+        self.waiting = {INTERACTIVE: 0, BULK: 0}
+
+
+    def pause(self, seconds):
+        # Flood control applies to the whole bot, so every sender backs off
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+    async def acquire(self, lane=BULK):
+        started = time.monotonic()
+        self.waiting[lane] += 1
+        lane_queue_depth.inc(stage="send", lane=lane)
+        try:
+            while True:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    await asyncio.sleep(self.paused_until - now)
+                    continue
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+                self.updated_at = now
+                needed = 1 if lane == INTERACTIVE else 1 + self.reserved
+                if self.tokens >= needed and (lane == INTERACTIVE or not self.waiting[INTERACTIVE]):
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep(max(needed - self.tokens, 0.1) / self.rate)
+        finally:
+            self.waiting[lane] -= 1
+            lane_queue_depth.dec(stage="send", lane=lane)
+            lane_wait_seconds.observe(time.monotonic() - started, stage="send", lane=lane)
+
+
+# Charges the messages handlers send straight through the bot, e.g.
+# message.reply, to the pipeline's bucket in the interactive lane. Bulk
+# messages go through the pipeline, which takes their tokens itself.
+class InteractiveSendBudget(BaseRequestMiddleware):
+    def __init__(self, bucket):
+        self.bucket = bucket
+
+
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, SendMessage) and current_lane() == INTERACTIVE:
+            await self.bucket.acquire(INTERACTIVE)
+        return await make_request(bot, method)
+
+
+class Delivery():
+    __slots__ = ("chat_id", "text", "attempts", "error", "sent_at", "future")
+
+    def __init__(self, chat_id, text, future):
+        self.chat_id = chat_id
+        self.text = text
+        self.attempts = 0
+        self.error = None
+        self.sent_at = None
+        self.future = future
+
+
+# Outbound message pipeline: a bounded pool of workers sends queued messages
+# through a shared token bucket, retries flood-control and network errors,
+# and dead-letters chats that blocked or deleted the bot.
+class DeliveryPipeline():
+    def __init__(self, workers=TELEGRAM_SEND_WORKERS, global_rate=TELEGRAM_GLOBAL_RATE,
+                 per_chat_interval=TELEGRAM_PER_CHAT_INTERVAL, max_retries=TELEGRAM_SEND_RETRIES,
+                 on_dead_letter=None):
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self.max_retries = max_retries
+        self.on_dead_letter = on_dead_letter
+        self.bucket = TokenBucket(global_rate)
+        self.dead_letters = {}
+        self.sent = 0
+        self.failed = 0
+        self.retries = 0
+        self._last_chat_send = {}
+        self._queue = None
+        self._tasks = []
+        self._bot = None
+
+
+    def start(self, bot):
+        self._bot = bot
+        self._queue = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        logger.info(f"Delivery pipeline started with {self.workers} workers.")
+
+
+    async def stop(self):
+        # Let queued messages go out before the workers are cancelled
+        if self._queue is not None:
+            await self._queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+
+    async def deliver(self, messages):
+        """
+        Queues (chat_id, text) pairs and waits until each one is sent or given up.
+        Returns the Delivery objects, error is None for the ones that went out.
+        """
+        loop = asyncio.get_running_loop()
+        deliveries = [Delivery(chat_id, text, loop.create_future()) for chat_id, text in messages]
+        for delivery in deliveries:
+            self._queue.put_nowait(delivery)
+        await asyncio.gather(*(delivery.future for delivery in deliveries), return_exceptions=True)
+        return deliveries
+
+
+    async def _worker(self):
+        set_lane(BULK)
+        while True:
+            delivery = await self._queue.get()
+            try:
+                await self._send(delivery)
+            except Exception as e:
+                # One bad delivery mustn't take the worker down, stop() waits for the queue
+                logger.error(f"Delivery to {delivery.chat_id} failed unexpectedly: {e!r}")
+            finally:
+                self._queue.task_done()
+
+
+    async def _wait_for_chat(self, chat_id):
+        last_send = self._last_chat_send.get(chat_id)
+        if last_send is not None:
+            delay = last_send + self.per_chat_interval - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        self._last_chat_send[chat_id] = time.monotonic()
+
+        # Forget chats that are past their interval so the map stays small
+        if len(self._last_chat_send) > 10000:
+            cutoff = time.monotonic() - self.per_chat_interval
+            self._last_chat_send = {chat: sent_at for chat, sent_at in self._last_chat_send.items() if sent_at > cutoff}
+
+
+    async def _send(self, delivery):
+        while True:
+            delivery.attempts += 1
+            await self._wait_for_chat(delivery.chat_id)
+            await self.bucket.acquire(BULK)
+            try:
+                with send_seconds.time():
+                    await self._bot.send_message(delivery.chat_id, delivery.text)
+                self.sent += 1
+                delivery.sent_at = time.time()
+                # Cancelled when whoever waited for it was cancelled, the message still went out
+                if not delivery.future.done():
+                    delivery.future.set_result(None)
+                return
+
+            except TelegramRetryAfter as e:
+                send_errors.inc(reason="flood_control")
+                logger.warning(f"Flood control while sending to {delivery.chat_id}, retrying in {e.retry_after}s.")
+                self.bucket.pause(e.retry_after)
+                error = e
+
+            except (TelegramNetworkError, TelegramServerError) as e:
+                send_errors.inc(reason="network" if isinstance(e, TelegramNetworkError) else "server")
+                logger.warning(f"Transient error while sending to {delivery.chat_id} (attempt {delivery.attempts}): {e}")
+                await asyncio.sleep(min(2 ** delivery.attempts, 60))
+                error = e
+
+            except (TelegramForbiddenError, TelegramBadRequest) as e:
+                send_errors.inc(reason="forbidden" if isinstance(e, TelegramForbiddenError) else "bad_request")
+                if isinstance(e, TelegramForbiddenError) or any(reason in str(e).lower() for reason in DEAD_CHAT_ERRORS):
+                    await self._dead_letter(delivery, e)
+                    return
+                self._fail(delivery, e)
+                return
+
+            except Exception as e:
+                send_errors.inc(reason="other")
+                self._fail(delivery, e)
+                return
+
+            if delivery.attempts > self.max_retries:
+                self._fail(delivery, error)
+                return
+            self.retries += 1
+            send_retries.inc()
+
+
+    def _fail(self, delivery, error):
+        self.failed += 1
+        logger.error(f"Failed to send message to {delivery.chat_id}: {error}")
+        delivery.error = error
+        if not delivery.future.done():
+            delivery.future.set_exception(error)
+
+
+    async def _dead_letter(self, delivery, error):
+        logger.warning(f"Chat {delivery.chat_id} is unreachable, deactivating it: {error}")
+        self.dead_letters[delivery.chat_id] = str(error)
+        if self.on_dead_letter is not None:
+            try:
+                await self.on_dead_letter(delivery.chat_id)
+            except Exception as e:
+                logger.error(f"Failed to deactivate chat {delivery.chat_id}: {e}")
+        self._fail(delivery, error)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# The bot's modules live in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from custom_logging import logger, db_handler
+
+# Tests don't log to PostgreSQL, and on exit mustn't write "Bot stopped" to bot_logs
+logger.removeHandler(db_handler)
+db_handler.close()
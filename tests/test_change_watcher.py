@@ -0,0 +1,82 @@
+"""
+Changes between two parsed snapshots of a feed: which events count as
+added, removed or changed, and how they are described.
+"""
+import json
+from datetime import date, datetime
+import pytest
+from change_watcher import describe, diff_snapshots, snapshot_events
+from parse_pool import parse_feed
+from schedule import cet_timezone
+
+NOW = cet_timezone.localize(datetime(2024, 10, 21, 12, 0))
+# The old snapshot was taken on Friday with a one week window
+OLD_WINDOW_END = date(2024, 10, 25)
+
+# uid: (start, end, summary, location) in UTC
+OLD = {
+    "same": ("20241022T063000Z", "20241022T080000Z", "KV Responsible AI / Martina Mara / (510101/2024W)", "HS 1"),
+    "cancelled": ("20241023T081500Z", "20241023T094500Z", "VL Formal Models / Armin Biere / (342201/2024W)", "S3 048"),
+    "moved": ("20241022T100000Z", "20241022T113000Z", "UE Hands-on AI I / Bernhard Nessler / (365051/2024W)", "HS 18"),
+    "room": ("20241022T120000Z", "20241022T133000Z", "VL Algorithms / Ana Costa / (351001/2024W)", "HS 1"),
+    "instructor": ("20241024T063000Z", "20241024T080000Z", "UE Algorithms / Ana Costa / (351002/2024W)", "S2 046"),
+    "over": ("20241021T063000Z", "20241021T080000Z", "VL Statistics / Jan Novak / (366001/2024W)", "HS 3"),
+}
+NEW = {
+    "same": OLD["same"],
+    "moved": ("20241024T100000Z", "20241024T113000Z", "UE Hands-on AI I / Bernhard Nessler / (365051/2024W)", "HS 18"),
+    "room": ("20241022T120000Z", "20241022T133000Z", "VL Algorithms / Ana Costa / (351001/2024W)", "HS 2"),
+    "instructor": ("20241024T063000Z", "20241024T080000Z", "UE Algorithms / Lea Berger / (351002/2024W)", "S2 046"),
+    "added": ("20241024T140000Z", "20241024T153000Z", "KV Databases / Eva Huber / (340110/2024W)", "S3 055"),
+    "later": ("20241028T080000Z", "20241028T093000Z", "VL Compilers / Eva Huber / (340120/2024W)", "S3 055"),
+    "added_over": ("20241021T060000Z", "20241021T070000Z", "IK Ethics / Eva Huber / (340130/2024W)", "HS 9"),
+}
+
+
+def feed(events):
+    lines = ["BEGIN:VCALENDAR", "VERSION:2.0", "PRODID:-//JKU//KUSSS//DE"]
+    for uid, (start, end, summary, location) in events.items():
+        lines += ["BEGIN:VEVENT", f"UID:{uid}", "DTSTAMP:20241001T120000Z", f"DTSTART:{start}", f"DTEND:{end}",
+                  f"SUMMARY:{summary}", f"LOCATION:{location}", "END:VEVENT"]
+    lines.append("END:VCALENDAR")
+    return "\r\n".join(lines).encode("utf-8")
+
+
+def snapshot(events, last_day):
+    event_index, _ = parse_feed(feed(events))
+    # The watcher keeps snapshots as JSON in FEED_SNAPSHOT
+    return json.loads(json.dumps(snapshot_events(event_index.events_between(NOW.date(), last_day))))
+
+
+@pytest.fixture(scope="module")
+def changes():
+    old = snapshot(OLD, OLD_WINDOW_END)
+    new = snapshot(NEW, date(2024, 11, 4))
+    return {(new or old)[3]: (kind, describe(kind, old, new)) for kind, old, new in
+            diff_snapshots(old, new, OLD_WINDOW_END, NOW)}
+
+
+@pytest.mark.parametrize("uid, kind, description", [
+    ("same", None, None),
+    ("cancelled", "removed", "🚫 Cancelled: VL Formal Models, Wed 23.10 10:15–11:45"),
+    ("moved", "changed", "🕒 Moved: UE Hands-on AI I, Tue 22.10 12:00 → Thu 24.10 12:00–13:30"),
+    ("room", "changed", "🏫 Room changed: VL Algorithms, Tue 22.10 14:00–15:30: HS 1 → HS 2"),
+    ("instructor", "changed", "✏️ Updated: UE Algorithms, Thu 24.10 08:30–10:00"),
+    ("added", "added", "🆕 New: KV Databases, Thu 24.10 16:00–17:30, S3 055"),
+    # Past the old window's end, it didn't appear, it only came into view
+    ("later", None, None),
+    # Already over when the change was seen
+    ("over", None, None),
+    ("added_over", None, None),
+])
+def test_classification(changes, uid, kind, description):
+    title = (NEW.get(uid) or OLD[uid])[2].split(" / ")[0]
+    assert changes.get(title, (None, None)) == (kind, description)
+
+
+def test_changes_in_start_order():
+    old = snapshot(OLD, OLD_WINDOW_END)
+    new = snapshot(NEW, date(2024, 11, 4))
+    starts = [(new or old)[1] for _, old, new in diff_snapshots(old, new, OLD_WINDOW_END, NOW)]
+    assert len(starts) == 5
+    assert starts == sorted(starts)
@@ -0,0 +1,231 @@
+"""
+The dispatch scheduler's fire times across midnight and DST, its windows, the lease heartbeat
+surviving database errors, and workers splitting a bucket's prefetch.
+Database calls are replaced, nothing here needs PostgreSQL.
+"""
+import asyncio
+import logging
+import sqlite3
+from datetime import datetime, timedelta
+import pytest
+import async_db
+import dispatch_scheduler
+from db_interaction import due_window_condition
+from dispatch_scheduler import DispatchScheduler, fire_time_on, minute_windows, next_fire_time
+from schedule import cet_timezone
+
+
+def cet(*args):
+    return cet_timezone.localize(datetime(*args))
+
+
+@pytest.mark.parametrize("now, minute_of_day, expected", [
+    ((2026, 3, 9, 23, 59, 30), 0, (2026, 3, 10, 0, 0)),
+    # Strictly after now, a bucket that just fired is due again tomorrow
+    ((2026, 3, 10, 0, 0), 0, (2026, 3, 11, 0, 0)),
+    ((2026, 3, 10, 0, 1), 0, (2026, 3, 11, 0, 0)),
+    ((2026, 3, 9, 23, 58), 1439, (2026, 3, 9, 23, 59)),
+    ((2026, 3, 9, 23, 59), 1439, (2026, 3, 10, 23, 59)),
+    ((2026, 12, 31, 23, 59, 59), 0, (2027, 1, 1, 0, 0)),
+])
+def test_next_fire_time_crosses_midnight(now, minute_of_day, expected):
+    assert next_fire_time(minute_of_day, cet(*now)) == cet(*expected)
+
+
+@pytest.mark.parametrize("day, offset_before, offset_after", [
+    # Clocks go forward 02:00 -> 03:00, and back 03:00 -> 02:00
+    ((2026, 3, 29), 1, 2),
+    ((2026, 10, 25), 2, 1),
+])
+@pytest.mark.parametrize("minute_of_day", [0, 8 * 60, 2 * 60, 2 * 60 + 30, 3 * 60, 23 * 60 + 59])
+def test_one_fire_per_day_across_dst(day, offset_before, offset_after, minute_of_day):
+    transition = datetime(*day).date()
+    now = cet(*day) - timedelta(days=1, seconds=1)
+    fires = []
+    for _ in range(5):
+        now = next_fire_time(minute_of_day, now)
+        fires.append(cet_timezone.normalize(now))
+
+    assert [fire.date() for fire in fires] == [transition + timedelta(days=offset) for offset in range(-1, 4)]
+    assert fires == sorted(fires)
+    for fire in fires:
+        changed = fire.date() > transition or (fire.date() == transition and minute_of_day >= 120)
+        assert fire.utcoffset() == timedelta(hours=offset_after if changed else offset_before)
+        wall_clock = fire.hour * 60 + fire.minute
+        if fire.date() == transition and offset_after > offset_before and 120 <= minute_of_day < 180:
+            # 02:xx doesn't exist that night, the message goes out an hour later
+            assert wall_clock == minute_of_day + 60
+        else:
+            # In autumn 02:xx happens twice, only the second one fires
+            assert wall_clock == minute_of_day
+
+
+@pytest.mark.parametrize("from_minute, to_minute, due", [
+    (480, 481, {480}),
+    (0, 1440, {0, 1, 479, 480, 1438, 1439}),
+    (1439, 1440, {1439}),
+    # Windows past midnight wrap around
+    (1430, 10, {0, 1, 1438, 1439}),
+    (1439, 1, {0, 1439}),
+    (1439, 0, {1439}),
+])
+def test_due_window_condition(from_minute, to_minute, due):
+    database = sqlite3.connect(":memory:")
+    database.execute("CREATE TABLE USERS (display_minute_of_day INTEGER)")
+    database.executemany("INSERT INTO USERS VALUES (?)", [(minute,) for minute in (0, 1, 479, 480, 1438, 1439)])
+    condition = due_window_condition(from_minute, to_minute).replace("%s", "?")
+    rows = database.execute(f"SELECT display_minute_of_day FROM USERS WHERE {condition}", (from_minute, to_minute))
+    assert {minute for minute, in rows} == due
+
+
+def test_minute_windows_split_at_midnight():
+    assert minute_windows(cet(2026, 3, 9, 23, 50), cet(2026, 3, 10, 0, 5)) == [
+        (23 * 60 + 50, 1440, cet(2026, 3, 9).date()),
+        (0, 6, cet(2026, 3, 10).date()),
+    ]
+    assert minute_windows(cet(2026, 3, 10, 8, 0), cet(2026, 3, 10, 8, 2)) == [(480, 483, cet(2026, 3, 10).date())]
+
+
+def test_heartbeat_survives_database_errors(monkeypatch, caplog):
+    calls = {"renew": 0, "minutes": 0, "enqueued": []}
+
+    async def renew_leases_DB(worker_id, lease_seconds):
+        calls["renew"] += 1
+        if calls["renew"] == 1:
+            raise RuntimeError("connection pool exhausted")
+
+    async def get_display_minutes_DB():
+        calls["minutes"] += 1
+        if calls["minutes"] == 1:
+            raise RuntimeError("server closed the connection")
+        return [480]
+
+    async def enqueue_due_jobs_DB(from_minute, to_minute, fire_date):
+        calls["enqueued"].append((from_minute, to_minute, fire_date))
+
+    async def claim_jobs_DB(fire_date, worker_id, lease_seconds, batch_size):
+        return []
+
+    monkeypatch.setattr(async_db, "renew_leases_DB", renew_leases_DB)
+    monkeypatch.setattr(async_db, "get_display_minutes_DB", get_display_minutes_DB)
+    monkeypatch.setattr(async_db, "enqueue_due_jobs_DB", enqueue_due_jobs_DB)
+    monkeypatch.setattr(async_db, "claim_jobs_DB", claim_jobs_DB)
+
+    async def run():
+        scheduler = DispatchScheduler(lease_seconds=0.03)
+        scheduler._claimed = 1
+        scheduler._swept_at = dispatch_scheduler.get_current_date(time=True)
+        scheduler._spawn(scheduler._maintain_leases())
+        await asyncio.sleep(0.2)
+        for task in list(scheduler._tasks):
+            task.cancel()
+        return scheduler
+
+    with caplog.at_level(logging.ERROR):
+        scheduler = asyncio.run(run())
+    assert calls["renew"] > 3
+    assert calls["minutes"] > 1
+    # The sweeps after the failed one enqueued the minutes since the last sweep again
+    assert calls["enqueued"]
+    assert (dispatch_scheduler.SEND, 480) in scheduler._scheduled
+    assert "connection pool exhausted" in caplog.text
+
+
+def test_failed_task_is_logged(caplog):
+    async def fail():
+        raise RuntimeError("enqueue failed")
+
+    async def run():
+        scheduler = DispatchScheduler()
+        scheduler._spawn(fail())
+        await asyncio.sleep(0)
+        await asyncio.sleep(0)
+        return scheduler
+
+    with caplog.at_level(logging.ERROR):
+        scheduler = asyncio.run(run())
+    assert not scheduler._tasks
+    assert "enqueue failed" in caplog.text
+
+
+class Ledger():
+    # In-memory DELIVERY_LEDGER with the reservation and claim rules of db_interaction
+    def __init__(self, users):
+        self.users = users
+        self.jobs = {}
+
+    def due(self, from_minute, to_minute):
+        return [telegram_id for telegram_id, (_, minute) in self.users.items() if from_minute <= minute < to_minute]
+
+    async def enqueue_prefetch_jobs_DB(self, from_minute, to_minute, target_date):
+        for telegram_id in self.due(from_minute, to_minute):
+            self.jobs.setdefault(telegram_id, {"status": "reserved", "owner": None})
+
+    async def claim_prefetch_jobs_DB(self, from_minute, to_minute, target_date, worker_id, reserved_until, batch_size):
+        await asyncio.sleep(0)
+        rows = []
+        for telegram_id in self.due(from_minute, to_minute):
+            job = self.jobs[telegram_id]
+            if job["status"] == "reserved" and job["owner"] is None and len(rows) < batch_size:
+                job["owner"] = worker_id
+                rows.append((telegram_id, self.users[telegram_id][0]))
+        return rows
+
+    async def enqueue_due_jobs_DB(self, from_minute, to_minute, target_date):
+        for telegram_id in self.due(from_minute, to_minute):
+            job = self.jobs.setdefault(telegram_id, {"status": "pending", "owner": None})
+            if job["status"] == "reserved":
+                job["status"] = "pending"
+
+    async def claim_jobs_DB(self, target_date, worker_id, lease_seconds, batch_size):
+        rows = []
+        for telegram_id, job in self.jobs.items():
+            if job["status"] == "pending" and job["owner"] in (None, worker_id) and len(rows) < batch_size:
+                job["status"] = "claimed"
+                job["owner"] = worker_id
+                url, minute = self.users[telegram_id]
+                rows.append((telegram_id, url, minute // 60, minute % 60))
+        return rows
+
+
+def test_workers_prefetch_only_what_they_send(monkeypatch):
+    minute = 8 * 60
+    ledger = Ledger({telegram_id: (f"https://www.kusss.jku.at/{telegram_id}.ics", minute) for telegram_id in range(40)})
+    for name in ("enqueue_prefetch_jobs_DB", "claim_prefetch_jobs_DB", "enqueue_due_jobs_DB", "claim_jobs_DB"):
+        monkeypatch.setattr(async_db, name, getattr(ledger, name))
+    prepared = {}
+    sent = {}
+
+    def worker(worker_id):
+        scheduler = DispatchScheduler(batch_size=5, worker_id=worker_id)
+
+        async def prepare(url, fire_date):
+            prepared.setdefault(worker_id, []).append(url)
+            return f"message for {url}"
+
+        async def send_batch(due_users):
+            sent.setdefault(worker_id, []).extend(due_users)
+
+        scheduler._prepare = prepare
+        scheduler._send_batch = send_batch
+        return scheduler
+
+    async def run():
+        workers = [worker("w1"), worker("w2")]
+        now = dispatch_scheduler.get_current_date(time=True)
+        fire_at = fire_time_on(now.date(), minute)
+        # The clock stands at the fire time, so the prefetches aren't spread out
+        monkeypatch.setattr(dispatch_scheduler, "get_current_date", lambda time=False: fire_at)
+        await asyncio.gather(*(scheduler._prefetch_bucket(minute, fire_at) for scheduler in workers))
+        for scheduler in workers:
+            await asyncio.gather(*scheduler._tasks)
+        await asyncio.gather(*(scheduler._dispatch_window(minute, minute + 1, fire_at.date()) for scheduler in workers))
+
+    asyncio.run(run())
+    assert sum(len(urls) for urls in prepared.values()) == 40
+    assert set(prepared) == {"w1", "w2"}
+    for worker_id, due_users in sent.items():
+        # Every message a worker sends is one it prefetched
+        assert all(message is not None for _, _, message, _ in due_users)
+        assert sorted(url for _, url, _, _ in due_users) == sorted(prepared[worker_id])
+    assert sum(len(due_users) for due_users in sent.values()) == 40
@@ -0,0 +1,153 @@
+"""
+The circuit breaker's transitions and the AIMD download limit, on a fake
+clock.
+"""
+import asyncio
+import pytest
+from feed_fetcher import AdaptiveLimit, CircuitBreaker, FEED_BREAKER_MAX_COOLDOWN
+
+
+class Clock():
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock():
+    return Clock()
+
+
+def open_breaker(clock, threshold=3, cooldown=30):
+    breaker = CircuitBreaker(threshold=threshold, cooldown=cooldown, clock=clock)
+    for _ in range(threshold):
+        breaker.record_failure(breaker.allow())
+    return breaker
+
+
+def test_opens_after_threshold_consecutive_failures(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=30, clock=clock)
+    assert not breaker.record_failure(breaker.allow())
+    assert not breaker.record_failure(breaker.allow())
+    # A success in between starts the count again
+    breaker.record_success(breaker.allow())
+    assert not breaker.record_failure(breaker.allow())
+    assert not breaker.record_failure(breaker.allow())
+    assert breaker.state == "closed"
+    assert breaker.record_failure(breaker.allow())
+    assert breaker.state == "open"
+    assert breaker.allow() is None
+
+
+def test_half_open_lets_one_probe_through(clock):
+    breaker = open_breaker(clock)
+    clock.now += 29.9
+    assert breaker.allow() is None
+    clock.now += 0.1
+    assert breaker.state == "half-open"
+    probe = breaker.allow()
+    assert probe.probe
+    assert breaker.state == "open"
+    assert breaker.allow() is None
+
+
+def test_probe_success_closes(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    breaker.record_success(breaker.allow())
+    assert breaker.state == "closed"
+    assert breaker.cooldown == 30
+    assert not breaker.allow().probe
+
+
+def test_probe_failure_reopens_for_twice_as_long(clock):
+    breaker = open_breaker(clock)
+    cooldown = 30
+    while cooldown < FEED_BREAKER_MAX_COOLDOWN:
+        clock.now += cooldown
+        breaker.record_failure(breaker.allow())
+        cooldown = min(cooldown * 2, FEED_BREAKER_MAX_COOLDOWN)
+        assert breaker.cooldown == cooldown
+        clock.now += cooldown - 1
+        assert breaker.state == "open"
+        clock.now += 1
+        assert breaker.state == "half-open"
+    breaker.record_failure(breaker.allow())
+    assert breaker.cooldown == FEED_BREAKER_MAX_COOLDOWN
+
+
+def test_stale_outcomes_dont_decide_the_probe(clock):
+    breaker = CircuitBreaker(threshold=3, cooldown=30, clock=clock)
+    slow = breaker.allow()
+    for _ in range(3):
+        breaker.record_failure(breaker.allow())
+    clock.now += 30
+    probe = breaker.allow()
+    # The request from before the circuit opened fails while the probe is out
+    assert not breaker.record_failure(slow)
+    assert breaker.probing
+    assert breaker.cooldown == 30
+    breaker.record_success(probe)
+    assert breaker.state == "closed"
+    # And a late success doesn't reset what the new generation counted
+    breaker.record_failure(breaker.allow())
+    breaker.record_success(slow)
+    assert breaker.failures == 1
+
+
+def test_unfinished_probe_lets_the_next_one_through(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    probe = breaker.allow()
+    breaker.finish(probe)
+    assert breaker.state == "half-open"
+    assert breaker.allow().probe
+
+
+def test_finished_request_doesnt_touch_a_newer_probe(clock):
+    breaker = open_breaker(clock)
+    clock.now += 30
+    first = breaker.allow()
+    breaker.record_failure(first)
+    clock.now += 60
+    second = breaker.allow()
+    breaker.finish(first)
+    assert breaker.probing
+    breaker.finish(second)
+    assert not breaker.probing
+
+
+def run_downloads(limit, outcomes):
+    # outcomes: (latency, overloaded) per download, one after the other
+    async def run():
+        for latency, overloaded in outcomes:
+            lane = await limit.acquire()
+            await limit.release(lane, latency, overloaded)
+    asyncio.run(run())
+
+
+def test_limit_grows_additively(clock):
+    limit = AdaptiveLimit(initial=4, minimum=1, maximum=6, latency_target=2, reserved=0, clock=clock)
+    run_downloads(limit, [(0.1, False)] * 4)
+    # 1/limit per download, about one per round
+    assert 4.9 < limit.limit < 5
+    run_downloads(limit, [(0.1, False)] * 20)
+    assert limit.limit == 6
+
+
+def test_limit_halves_once_per_latency_target(clock):
+    limit = AdaptiveLimit(initial=16, minimum=1, maximum=32, latency_target=2, reserved=0, clock=clock)
+    run_downloads(limit, [(5.0, False)])
+    assert limit.limit == 8
+    # The rest of the same bad round
+    run_downloads(limit, [(5.0, False), (0.1, True)])
+    assert limit.limit == 8
+    clock.now += 2.1
+    run_downloads(limit, [(0.1, True)])
+    assert limit.limit == 4
+    for _ in range(5):
+        clock.now += 2.1
+        run_downloads(limit, [(5.0, False)])
+    assert limit.limit == 1
@@ -0,0 +1,63 @@
+"""
+Feeds written to the feed store come back with the same events, and loading
+them leaves no file open.
+"""
+import os
+import pytest
+from calendar_cache import CacheEntry
+from event_store import content_key, event_store
+from feed_store import FeedStore
+from parse_pool import parse_feed
+
+FEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feeds")
+
+
+def fields(event_index):
+    return [(day, [content_key(record) for record in events]) for day, events in event_index.days()]
+
+
+def stored(directory, url, name):
+    with open(os.path.join(FEEDS, f"{name}.ics"), "rb") as file:
+        body = file.read()
+    event_index, _ = parse_feed(body)
+    entry = CacheEntry(url, body, event_store.intern_index(event_index), '"etag"', None)
+    store = FeedStore(directory=str(directory), enabled=1)
+    store._write(entry)
+    return store, entry
+
+
+def test_round_trip(tmp_path):
+    store, entry = stored(tmp_path, "https://www.kusss.jku.at/a.ics", "tzid")
+    restored = store.load(entry.url)
+    assert restored.digest == entry.digest
+    assert restored.etag == '"etag"'
+    assert restored.restored
+    assert fields(restored.parsed) == fields(entry.parsed)
+
+
+def test_missing_and_foreign(tmp_path):
+    store, entry = stored(tmp_path, "https://www.kusss.jku.at/a.ics", "utc")
+    assert store.load("https://www.kusss.jku.at/b.ics") is None
+    os.replace(store.path(entry.url), store.path("https://www.kusss.jku.at/b.ics"))
+    assert store.load("https://www.kusss.jku.at/b.ics") is None
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc/self/fd"), reason="needs /proc")
+def test_loaded_feeds_hold_no_file_descriptors(tmp_path):
+    store, entry = stored(tmp_path, "https://www.kusss.jku.at/a.ics", "tzid")
+    before = len(os.listdir("/proc/self/fd"))
+    restored = [store.load(entry.url) for _ in range(50)]
+    assert all(restored)
+    assert len(os.listdir("/proc/self/fd")) == before
+
+
+def test_restored_feeds_share_events(tmp_path):
+    # Two users on the same course list, and a third whose feed is still in memory
+    store, first = stored(tmp_path, "https://www.kusss.jku.at/a.ics", "tzid")
+    store, second = stored(tmp_path, "https://www.kusss.jku.at/b.ics", "tzid")
+    a = store.load(first.url)
+    b = store.load(second.url)
+    for (_, restored_a), (_, restored_b), (_, fresh) in zip(a.parsed.days(), b.parsed.days(), first.parsed.days()):
+        assert all(x is y is z for x, y, z in zip(restored_a, restored_b, fresh))
+    # Only ids are charged to feeds whose events were already stored
+    assert a.size < len(open(store.path(a.url), "rb").read())
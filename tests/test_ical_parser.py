@@ -0,0 +1,91 @@
+"""
+The streaming parser must give the bot exactly what ics gave it. Every
+sample feed is parsed both ways and the events are compared field by field.
+"""
+import os
+from datetime import date
+import pytest
+from ics import Calendar
+from event_index import EventIndex
+from ical_parser import parse_events, UnsupportedFeed
+from parse_pool import parse_feed
+
+FEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feeds")
+
+SUPPORTED = ["tzid", "utc", "floating", "date_only", "folded", "escaped", "valarm"]
+FALLBACK = ["rrule", "unknown_tzid"]
+
+
+def read_feed(name):
+    with open(os.path.join(FEEDS, f"{name}.ics"), "rb") as file:
+        return file.read()
+
+
+def fields(event_index):
+    # Offsets included, the same instant in another zone renders another time.
+    # Sorted, ics keeps events in a set and orders events with equal starts at random.
+    return sorted(
+        (record.start, record.start.utcoffset(), record.end, record.end.utcoffset(),
+         record.title, record.instructor, record.location, record.uid)
+        for _, events in event_index.days() for record in events
+    )
+
+
+def reference(feed):
+    return EventIndex.from_calendar(Calendar(feed.decode("utf-8")))
+
+
+@pytest.mark.parametrize("name", SUPPORTED)
+def test_matches_ics(name):
+    feed = read_feed(name)
+    expected = fields(reference(feed))
+    assert expected
+    assert fields(EventIndex(parse_events(feed))) == expected
+
+
+@pytest.mark.parametrize("name", SUPPORTED)
+def test_text_and_bytes_agree(name):
+    feed = read_feed(name)
+    assert fields(EventIndex(parse_events(feed.decode("utf-8")))) == fields(EventIndex(parse_events(feed)))
+
+
+def test_all_events_across_dst_change():
+    # Two weeks around the end of summer time on 27.10.2024
+    events = fields(EventIndex(parse_events(read_feed("tzid"))))
+    assert len(events) == 42
+    assert {offset.total_seconds() for _, offset, *_ in events} == {7200, 3600}
+
+
+def test_unescaped_text():
+    records = parse_events(read_feed("escaped"))
+    assert records[0].title == "KV Responsible AI, Ethics; Law"
+    assert records[0].location == "HS 1, Kepler Gebäude; EG\nEingang C\\Süd"
+
+
+def test_escaped_backslash_before_n():
+    # RFC 5545: "\\N" is a backslash and an N. ics reads a newline after the backslash, we don't follow it there.
+    feed = read_feed("escaped").replace("C\\\\Süd".encode("utf-8"), b"C\\\\Nord")
+    assert parse_events(feed)[0].location.endswith("Eingang C\\Nord")
+
+
+def test_day_window():
+    feed = read_feed("tzid")
+    day = date(2024, 10, 27)
+    records = parse_events(feed, day, day)
+    assert [record.start.date() for record in records] == [day] * 3
+    assert fields(EventIndex(records)) == [event for event in fields(reference(feed)) if event[0].date() == day]
+
+
+@pytest.mark.parametrize("name", FALLBACK)
+def test_unsupported_feeds_fall_back_to_ics(name):
+    feed = read_feed(name)
+    with pytest.raises(UnsupportedFeed):
+        parse_events(feed)
+    event_index, fallback = parse_feed(feed)
+    assert fallback is not None
+    assert fields(event_index) == fields(reference(feed))
+
+
+def test_supported_feeds_dont_fall_back():
+    for name in SUPPORTED:
+        assert parse_feed(read_feed(name))[1] is None
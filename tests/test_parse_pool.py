@@ -0,0 +1,55 @@
+"""
+Parse workers are spawned processes. They must not re-import the bot's main
+script, and must come up without the PostgreSQL log handler.
+"""
+import asyncio
+import os
+from multiprocessing import spawn
+from custom_logging import logger, db_handler
+from parse_pool import ParsePool, bare_main
+
+FEEDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "feeds")
+
+
+def logs_to_database():
+    return db_handler in logger.handlers
+
+
+def test_workers_detach_db_handler():
+    async def run():
+        pool = ParsePool(size=1)
+        await pool.start()
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(pool._executor, logs_to_database)
+        finally:
+            pool.shutdown()
+
+    assert asyncio.run(run()) is False
+
+
+def test_parse_during_warm_up():
+    feed = open(os.path.join(FEEDS, "tzid.ics"), "rb").read()
+
+    async def run():
+        pool = ParsePool(size=1, min_bytes=0)
+        starting = asyncio.create_task(pool.start())
+        while pool._executor is None:
+            await asyncio.sleep(0)
+        warming_up = not starting.done()
+        try:
+            return await pool.parse(feed), warming_up
+        finally:
+            await starting
+            pool.shutdown()
+
+    event_index, warming_up = asyncio.run(run())
+    assert warming_up
+    assert len(event_index.days()) > 0
+
+
+def test_workers_skip_main_script():
+    with bare_main():
+        preparation = spawn.get_preparation_data("worker")
+    assert "init_main_from_path" not in preparation
+    assert "init_main_from_name" not in preparation
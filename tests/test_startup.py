@@ -0,0 +1,30 @@
+"""
+The bot must import and reach polling within budget, without connecting to
+PostgreSQL. probe() starts a fresh interpreter, modules the tests already
+imported don't hide a slow or eager import.
+"""
+from check_startup import check, probe
+
+
+def test_startup_within_budget():
+    result = probe()
+    assert check(result) == []
+    assert not result["heavy_modules"]
+    assert not result["db_pool_created"]
+    assert not result["log_connection_opened"]
+
+
+def test_check_reports_regressions():
+    result = {
+        "import_seconds": 9.0,
+        "first_poll_seconds": 2.0,
+        "heavy_modules": ["ics"],
+        "db_pool_created": True,
+        "log_connection_opened": True,
+    }
+    assert len(check(result)) == 5
+    assert check(result, import_budget=10, startup_budget=3) == [
+        "imported eagerly: ics",
+        "database pool created before it was needed",
+        "log handler connected to PostgreSQL during startup",
+    ]
@@ -0,0 +1,45 @@
+from aiohttp import web
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+import config
+from custom_logging import logger
+
+# Public HTTPS address Telegram posts updates to, e.g. https://bot.example.com
+WEBHOOK_URL = config.get("WEBHOOK_URL")
+WEBHOOK_PATH = config.get("WEBHOOK_PATH", "/webhook")
+# Telegram sends it in X-Telegram-Bot-Api-Secret-Token, anything else gets 401
+WEBHOOK_SECRET = config.get("WEBHOOK_SECRET")
+# Where the reverse proxy forwards the webhook to
+WEBHOOK_HOST = config.get("WEBHOOK_HOST", "127.0.0.1")
+WEBHOOK_PORT = config.get("WEBHOOK_PORT", 8080, int)
+# Lets several workers listen on the same port, the kernel spreads connections between them
+WEBHOOK_REUSE_PORT = config.get("WEBHOOK_REUSE_PORT", 0, int)
+# Parallel connections Telegram may open to deliver updates (1-100)
+WEBHOOK_MAX_CONNECTIONS = config.get("WEBHOOK_MAX_CONNECTIONS", 40, int)
+
+
+async def start_webhook_server(bot, dispatcher, host=WEBHOOK_HOST, port=WEBHOOK_PORT, path=WEBHOOK_PATH,
+                               secret=WEBHOOK_SECRET, reuse_port=WEBHOOK_REUSE_PORT):
+    if not secret:
+        raise ValueError("WEBHOOK_SECRET must be set in webhook mode")
+    app = web.Application()
+    # Every update is acknowledged as soon as it is parsed and handled in a
+    # task of its own, Telegram doesn't wait for the handlers
+    SimpleRequestHandler(dispatcher=dispatcher, bot=bot, secret_token=secret,
+                         handle_in_background=True).register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port, reuse_port=bool(reuse_port)).start()
+    logger.info(f"Webhook served on http://{host}:{port}{path}")
+    return runner
+
+
+async def register_webhook(bot, dispatcher, url=WEBHOOK_URL, path=WEBHOOK_PATH, secret=WEBHOOK_SECRET,
+                           max_connections=WEBHOOK_MAX_CONNECTIONS):
+    # Every worker registers the same address, repeating it changes nothing
+    if not url:
+        logger.warning("WEBHOOK_URL is not set, expecting the webhook to be registered already.")
+        return
+    await bot.set_webhook(url.rstrip("/") + path, secret_token=secret, max_connections=max_connections,
+                          allowed_updates=dispatcher.resolve_used_update_types())
+    logger.info(f"Webhook registered at {url.rstrip('/')}{path}")